@@ -32,26 +32,48 @@ try:
 except ImportError:
     geoip2_available = False
 
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, where a single writer is assumed
+    fcntl = None
+
 import socket
 import re
 import argparse
 import sys
 import os
 import logging
+import threading
+import select
+import atexit
+import time
+import hashlib
+import heapq
+import random
+import base64
+import json
+import sqlite3
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from humanize import naturalsize
-from collections import OrderedDict, deque
+from collections import OrderedDict
 from pprint import pformat
 from semantic_version import Version as semver
+from jinja2 import Environment
+from markupsafe import Markup
 import flask
 
-
-logger = logging.getLogger(__name__)
+# The management interface line reader is shared with src/, which is
+# installed alongside this script as the util package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from util.line_reader import LineReader  # noqa: E402
 
 
-def output(s):
-    global wsgi_output
-    wsgi_output += s
+logger = logging.getLogger(__name__)
 
 
 def get_date(date_string, uts=False):
@@ -101,14 +123,37 @@ class ConfigLoader(object):
         logger.info('Using default settings => localhost:5555')
         self.settings = {'site': 'Default Site',
                          'geoip_data': '/usr/share/GeoIP/GeoIPCity.dat',
-                         'datetime_format': '%d/%m/%Y %H:%M:%S'}
+                         'datetime_format': '%d/%m/%Y %H:%M:%S',
+                         'concurrency': '10',
+                         'refresh_interval': '10',
+                         'coalesce_window': '0',
+                         'geoip_cache_size': '10000',
+                         'geoip_cache_ttl': '3600',
+                         'metrics_client_labels': 'False',
+                         'stats_samples': '60',
+                         'bytecount_interval': '0',
+                         'connect_timeout': '3',
+                         'command_timeout': '10',
+                         'request_timeout': '15',
+                         'breaker_threshold': '3',
+                         'breaker_backoff': '5',
+                         'breaker_max_backoff': '300',
+                         'event_driven': 'False',
+                         'reconcile_interval': '300'}
         self.vpns['Default VPN'] = {'name': 'default',
                                     'host': 'localhost',
                                     'port': '5555',
                                     'show_disconnect': False}
 
     def parse_global_section(self, config):
-        global_vars = ['site', 'logo', 'latitude', 'longitude', 'geoip_data', 'datetime_format']
+        global_vars = ['site', 'logo', 'latitude', 'longitude', 'geoip_data', 'datetime_format',
+                       'concurrency', 'persistent_connections', 'refresh_interval',
+                       'coalesce_window', 'geoip_cache_size', 'geoip_cache_ttl',
+                       'metrics_client_labels', 'stats_samples', 'history_db',
+                       'history_retention', 'event_log', 'event_log_segments',
+                       'bytecount_interval', 'connect_timeout', 'command_timeout',
+                       'request_timeout', 'breaker_threshold', 'breaker_backoff',
+                       'breaker_max_backoff', 'event_driven', 'reconcile_interval']
         for var in global_vars:
             try:
                 self.settings[var] = config.get('openvpn-monitor', var)
@@ -141,121 +186,1192 @@ class ConfigLoader(object):
         logger.debug("=== begin section\n%s\n=== end section", vpn)
 
 
-class OpenvpnMgmtInterface(object):
+client_stats = {'TUN/TAP read bytes': 'tuntap_read',
+                'TUN/TAP write bytes': 'tuntap_write',
+                'TCP/UDP read bytes': 'tcpudp_read',
+                'TCP/UDP write bytes': 'tcpudp_write',
+                'Auth read bytes': 'auth_read'}
 
-    def __init__(self, cfg, **kwargs):
-        self.vpns = cfg.vpns
 
-        if 'vpn_id' in kwargs:
-            vpn = self.vpns[kwargs['vpn_id']]
-            self._socket_connect(vpn)
-            if vpn['socket_connected']:
-                release = self.send_command('version\n')
-                version = semver(self.parse_version(release).split(' ')[1])
-                if version.major == 2 and \
-                        version.minor >= 4 and \
-                        'port' not in kwargs:
-                    command = 'client-kill {0!s}\n'.format(kwargs['client_id'])
+def socket_error_str(e):
+    if getattr(e, 'strerror', None):
+        return '{0!s}'.format(e.strerror)
+    return '{0!s}'.format(e)
+
+
+# greeting of an interface shared through src/mux.py
+MULTIPLEXED = 'multiplexed by openvpn-monitor'
+
+
+class MgmtConnection(object):
+    """A management interface socket for a single VPN, kept open between uses.
+
+    Connecting (and logging in) must finish within connect_timeout seconds,
+    and each command response within command_timeout seconds, and both by
+    the deadline of the current request if there is one.
+    """
+
+    connect_timeout = 3
+    command_timeout = 10
+
+    def __init__(self, vpn, on_notification=None):
+        self.address = self.get_address(vpn)
+        self.password = vpn.get('password')
+        self.on_notification = on_notification
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.s = None
+        self.reader = None
+        self.reused = False
+        self.bytecount = 0  # interval of byte count notifications asked for
+        # version, management version and commands of the daemon, see
+        # OpenvpnMgmtInterface.get_capabilities
+        self.capabilities = None
+        self.multiplexed = False
+        self.event_driven = False  # whether event-driven collection was asked for
+        self.events = None  # ClientEvents, if collection is event-driven
+        self.warned_client_auth = False
+
+    @staticmethod
+    def get_address(vpn):
+        if 'socket' in vpn:
+            return vpn['socket']
+        try:
+            return (vpn['host'], int(vpn['port']))
+        except (KeyError, TypeError, ValueError) as e:
+            raise socket.error('invalid host or port: {0!s}'.format(e))
+
+    @property
+    def connected(self):
+        return self.s is not None
+
+    def get_deadline(self, timeout):
+        """time.monotonic() by which something allowed timeout seconds must finish."""
+        deadline = time.monotonic() + timeout
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+        return deadline
+
+    def connect(self):
+        deadline = self.get_deadline(self.connect_timeout)
+        try:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout('no time left to connect')
+            if isinstance(self.address, tuple):
+                self.s = socket.create_connection(self.address, timeout)
+            else:
+                self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.s.settimeout(timeout)
+                self.s.connect(self.address)
+            self.reader = LineReader(self.s, self.notify)
+            self.reader.deadline = deadline
+            self._login()
+        except Exception:
+            self.close(quit=False)
+            raise
+        self.reused = False
+        self.bytecount = 0
+        self.capabilities = None
+        self.event_driven = False
+        self.events = None
+        self.warned_client_auth = False
+
+    def _login(self):
+        while True:
+            line = self.reader.readline(prompts=(b'ENTER PASSWORD:',))
+            if line.startswith('>INFO'):
+                self.multiplexed = MULTIPLEXED in line
+                return
+            elif line == 'ENTER PASSWORD:':
+                if not self.password:
+                    raise socket.error('management interface requires a password')
+                self._socket_send('{0!s}\n'.format(self.password))
+            elif line.startswith('ERROR'):
+                raise socket.error(line)
+
+    def is_alive(self):
+        """Check the socket is still usable, buffering any pending async notifications."""
+        if self.s is None:
+            return False
+        # only reads what select says has arrived
+        self.reader.deadline = None
+        try:
+            while True:
+                readable, _, _ = select.select([self.s], [], [], 0)
+                if not readable:
+                    return True
+                # buffered notifications are skipped by the next response
+                self.reader.fill()
+        except (socket.error, ValueError):
+            return False
+
+    def close(self, quit=True):
+        if self.s is None:
+            return
+        try:
+            if quit:
+                self._socket_send('quit\n')
+            self.s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.s.close()
+        self.s = None
+        self.reader = None
+
+    def _socket_send(self, command):
+        self.s.settimeout(max(0.001, self.get_deadline(self.command_timeout) - time.monotonic()))
+        if sys.version_info[0] == 2:
+            self.s.sendall(command)
+        else:
+            self.s.sendall(bytes(command, 'utf-8'))
+
+    def iter_command(self, command):
+        """Send command and yield the response lines as they arrive.
+
+        The generator must be exhausted before the next command is sent.
+        """
+        logger.info('Sending command: %s', command.strip())
+        self._socket_send(command)
+        self.reader.deadline = self.get_deadline(self.command_timeout)
+        for line in self.reader.response():
+            yield line
+
+    def iter_batch(self, commands):
+        """Send commands in a single write and yield a generator of the
+        response lines of each in turn.
+
+        The interface answers the commands in order, so the whole batch
+        costs one round trip. Each response must be exhausted before the
+        next is taken, and every response before the next command is sent.
+        """
+        logger.info('Sending commands: %s', ', '.join(c.strip() for c in commands))
+        self._socket_send(''.join(commands))
+        for _ in commands:
+            # each response has its own budget from when it is waited for
+            self.reader.deadline = self.get_deadline(self.command_timeout)
+            yield self.reader.response()
+
+    def send_command(self, command):
+        lines = list(self.iter_command(command))
+        if command.startswith('kill') or command.startswith('client-kill'):
+            return
+        return self.get_data(lines)
+
+    def send_batch(self, commands):
+        return [self.get_data(lines) for lines in self.iter_batch(commands)]
+
+    @staticmethod
+    def get_data(lines):
+        data = '\r\n'.join(lines) + '\r\n'
+        logger.debug("=== begin raw data\n%s\n=== end raw data", data)
+        return data
+
+    def notify(self, line):
+        """Handle an asynchronous notification: client and state ones if
+        collection is event-driven, any others with on_notification."""
+        if self.events is not None and self.events.notify(line):
+            return
+        if (line.startswith('>CLIENT:CONNECT,') or line.startswith('>CLIENT:REAUTH,')) and \
+                not self.multiplexed and not self.warned_client_auth:
+            # nobody else can answer on an interface that isn't shared
+            logger.warning('%s runs with --management-client-auth and is waiting for openvpn-monitor to '
+                           'answer client-auth, which it never does: its clients cannot connect',
+                           self.address)
+            self.warned_client_auth = True
+        if self.on_notification is not None:
+            self.on_notification(line)
+        else:
+            logger.debug('Discarding notification: %s', line)
+
+    def set_event_driven(self, enabled, reconcile_interval):
+        """Start or stop event-driven collection, see ClientEvents."""
+        self.event_driven = enabled
+        if not enabled:
+            if self.events is not None:
+                self.events = None
+                self.send_command('state off\n')
+            return
+        if not self.multiplexed:
+            logger.warning('%s is not shared through the multiplexer, so it can only send client '
+                           'notifications if openvpn-monitor answers client-auth, which it does not: '
+                           'polling it instead', self.address)
+            return
+        data = self.send_command('state on\n')
+        if data.startswith('ERROR'):
+            logger.warning('real-time state not supported by %s: %s', self.address, data.strip())
+        self.events = ClientEvents(reconcile_interval)
+
+    def set_bytecount(self, interval):
+        """Ask for byte count notifications every interval seconds, or stop them with 0."""
+        data = self.send_command('bytecount {0:d}\n'.format(interval))
+        if data.startswith('ERROR'):
+            logger.warning('bytecount not supported by %s: %s', self.address, data.strip())
+        self.bytecount = interval
+
+
+class ClientEvents(object):
+    """Sessions of a VPN kept up to date from the client notifications on
+    its management connection, so that a full 'status 3' is only needed
+    every reconcile_interval seconds rather than on every collection.
+
+    OpenVPN only sends >CLIENT notifications when run with
+    --management-client-auth, and then waits for every CONNECT and REAUTH
+    to be answered with client-auth or client-deny. openvpn-monitor never
+    answers them, so collection is only event-driven through the
+    multiplexer (src/mux.py), shared with the client that does.
+
+    Sessions are keyed by client ID. Status output has none before
+    OpenVPN 2.4, so those sessions are only updated by full dumps. A full
+    dump is also taken after any state other than CONNECTED, as clients
+    may be dropped without notifications when the daemon restarts.
+    """
+
+    def __init__(self, reconcile_interval):
+        self.reconcile_interval = reconcile_interval
+        self.sessions = None  # client id => session, from the last full dump and notifications since
+        self.reconciled = None  # time.monotonic() of the last full dump
+        self.pending = None  # client events received during a full dump, applied after it
+        self.client = None  # (event, client id, env) of a notification until its environment ends
+        self.changed = time.monotonic()  # when the sessions last changed, for the digest of the data
+
+    @property
+    def due(self):
+        """Whether a full dump should be taken with the next collection."""
+        return self.sessions is None or self.reconciled is None or \
+            time.monotonic() - self.reconciled >= self.reconcile_interval
+
+    def start_dump(self):
+        self.pending = []
+
+    def reconcile(self, sessions):
+        """Replace the sessions with those of a full dump, then apply the
+        events received during it, which it may or may not reflect."""
+        pending, self.pending = self.pending or [], None
+        if 'Client' in sessions:
+            # client mode has no client notifications, keep dumping
+            return
+        self.sessions = OrderedDict((SessionRates.get_key(session), dict(session))
+                                    for session in sessions.values())
+        self.reconciled = time.monotonic()
+        self.changed = self.reconciled
+        for event in pending:
+            self.apply(*event)
+
+    def notify(self, line):
+        """Apply a notification, returning whether nothing else needs it."""
+        if line.startswith('>CLIENT:ENV,'):
+            if self.client is not None:
+                env = line[len('>CLIENT:ENV,'):]
+                if env == 'END':
+                    event, self.client = self.client, None
+                    self.apply(*event)
                 else:
-                    command = 'kill {0!s}:{1!s}\n'.format(kwargs['ip'], kwargs['port'])
-                self.send_command(command)
-                self._socket_disconnect()
+                    name, _, value = env.partition('=')
+                    self.client[2][name] = value
+            return True
+        elif line.startswith('>CLIENT:'):
+            parts = line[len('>CLIENT:'):].split(',')
+            # ADDRESS notifications have no environment
+            if parts[0] != 'ADDRESS':
+                self.client = (parts[0], parts[1] if len(parts) > 1 else None, {})
+            return True
+        elif line.startswith('>STATE:'):
+            parts = line[len('>STATE:'):].split(',')
+            if len(parts) > 1 and parts[1] != 'CONNECTED':
+                self.reconciled = None
+            return True
+        elif line.startswith('>BYTECOUNT_CLI:'):
+            parts = line[len('>BYTECOUNT_CLI:'):].split(',')
+            session = self.sessions.get(parts[0]) if self.sessions is not None else None
+            if session is not None and len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                session['bytes_recv'], session['bytes_sent'] = int(parts[1]), int(parts[2])
+                self.changed = time.monotonic()
+            # rates are worked out by ByteCounts
+            return False
+        return False
+
+    def apply(self, event, client_id, env):
+        if self.pending is not None:
+            self.pending.append((event, client_id, env))
+        elif self.sessions is None:
+            return
+        elif event == 'ESTABLISHED':
+            session = self.get_session(client_id, env)
+            if session is not None:
+                self.sessions[client_id] = session
+                self.changed = time.monotonic()
+        elif event == 'DISCONNECT':
+            if self.sessions.pop(client_id, None) is not None:
+                self.changed = time.monotonic()
 
-        geoip_data = cfg.settings['geoip_data']
-        self.geoip_version = None
+    @staticmethod
+    def get_session(client_id, env):
+        """Return a session as parse_client would from the environment of
+        an ESTABLISHED notification, or None if it is incomplete."""
+        try:
+            remote_ip = ip_address(env.get('trusted_ip') or env['trusted_ip6'])
+            connected_since = get_date(env['time_unix'], uts=True)
+            common_name = env['common_name']
+        except (KeyError, ValueError) as e:
+            logger.debug('Discarding client %s with incomplete environment: %s', client_id, e)
+            return None
+        if isinstance(remote_ip, IPv6Address) and remote_ip.ipv4_mapped is not None:
+            remote_ip = remote_ip.ipv4_mapped
+        local_ip = env.get('ifconfig_pool_remote_ip6') or env.get('ifconfig_pool_remote_ip')
+        port = env.get('trusted_port')
+        return {'remote_ip': remote_ip,
+                'port': int(port) if port and port.isdigit() else '',
+                'local_ip': ip_address(local_ip) if local_ip else '',
+                'bytes_recv': 0,
+                'bytes_sent': 0,
+                'connected_since': connected_since,
+                'common_name': common_name,
+                'username': env.get('username') or common_name,
+                'client_id': client_id,
+                'peer_id': env.get('peer_id', '')}
+
+
+class ByteCounts(object):
+    """Live byte counters of each client and VPN, from the >BYTECOUNT_CLI:
+    (server mode) and >BYTECOUNT: (client mode) notifications OpenVPN sends
+    every interval seconds after 'bytecount N'.
+
+    Bits per second are worked out from consecutive notifications of the
+    same counter, so they are as fresh as the interval however long a
+    status dump takes. A counter that goes backwards has no rate until its
+    next notification.
+    """
+
+    def __init__(self):
+        self.interval = 0
+        # vpn key => {client id, or None for the VPN => (time, bytes_in, bytes_out, bps_in, bps_out)}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def handler(self, key):
+        def notify(line):
+            self.notify(key, line, time.time())
+        return notify
+
+    def notify(self, key, line, ts):
+        if line.startswith('>BYTECOUNT_CLI:'):
+            parts = line[len('>BYTECOUNT_CLI:'):].split(',')
+            counter = parts.pop(0)
+        elif line.startswith('>BYTECOUNT:'):
+            parts = line[len('>BYTECOUNT:'):].split(',')
+            counter = None
+        else:
+            logger.debug('Discarding notification: %s', line)
+            return
+        try:
+            bytes_in, bytes_out = int(parts[0]), int(parts[1])
+        except (IndexError, ValueError):
+            logger.debug('Discarding malformed notification: %s', line)
+            return
+        with self.lock:
+            counters = self.counters.setdefault(key, {})
+            prev = counters.get(counter)
+            bps_in = bps_out = None
+            if prev is not None and ts > prev[0] and \
+                    bytes_in >= prev[1] and bytes_out >= prev[2]:
+                bps_in = int((bytes_in - prev[1]) * 8 / (ts - prev[0]))
+                bps_out = int((bytes_out - prev[2]) * 8 / (ts - prev[0]))
+            counters[counter] = (ts, bytes_in, bytes_out, bps_in, bps_out)
+
+    def get_rates(self, key, now):
+        """Return {counter: (bps_in, bps_out)} of the counters of a VPN
+        updated in the last two intervals, forgetting older ones."""
+        max_age = 2 * self.interval + 1
+        with self.lock:
+            counters = self.counters.get(key, {})
+            for counter in [c for c, v in counters.items() if now - v[0] > max_age]:
+                del counters[counter]
+            return dict((c, v[3:]) for c, v in counters.items() if v[3] is not None)
+
+    def apply(self, key, vpn, digest):
+        """Replace the rates of the VPN's sessions, and its current
+        throughput, with live ones where there are any, adding them to the
+        digest of the VPN's data."""
+        if self.interval <= 0:
+            return
+        rates = self.get_rates(key, time.time())
+        if not rates:
+            return
+        sessions = [session for session in vpn['sessions'].values() if 'bytes_recv' in session]
+        live = 0
+        for session in sessions:
+            rate = rates.get(session.get('client_id'))
+            if rate is None:
+                continue
+            session['bps_recv'], session['bps_sent'] = rate
+            digest.update('live {0:d},{1:d}\n'.format(*rate).encode('utf-8'))
+            live += 1
+        if None in rates:
+            total = rates[None]
+        elif sessions and live == len(sessions):
+            total = (sum(session['bps_recv'] for session in sessions),
+                     sum(session['bps_sent'] for session in sessions))
+        else:
+            # not every client has a live rate yet
+            return
+        if vpn['throughput'] is not None:
+            vpn['throughput'] = dict(vpn['throughput'], bps_in=total[0], bps_out=total[1])
+
+
+bytecounts = ByteCounts()
+
+
+class MgmtConnectionPool(object):
+    """Process-wide set of management connections, one per configured VPN.
+
+    With byte count notifications enabled a listener thread reads idle
+    connections as notifications arrive, so each is timed when sent rather
+    than when the connection is next used. With event-driven collection it
+    keeps client notifications from piling up between collections.
+    """
+
+    def __init__(self):
+        self.persistent = True
+        self.bytecount_interval = 0
+        self.event_driven = False
+        self.reconcile_interval = 300
+        self.connect_timeout = MgmtConnection.connect_timeout
+        self.command_timeout = MgmtConnection.command_timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def get(self, key, vpn):
+        address = MgmtConnection.get_address(vpn)
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None or conn.address != address:
+                conn = MgmtConnection(vpn, bytecounts.handler(key))
+                self.connections[key] = conn
+            conn.password = vpn.get('password')
+            conn.connect_timeout = self.connect_timeout
+            conn.command_timeout = self.command_timeout
+            if conn.events is not None:
+                conn.events.reconcile_interval = self.reconcile_interval
+            return conn
+
+    @contextmanager
+    def connection(self, key, vpn, deadline=None):
+        """Yield a healthy connection for vpn, reconnecting if the old one
+        has gone away. Nothing done with it may take past deadline."""
+        conn = self.get(key, vpn)
+        with conn.lock:
+            conn.deadline = deadline
+            try:
+                if conn.is_alive():
+                    conn.reused = True
+                else:
+                    conn.close(quit=False)
+                    conn.connect()
+                try:
+                    if conn.bytecount != self.bytecount_interval:
+                        conn.set_bytecount(self.bytecount_interval)
+                    if conn.event_driven != self.event_driven:
+                        conn.set_event_driven(self.event_driven, self.reconcile_interval)
+                    yield conn
+                except Exception:
+                    conn.close(quit=False)
+                    raise
+                if not self.persistent:
+                    conn.close()
+            finally:
+                conn.deadline = None
+
+    def set_bytecount_interval(self, interval):
+        """Set the byte count notification interval of every connection,
+        applied as each is next used. Notifications need connections that
+        stay open, so the interval is 0 unless connections are persistent."""
+        self.bytecount_interval = interval if self.persistent else 0
+        bytecounts.interval = self.bytecount_interval
+        if self.bytecount_interval > 0:
+            self.start_listener()
+
+    def set_event_driven(self, enabled, reconcile_interval):
+        """Collect sessions from client notifications, with a full dump
+        every reconcile_interval seconds, see ClientEvents. As for byte
+        counts, connections must stay open."""
+        self.event_driven = enabled and self.persistent
+        self.reconcile_interval = reconcile_interval
+        if self.event_driven:
+            self.start_listener()
+
+    @property
+    def listening(self):
+        return self.bytecount_interval > 0 or self.event_driven
+
+    def start_listener(self):
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(target=self.listen, name='notifications')
+                self.listener.daemon = True
+                self.listener.start()
+
+    def listen(self):
+        while self.listening:
+            with self.lock:
+                conns = list(self.connections.values())
+            sockets = dict((conn.s, conn) for conn in conns if conn.s is not None)
+            if not sockets:
+                time.sleep(1)
+                continue
+            try:
+                readable, _, _ = select.select(list(sockets), [], [], 1)
+            except (socket.error, ValueError):
+                # closed by another thread since the list was made
+                continue
+            busy = False
+            for s in readable:
+                conn = sockets[s]
+                if not conn.lock.acquire(False):
+                    # in use, its notifications are handled with the response
+                    busy = True
+                    continue
+                try:
+                    if conn.s is not s:
+                        continue
+                    if conn.is_alive():
+                        conn.reader.drain()
+                    else:
+                        conn.close(quit=False)
+                finally:
+                    conn.lock.release()
+            if busy:
+                time.sleep(0.1)
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for conn in connections:
+            with conn.lock:
+                conn.close()
+
+
+connections = MgmtConnectionPool()
+atexit.register(connections.close_all)
+
+
+class GeoipCache(object):
+    """Bounded LRU cache of GeoIP lookup results, expiring after ttl seconds.
+
+    Addresses missing from the database are cached as an empty result so
+    they are not looked up again on every collection either.
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ip, lookup):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(ip, None)
+            if entry is not None and entry[0] > now:
+                # re-inserting moves the entry to the most recently used end
+                self.entries[ip] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        location = lookup(ip)
+        with self.lock:
+            self.entries[ip] = (now + self.ttl, location)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return location
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return self.hits, self.misses, len(self.entries)
+
+
+class GeoipDatabase(object):
+    """Process-wide GeoIP reader, reopened when the database file changes.
+
+    The database is memory mapped rather than read into memory, and is
+    swapped for a new reader when its file is replaced (e.g. by
+    geoipupdate). Callers keep the reader they were given, so lookups in
+    progress are unaffected by a swap.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.signature = None
         self.gi = None
+        self.version = None
+        self.open_lock = threading.Lock()
+        # legacy GeoIP handles are not safe to share between threads
+        self.lock = threading.Lock()
+        self.cache = GeoipCache()
+
+    @staticmethod
+    def get_signature(path):
         try:
-            if geoip_data.endswith('.mmdb') and geoip2_available:
-                self.gi = database.Reader(geoip_data)
-                self.geoip_version = 2
-            elif geoip_data.endswith('.dat') and geoip1_available:
-                self.gi = geoip1.open(geoip_data, geoip1.GEOIP_STANDARD)
-                self.geoip_version = 1
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_ino, st.st_size)
+
+    def get(self, path):
+        signature = self.get_signature(path)
+        with self.open_lock:
+            if path != self.path or signature != self.signature:
+                if self.path is not None:
+                    logger.info('GeoIP data changed, reopening: %s', path)
+                self.gi, self.version = self.open(path)
+                self.path = path
+                self.signature = signature
+                self.cache.clear()
+            return self.gi, self.version
+
+    @staticmethod
+    def open(path):
+        try:
+            if path.endswith('.mmdb') and geoip2_available:
+                return database.Reader(path, mode=database.MODE_MMAP), 2
+            elif path.endswith('.dat') and geoip1_available:
+                return geoip1.open(path, geoip1.GEOIP_MMAP_CACHE), 1
             else:
                 logger.warning('No compatible geoip1 or geoip2 data/libraries found.')
         except IOError:
             logger.warning('No compatible geoip1 or geoip2 data/libraries found.')
+        return None, None
 
-        for key, vpn in list(self.vpns.items()):
-            self._socket_connect(vpn)
-            if vpn['socket_connected']:
-                self.collect_data(vpn)
-                self._socket_disconnect()
-
-    def collect_data(self, vpn):
-        ver = self.send_command('version\n')
-        vpn['release'] = self.parse_version(ver)
-        vpn['version'] = semver(vpn['release'].split(' ')[1])
-        state = self.send_command('state\n')
-        vpn['state'] = self.parse_state(state)
-        stats = self.send_command('load-stats\n')
-        vpn['stats'] = self.parse_stats(stats)
-        status = self.send_command('status 3\n')
-        vpn['sessions'] = self.parse_status(status, vpn['version'])
 
-    def _socket_send(self, command):
-        if sys.version_info[0] == 2:
-            self.s.send(command)
-        else:
-            self.s.send(bytes(command, 'utf-8'))
+geoip = GeoipDatabase()
 
-    def _socket_recv(self, length):
-        if sys.version_info[0] == 2:
-            return self.s.recv(length)
+
+class StatsRing(object):
+    """Fixed-size ring buffer of load-stats samples.
+
+    Samples are kept in parallel arrays of doubles, so memory use is
+    bounded by size however long the VPN has been up.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.nclients = array('d', [0.0]) * size
+        self.bytesin = array('d', [0.0]) * size
+        self.bytesout = array('d', [0.0]) * size
+        self.start = 0  # index of the oldest sample
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def index(self, n):
+        """Index of the nth oldest sample, or counting from the newest if n is negative."""
+        if n < 0:
+            n += self.count
+        return (self.start + n) % self.size
+
+    def append(self, ts, nclients, bytesin, bytesout):
+        i = self.index(self.count)
+        self.times[i] = ts
+        self.nclients[i] = nclients
+        self.bytesin[i] = bytesin
+        self.bytesout[i] = bytesout
+        if self.count < self.size:
+            self.count += 1
         else:
-            return self.s.recv(length).decode('utf-8')
+            self.start = (self.start + 1) % self.size
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def bps(self, first, last):
+        """Bits per second in and out between two samples."""
+        elapsed = self.times[last] - self.times[first]
+        if elapsed <= 0:
+            return 0, 0
+        return (int((self.bytesin[last] - self.bytesin[first]) * 8 / elapsed),
+                int((self.bytesout[last] - self.bytesout[first]) * 8 / elapsed))
+
+    def get_throughput(self):
+        if self.count < 2:
+            return None
+        first = self.index(0)
+        last = self.index(-1)
+        bps_in, bps_out = self.bps(self.index(-2), last)
+        avg_bps_in, avg_bps_out = self.bps(first, last)
+        clients = sum(self.nclients[self.index(n)] for n in range(self.count))
+        return {'bps_in': bps_in,
+                'bps_out': bps_out,
+                'avg_bps_in': avg_bps_in,
+                'avg_bps_out': avg_bps_out,
+                'clients_avg': round(clients / self.count, 1),
+                'clients_change': int(self.nclients[last] - self.nclients[first]),
+                'samples': self.count}
+
+
+class ThroughputHistory(object):
+    """Recent load-stats samples of each VPN, up to samples per VPN, from
+    which current and average throughput and the trend in the number of
+    clients are worked out.
+    """
+
+    def __init__(self, samples=60):
+        self.samples = samples
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, ts, stats):
+        with self.lock:
+            ring = self.rings.get(key)
+            if ring is None or ring.size != self.samples:
+                ring = self.rings[key] = StatsRing(self.samples)
+            elif ring and (stats['bytesin'] < ring.bytesin[ring.index(-1)] or
+                           stats['bytesout'] < ring.bytesout[ring.index(-1)]):
+                # counters start again from zero when OpenVPN restarts
+                ring.clear()
+            ring.append(ts, stats['nclients'], stats['bytesin'], stats['bytesout'])
+            return ring.get_throughput()
+
+
+throughput = ThroughputHistory()
+
+
+class SessionRates(object):
+    """Works out the bits per second received from and sent to each client
+    from the change in its byte counters since the previous collection.
+
+    Sessions are matched with the previous collection by client_id, or by
+    remote address and port before OpenVPN 2.4. A match only counts if it
+    connected at the same time and its counters have not gone backwards,
+    so a client that reconnects, or any client after OpenVPN restarts, has
+    no rate until the next collection.
+    """
+
+    def __init__(self):
+        # vpn key => (time, {session key => (connected_since, bytes_recv, bytes_sent)})
+        self.previous = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(session):
+        if 'client_id' in session:
+            return session['client_id']
+        return (session['remote_ip'], session['port'])
+
+    def skip(self, key, sessions):
+        """Leave sessions whose counters were not collected from a full
+        status without a rate, as with event-driven collection they may be
+        as old as the last full status. The previous counters are forgotten
+        too, so that the next full status is not compared with them."""
+        for session in sessions.values():
+            if 'bytes_recv' in session:
+                session['bps_recv'] = None
+                session['bps_sent'] = None
+        with self.lock:
+            self.previous.pop(key, None)
+
+    def update(self, key, ts, sessions, digest):
+        """Set bps_recv and bps_sent on each server session, adding them to
+        the digest of the VPN's data.
+        """
+        with self.lock:
+            last_ts, last = self.previous.get(key, (ts, {}))
+        elapsed = ts - last_ts
+        index = {}
+        rated = 0
+        for session in sessions.values():
+            if 'bytes_recv' not in session:
+                # client mode
+                continue
+            sample = (session['connected_since'], session['bytes_recv'], session['bytes_sent'])
+            session_key = self.get_key(session)
+            index[session_key] = sample
+            prev = last.get(session_key)
+            if prev is None or elapsed <= 0 or prev[0] != sample[0] or \
+                    sample[1] < prev[1] or sample[2] < prev[2]:
+                session['bps_recv'] = None
+                session['bps_sent'] = None
+                continue
+            session['bps_recv'] = int((sample[1] - prev[1]) * 8 / elapsed)
+            session['bps_sent'] = int((sample[2] - prev[2]) * 8 / elapsed)
+            digest.update('{0:d},{1:d}\n'.format(session['bps_recv'],
+                                                 session['bps_sent']).encode('utf-8'))
+            rated += 1
+        digest.update('rated {0:d}\n'.format(rated).encode('utf-8'))
+        with self.lock:
+            self.previous[key] = (ts, index)
+
+
+session_rates = SessionRates()
+
+
+class LastGood(object):
+    """The data last collected from each VPN, with the time it was
+    collected, for rendering in place of a VPN that runs out of time."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def set(self, key, collected, data):
+        with self.lock:
+            self.data[key] = (collected, data)
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def get_stale(self, key, error):
+        """Return the last data of a VPN marked as stale since it was
+        collected, or None if nothing has been collected from it."""
+        last = self.get(key)
+        if last is None:
+            return None
+        collected, data = last
+        return dict(data, stale_since=collected, error=error)
+
+
+last_good = LastGood()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0  # consecutive
+        self.error = None
+        self.backoff = 0
+        self.retry_at = None  # time.time() of the next probe while open
+        self.timer = None
 
-    def _socket_connect(self, vpn):
-        timeout = 3
-        self.s = False
+    def get_info(self):
+        retry_at = datetime.fromtimestamp(self.retry_at) if self.retry_at else None
+        return {'state': self.state, 'failures': self.failures,
+                'error': self.error, 'retry_at': retry_at}
+
+
+class CircuitBreakers(object):
+    """Failure state of each VPN's management interface.
+
+    After threshold consecutive failures a VPN's breaker opens, and
+    collections show its last good data as stale, or else the VPN as
+    unavailable with its last error, straight away instead of waiting to
+    fail again. Meanwhile it is probed in the
+    background, after a backoff that doubles with each failed probe up to
+    max_backoff, less a random jitter of up to half so VPNs that went down
+    together are not probed together. The breaker closes once a probe
+    connects.
+    """
+
+    def __init__(self):
+        self.threshold = 3
+        self.backoff = 5
+        self.max_backoff = 300
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
         try:
-            if 'socket' in vpn:
-                self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.s.connect(vpn['socket'])
+            self.threshold = int(settings.get('breaker_threshold', 3))
+        except ValueError:
+            logger.warning('CONFIG: invalid breaker_threshold %s', settings['breaker_threshold'])
+        self.backoff = max(1, get_seconds(settings, 'breaker_backoff', 5))
+        self.max_backoff = max(self.backoff, get_seconds(settings, 'breaker_max_backoff', 300))
+
+    def get_info(self, key):
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                return CircuitBreaker().get_info()
+            return breaker.get_info()
+
+    def success(self, key):
+        with self.lock:
+            breaker = self.breakers.pop(key, None)
+        if breaker is not None and breaker.timer is not None:
+            breaker.timer.cancel()
+
+    def failure(self, key, vpn, error):
+        with self.lock:
+            breaker = self.breakers.setdefault(key, CircuitBreaker())
+            breaker.failures += 1
+            breaker.error = error
+            if breaker.state == 'closed':
+                if self.threshold <= 0 or breaker.failures < self.threshold:
+                    return
+                logger.warning('%s failed %d times, retrying in the background', key, breaker.failures)
+                breaker.backoff = self.backoff
             else:
-                host = vpn['host']
-                port = int(vpn['port'])
-                self.s = socket.create_connection((host, port), timeout)
-            if self.s:
-                vpn['socket_connected'] = True
-        except socket.timeout as e:
-            vpn['error'] = '{0!s}'.format(e)
-            logger.warning('socket timeout: %s', e)
-            vpn['socket_connected'] = False
-            if self.s:
-                self.s.shutdown(socket.SHUT_RDWR)
-                self.s.close()
-        except socket.error as e:
-            vpn['error'] = '{0!s}'.format(e.strerror)
-            logger.warning('socket error: %s', e)
-            vpn['socket_connected'] = False
+                breaker.backoff = min(self.max_backoff, breaker.backoff * 2)
+            delay = breaker.backoff * random.uniform(0.5, 1)
+            breaker.state = 'open'
+            breaker.retry_at = time.time() + delay
+            breaker.timer = threading.Timer(delay, self.probe, (key, vpn))
+            breaker.timer.daemon = True
+            breaker.timer.start()
+
+    def probe(self, key, vpn):
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None or breaker.state != 'open':
+                return
+            breaker.state = 'half-open'
+            breaker.retry_at = None
+        try:
+            # a persistent connection is then reused by the next collection
+            with connections.connection(key, vpn, time.monotonic() + connections.connect_timeout):
+                pass
         except Exception as e:
-            vpn['error'] = '{0!s}'.format(e)
-            logger.warning('unexpected error: %s', e)
-            vpn['socket_connected'] = False
+            # anything else would leave the breaker half-open for good
+            logger.info('probe of %s failed: %s', key, e)
+            self.failure(key, vpn, socket_error_str(e))
+        else:
+            logger.info('%s is reachable again', key)
+            self.success(key)
 
-    def _socket_disconnect(self):
-        self._socket_send('quit\n')
-        self.s.shutdown(socket.SHUT_RDWR)
-        self.s.close()
+    def retain(self, keys):
+        """Forget the breakers of VPNs no longer configured."""
+        with self.lock:
+            removed = [self.breakers.pop(key) for key in list(self.breakers) if key not in keys]
+        for breaker in removed:
+            if breaker.timer is not None:
+                breaker.timer.cancel()
 
-    def send_command(self, command):
-        logger.info('Sending command: %s', command.strip())
-        self._socket_send(command)
-        data = ''
-        if command.startswith('kill') or command.startswith('client-kill'):
+
+breakers = CircuitBreakers()
+
+
+# queried once per connection, and again when the daemon restarts
+CAPABILITY_COMMANDS = ['version\n', 'help\n']
+
+
+class OpenvpnMgmtInterface(object):
+
+    def __init__(self, cfg, **kwargs):
+        self.vpns = cfg.vpns
+        connections.persistent = get_boolean(cfg.settings, 'persistent_connections', True)
+        try:
+            connections.set_bytecount_interval(max(0, int(cfg.settings.get('bytecount_interval', 0))))
+        except ValueError:
+            logger.warning('CONFIG: invalid bytecount_interval %s', cfg.settings['bytecount_interval'])
+        connections.set_event_driven(get_boolean(cfg.settings, 'event_driven', False),
+                                     get_seconds(cfg.settings, 'reconcile_interval', 300))
+        connections.connect_timeout = get_seconds(cfg.settings, 'connect_timeout', 3)
+        connections.command_timeout = get_seconds(cfg.settings, 'command_timeout', 10)
+        self.request_timeout = get_seconds(cfg.settings, 'request_timeout', 15)
+        breakers.configure(cfg.settings)
+
+        if 'vpn_id' in kwargs:
+            vpn = self.vpns[kwargs['vpn_id']]
+            try:
+                with connections.connection(kwargs['vpn_id'], vpn) as conn:
+                    capabilities = self.get_capabilities(conn)
+                    if 'client-kill' in capabilities['commands'] and \
+                            'port' not in kwargs:
+                        command = 'client-kill {0!s}\n'.format(kwargs['client_id'])
+                    else:
+                        command = 'kill {0!s}:{1!s}\n'.format(kwargs['ip'], kwargs['port'])
+                    conn.send_command(command)
+            except socket.error as e:
+                logger.warning('socket error: %s', e)
+
+        self.gi, self.geoip_version = geoip.get(cfg.settings['geoip_data'])
+        self.gi_lock = geoip.lock
+        self.geoip_cache = geoip.cache
+        try:
+            self.geoip_cache.size = int(cfg.settings.get('geoip_cache_size', 10000))
+            self.geoip_cache.ttl = float(cfg.settings.get('geoip_cache_ttl', 3600))
+        except ValueError:
+            logger.warning('CONFIG: invalid geoip_cache_size or geoip_cache_ttl')
+        try:
+            throughput.samples = max(2, int(cfg.settings.get('stats_samples', 60)))
+        except ValueError:
+            logger.warning('CONFIG: invalid stats_samples %s', cfg.settings['stats_samples'])
+
+        self.collect_all(cfg.settings.get('concurrency', 10))
+        self.collected = datetime.now()
+        logger.debug('GeoIP cache: %d hits, %d misses, %d entries', *self.geoip_cache.get_stats())
+
+    def collect_all(self, concurrency):
+        items = list(self.vpns.items())
+        if not items:
             return
-        while 1:
-            socket_data = self._socket_recv(1024)
-            socket_data = re.sub('>INFO(.)*\r\n', '', socket_data)
-            data += socket_data
-            if command == 'load-stats\n' and data != '':
-                break
-            elif data.endswith("\nEND\r\n"):
-                break
-        logger.debug("=== begin raw data\n%s\n=== end raw data", data)
+        try:
+            max_workers = max(1, min(int(concurrency), len(items)))
+        except (TypeError, ValueError):
+            logger.warning('CONFIG: invalid concurrency %s, using 1', concurrency)
+            max_workers = 1
+        keys = [key for key, vpn in items]
+        vpns = [vpn for key, vpn in items]
+        breakers.retain(keys)
+        # VPNs still waiting for a worker at the deadline fail straight away
+        deadlines = [time.monotonic() + self.request_timeout] * len(items)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(self.collect_vpn, keys, vpns, deadlines)
+            # merge in the main thread so each vpn dict has a single writer
+            for vpn, data in zip(vpns, results):
+                vpn.update(data)
+
+    def collect_vpn(self, key, vpn, deadline=None):
+        breaker = breakers.get_info(key)
+        if breaker['state'] != 'closed':
+            # known to be unreachable, the breaker probes it meanwhile
+            data = last_good.get_stale(key, breaker['error'])
+            if data is None:
+                return {'socket_connected': False, 'error': breaker['error'], 'breaker': breaker}
+            data['breaker'] = breaker
+            return data
+        data = self.poll_vpn(key, vpn, deadline)
+        if 'error' in data:
+            breakers.failure(key, vpn, data['error'])
+        else:
+            breakers.success(key)
+        data['breaker'] = breakers.get_info(key)
         return data
 
+    def poll_vpn(self, key, vpn, deadline=None):
+        data = {}
+        for attempt in range(2):
+            conn = None
+            try:
+                with connections.connection(key, vpn, deadline) as conn:
+                    self.collect_data(conn, data)
+                sampled = data.pop('stats_time')
+                data['throughput'] = throughput.add(key, sampled, data['stats'])
+                if data.pop('dumped'):
+                    session_rates.update(key, sampled, data['sessions'], data['digest'])
+                else:
+                    session_rates.skip(key, data['sessions'])
+                bytecounts.apply(key, data, data['digest'])
+                data['digest'] = data['digest'].hexdigest()
+                data['socket_connected'] = True
+                last_good.set(key, datetime.now(), data)
+                return data
+            except socket.timeout as e:
+                logger.warning('socket timeout: %s', e)
+                stale = last_good.get_stale(key, socket_error_str(e))
+                if stale is not None:
+                    # render the last good data rather than nothing
+                    return stale
+                data['socket_connected'] = False
+                data['error'] = socket_error_str(e)
+                return data
+            except socket.error as e:
+                # a reused connection may have died since its health check, retry once
+                if attempt == 0 and conn is not None and conn.reused:
+                    logger.info('reconnecting to %s: %s', key, e)
+                    continue
+                logger.warning('socket error: %s', e)
+                data['socket_connected'] = False
+                data['error'] = socket_error_str(e)
+                return data
+
+    def collect_data(self, conn, vpn):
+        # digest of everything collected, so a VPN panel is only rendered
+        # again when its data has changed
+        digest = hashlib.sha1()
+        events = conn.events
+        dump = events is None or events.due
+        # pipelined, as on a distant interface the round trips cost more
+        # than the commands
+        commands = ['state\n', 'load-stats\n']
+        if dump:
+            commands.append('status 3\n')
+            if events is not None:
+                events.start_dump()
+        if conn.capabilities is None:
+            commands = CAPABILITY_COMMANDS + commands
+        responses = conn.iter_batch(commands)
+        if conn.capabilities is None:
+            conn.capabilities = self.parse_capabilities(*[conn.get_data(next(responses))
+                                                          for _ in CAPABILITY_COMMANDS])
+        state = conn.get_data(next(responses))
+        vpn['state'] = self.parse_state(state)
+        stats = conn.get_data(next(responses))
+        vpn['stats'] = self.parse_stats(stats)
+        vpn['stats_time'] = time.time()
+        for data in (state, stats):
+            digest.update(data.encode('utf-8'))
+        vpn['dumped'] = dump
+        if dump:
+            status = self.digest_status(next(responses), digest)
+            vpn['sessions'] = self.parse_status(status)
+            if events is not None:
+                events.reconcile(vpn['sessions'])
+        else:
+            digest.update('events {0!r}\n'.format(events.changed).encode('utf-8'))
+            vpn['sessions'] = self.get_event_sessions(events)
+        capabilities = self.get_capabilities(conn, vpn['state'].get('up_since'))
+        vpn['release'] = capabilities['release']
+        vpn['version'] = capabilities['version']
+        digest.update(vpn['release'].encode('utf-8'))
+        # finished once session rates have been added
+        vpn['digest'] = digest
+
+    def get_event_sessions(self, events):
+        """Return copies of the sessions kept up to date by events, keyed
+        as by parse_status."""
+        sessions = OrderedDict()
+        for session in events.sessions.values():
+            if 'location' not in session:
+                self.locate(session)
+            session = dict(session)
+            sessions[str(session['local_ip'])] = session
+        return sessions
+
+    def get_capabilities(self, conn, up_since=None):
+        """Return the capabilities of the daemon on conn, cached until the
+        connection is lost or the daemon restarts, when up_since (from
+        its current state) changes."""
+        capabilities = conn.capabilities
+        if capabilities is not None and up_since is not None and \
+                capabilities['up_since'] not in (None, up_since):
+            logger.info('%s restarted, querying its capabilities again', conn.address)
+            capabilities = None
+        if capabilities is None:
+            capabilities = self.parse_capabilities(*conn.send_batch(CAPABILITY_COMMANDS))
+        if capabilities['up_since'] is None:
+            capabilities['up_since'] = up_since
+        conn.capabilities = capabilities
+        return capabilities
+
+    def parse_capabilities(self, ver, help_data):
+        release = self.parse_version(ver)
+        capabilities = {'release': release,
+                        'version': semver(release.split(' ')[1]),
+                        'management_version': None,
+                        'commands': set(),
+                        'up_since': None}
+        for line in ver.splitlines():
+            if line.startswith('Management Version:'):
+                try:
+                    capabilities['management_version'] = int(line.split(':', 1)[1])
+                except ValueError:
+                    pass
+        # help lists one command per line as 'name [args] : description'
+        for line in help_data.splitlines():
+            if ' : ' in line and not line[:1].isspace():
+                capabilities['commands'].add(line.split(None, 1)[0])
+        return capabilities
+
+    @staticmethod
+    def digest_status(lines, digest):
+        for line in lines:
+            # the time the status was generated changes on every call
+            if not line.startswith('TIME'):
+                digest.update(line.encode('utf-8'))
+            yield line
+
     @staticmethod
     def parse_state(data):
         state = {}
@@ -293,138 +1409,165 @@ class OpenvpnMgmtInterface(object):
         stats['bytesout'] = int(re.sub('bytesout=', '', parts[2]).replace('\r\n', ''))
         return stats
 
-    def parse_status(self, data, version):
-        gi = self.gi
-        geoip_version = self.geoip_version
-        client_section = False
-        routes_section = False
+    def parse_status(self, lines):
         sessions = {}
-        client_session = {}
-
-        for line in data.splitlines():
-            parts = deque(line.split('\t'))
-            logger.debug("=== begin split line\n%s\n=== end split line", parts)
+        for key, session in self.iter_status(lines):
+            sessions[key] = session
 
-            if parts[0].startswith('END'):
-                break
-            if parts[0].startswith('TITLE') or \
-               parts[0].startswith('GLOBAL') or \
-               parts[0].startswith('TIME'):
-                continue
-            if parts[0] == 'HEADER':
-                if parts[1] == 'CLIENT_LIST':
-                    client_section = True
-                    routes_section = False
-                if parts[1] == 'ROUTING_TABLE':
-                    client_section = False
-                    routes_section = True
-                continue
-
-            if parts[0].startswith('TUN') or \
-               parts[0].startswith('TCP') or \
-               parts[0].startswith('Auth'):
-                parts = parts[0].split(',')
-            if parts[0] == 'TUN/TAP read bytes':
-                client_session['tuntap_read'] = int(parts[1])
-                continue
-            if parts[0] == 'TUN/TAP write bytes':
-                client_session['tuntap_write'] = int(parts[1])
-                continue
-            if parts[0] == 'TCP/UDP read bytes':
-                client_session['tcpudp_read'] = int(parts[1])
-                continue
-            if parts[0] == 'TCP/UDP write bytes':
-                client_session['tcpudp_write'] = int(parts[1])
-                continue
-            if parts[0] == 'Auth read bytes':
-                client_session['auth_read'] = int(parts[1])
-                sessions['Client'] = client_session
-                continue
-
-            if client_section:
-                session = {}
-                parts.popleft()
-                common_name = parts.popleft()
-                remote_str = parts.popleft()
-                if remote_str.count(':') == 1:
-                    remote, port = remote_str.split(':')
-                elif '(' in remote_str:
-                    remote, port = remote_str.split('(')
-                    port = port[:-1]
-                else:
-                    remote = remote_str
-                    port = None
-                remote_ip = ip_address(remote)
-                if isinstance(remote_ip, IPv6Address) and \
-                        remote_ip.ipv4_mapped is not None:
-                    session['remote_ip'] = remote_ip.ipv4_mapped
-                else:
-                    session['remote_ip'] = remote_ip
-                if port:
-                    session['port'] = int(port)
-                else:
-                    session['port'] = ''
-                if session['remote_ip'].is_private:
-                    session['location'] = 'RFC1918'
-                else:
-                    try:
-                        if geoip_version == 1:
-                            gir = gi.record_by_addr(str(session['remote_ip']))
-                            session['location'] = gir['country_code']
-                            session['region'] = get_str(gir['region'])
-                            session['city'] = get_str(gir['city'])
-                            session['country'] = gir['country_name']
-                            session['longitude'] = gir['longitude']
-                            session['latitude'] = gir['latitude']
-                        elif geoip_version == 2:
-                            gir = gi.city(str(session['remote_ip']))
-                            session['location'] = gir.country.iso_code
-                            session['region'] = gir.subdivisions.most_specific.iso_code
-                            session['city'] = gir.city.name
-                            session['country'] = gir.country.name
-                            session['longitude'] = gir.location.longitude
-                            session['latitude'] = gir.location.latitude
-                    except AddressNotFoundError:
-                        pass
-                    except SystemError:
-                        pass
-                local_ipv4 = parts.popleft()
-                if local_ipv4:
-                    session['local_ip'] = ip_address(local_ipv4)
-                else:
-                    session['local_ip'] = ''
-                if version.major == 2 and version.minor >= 4:
-                    local_ipv6 = parts.popleft()
-                    if local_ipv6:
-                        session['local_ip'] = ip_address(local_ipv6)
-                session['bytes_recv'] = int(parts.popleft())
-                session['bytes_sent'] = int(parts.popleft())
-                parts.popleft()
-                session['connected_since'] = get_date(parts.popleft(), uts=True)
-                username = parts.popleft()
-                if username != 'UNDEF':
-                    session['username'] = username
-                else:
-                    session['username'] = common_name
-                if version.major == 2 and version.minor >= 4:
-                    session['client_id'] = parts.popleft()
-                    session['peer_id'] = parts.popleft()
-                sessions[str(session['local_ip'])] = session
-
-            if routes_section:
-                local_ip = parts[1]
-                last_seen = parts[5]
-                if local_ip in sessions:
-                    sessions[local_ip]['last_seen'] = get_date(last_seen, uts=True)
-
-        if sessions:
+        if sessions and logger.isEnabledFor(logging.DEBUG):
             pretty_sessions = pformat(sessions)
             logger.debug("=== begin sessions\n%s\n=== end sessions", pretty_sessions)
-        else:
+        elif not sessions:
             logger.debug("no sessions")
 
         return sessions
 
+    def iter_status(self, lines):
+        """Yield (key, session) pairs from status 3 output as lines arrive.
+
+        Client list columns are located from the HEADER line, so the same
+        code handles the 2.3 and 2.4+ layouts. last_seen comes from the
+        routing table, which follows the client list, so it is filled in
+        on sessions that have already been yielded.
+        """
+        client_columns = None
+        route_columns = None
+        sessions = {}
+        client_session = {}
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        for line in lines:
+            if debug:
+                logger.debug("=== begin line\n%s\n=== end line", line)
+
+            if line.startswith('CLIENT_LIST\t'):
+                if client_columns is None:
+                    continue
+                session = self.parse_client(line.split('\t'), client_columns)
+                key = str(session['local_ip'])
+                sessions[key] = session
+                yield key, session
+            elif line.startswith('ROUTING_TABLE\t'):
+                if route_columns is None:
+                    continue
+                parts = line.split('\t')
+                session = sessions.get(parts[route_columns[0]])
+                if session is not None:
+                    session['last_seen'] = get_date(parts[route_columns[1]], uts=True)
+            elif line.startswith('HEADER\t'):
+                # drop 'HEADER' so column numbers match the data rows
+                header = line.split('\t')[1:]
+                if header[0] == 'CLIENT_LIST':
+                    client_columns = self.get_client_columns(header)
+                elif header[0] == 'ROUTING_TABLE':
+                    route_columns = (header.index('Virtual Address'),
+                                     header.index('Last Ref (time_t)'))
+            elif ',' in line:
+                # client mode statistics
+                name, _, value = line.partition(',')
+                key = client_stats.get(name)
+                if key:
+                    client_session[key] = int(value)
+                    if key == 'auth_read':
+                        yield 'Client', client_session
+
+    @staticmethod
+    def get_client_columns(header):
+        def column(name):
+            return header.index(name) if name in header else None
+        return (column('Common Name'), column('Real Address'),
+                column('Virtual Address'), column('Virtual IPv6 Address'),
+                column('Bytes Received'), column('Bytes Sent'),
+                column('Connected Since (time_t)'), column('Username'),
+                column('Client ID'), column('Peer ID'))
+
+    def parse_client(self, parts, columns):
+        (common_name_col, remote_col, local_ipv4_col, local_ipv6_col,
+         bytes_recv_col, bytes_sent_col, connected_since_col, username_col,
+         client_id_col, peer_id_col) = columns
+        session = {}
+        common_name = parts[common_name_col]
+        remote_str = parts[remote_col]
+        if remote_str.count(':') == 1:
+            remote, port = remote_str.split(':')
+        elif '(' in remote_str:
+            remote, port = remote_str.split('(')
+            port = port[:-1]
+        else:
+            remote = remote_str
+            port = None
+        remote_ip = ip_address(remote)
+        if isinstance(remote_ip, IPv6Address) and \
+                remote_ip.ipv4_mapped is not None:
+            session['remote_ip'] = remote_ip.ipv4_mapped
+        else:
+            session['remote_ip'] = remote_ip
+        if port:
+            session['port'] = int(port)
+        else:
+            session['port'] = ''
+        self.locate(session)
+        local_ipv4 = parts[local_ipv4_col]
+        if local_ipv4:
+            session['local_ip'] = ip_address(local_ipv4)
+        else:
+            session['local_ip'] = ''
+        if local_ipv6_col is not None:
+            local_ipv6 = parts[local_ipv6_col]
+            if local_ipv6:
+                session['local_ip'] = ip_address(local_ipv6)
+        session['bytes_recv'] = int(parts[bytes_recv_col])
+        session['bytes_sent'] = int(parts[bytes_sent_col])
+        session['connected_since'] = get_date(parts[connected_since_col], uts=True)
+        session['common_name'] = common_name
+        username = parts[username_col]
+        if username != 'UNDEF':
+            session['username'] = username
+        else:
+            session['username'] = common_name
+        if client_id_col is not None:
+            session['client_id'] = parts[client_id_col]
+            session['peer_id'] = parts[peer_id_col]
+        return session
+
+    def locate(self, session):
+        if session['remote_ip'].is_private:
+            session['location'] = 'RFC1918'
+        else:
+            self.geolocate(session)
+
+    def geolocate(self, session):
+        if self.gi is None:
+            return
+        session.update(self.geoip_cache.get(session['remote_ip'], self.geoip_lookup))
+
+    def geoip_lookup(self, ip):
+        gi = self.gi
+        location = {}
+        try:
+            if self.geoip_version == 1:
+                with self.gi_lock:
+                    gir = gi.record_by_addr(str(ip))
+                location['location'] = gir['country_code']
+                location['region'] = get_str(gir['region'])
+                location['city'] = get_str(gir['city'])
+                location['country'] = gir['country_name']
+                location['longitude'] = gir['longitude']
+                location['latitude'] = gir['latitude']
+            elif self.geoip_version == 2:
+                gir = gi.city(str(ip))
+                location['location'] = gir.country.iso_code
+                location['region'] = gir.subdivisions.most_specific.iso_code
+                location['city'] = gir.city.name
+                location['country'] = gir.country.name
+                location['longitude'] = gir.location.longitude
+                location['latitude'] = gir.location.latitude
+        except AddressNotFoundError:
+            pass
+        except SystemError:
+            pass
+        return location
+
     @staticmethod
     def parse_version(data):
         for line in data.splitlines():
@@ -432,17 +1575,372 @@ class OpenvpnMgmtInterface(object):
                 return line.replace('OpenVPN Version: ', '')
 
 
+def format_size(n):
+    return '{0!s} ({1!s})'.format(n, naturalsize(n, binary=True))
+
+
+def format_bps(bps):
+    if bps < 1000:
+        return '{0:d} bit/s'.format(bps)
+    for unit in ('kbit/s', 'Mbit/s', 'Gbit/s'):
+        bps /= 1000.0
+        if bps < 1000:
+            break
+    return '{0:.1f} {1!s}'.format(bps, unit)
+
+
+def get_timestamp(dt):
+    return int(time.mktime(dt.timetuple()))
+
+
+def get_anchor(name):
+    return name.lower().replace(' ', '_')
+
+
+# Measures sessions can be ranked by, and their titles
+TOP_METRICS = OrderedDict((
+    ('bps', 'Bits/s In + Out'),
+    ('bps_recv', 'Bits/s In'),
+    ('bps_sent', 'Bits/s Out'),
+    ('bytes', 'Bytes In + Out'),
+    ('bytes_recv', 'Bytes In'),
+    ('bytes_sent', 'Bytes Out'),
+))
+TOP_DEFAULT = 20
+TOP_MAX = 1000
+
+
+def get_top_sessions(vpns, n, metric):
+    """Return the (vpn_id, session) pairs of the n server sessions with the
+    largest metric across all VPNs, largest first.
+
+    Sessions are selected with a heap of n entries rather than by sorting
+    every session. A session without a rate yet ranks as 0.
+    """
+    if metric not in TOP_METRICS:
+        raise ValueError('unknown metric: {0!s}'.format(metric))
+    if metric in ('bps', 'bytes'):
+        fields = (metric + '_recv', metric + '_sent')
+    else:
+        fields = (metric,)
+
+    def value(item):
+        session = item[1]
+        return sum(session[field] or 0 for field in fields)
+
+    sessions = ((vpn_id, session)
+                for vpn_id, vpn in vpns.items()
+                if vpn['socket_connected'] and vpn['state']['mode'] == 'Server'
+                for session in vpn['sessions'].values())
+    return heapq.nlargest(n, sessions, key=value)
+
+
+# Everything in <head> that does not depend on the configuration, put
+# together once at startup rather than for every page
+HTML_HEAD = Markup(''.join((
+    '<meta http-equiv="refresh" content="300" />',
+    '<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha256-916EbMg70RQy9LHiGkXzG8hSg9EdNy97GazNG/aiY1w=" crossorigin="anonymous" />',          # noqa
+    '<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap-theme.min.css" integrity="sha256-ZT4HPpdCOt2lvDkXokHuhJfdOKSPFLzeAJik5U/Q+l4=" crossorigin="anonymous" />',    # noqa
+    '<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/css/theme.bootstrap.min.css" integrity="sha256-dXZ9g5NdsPlD0182JqLz9UFael+Ug5AYo63RfujWPu8=" crossorigin="anonymous" />',  # noqa
+    '<style>',
+    '.panel-custom {',
+    '   background-color:#777;',
+    '   color:#fff;',
+    '   font-size:80%;',
+    '   vertical-align:baseline;',
+    '   padding:.4em .4em .4em;',
+    '   line-height:1;',
+    '   font-weight:700;',
+    '}',
+    '</style>',
+    '<script src="//cdnjs.cloudflare.com/ajax/libs/jquery/3.3.1/jquery.min.js" integrity="sha256-FgpCb/KJQlLNfOu91ta32o/NMZxltwRo8QtmkMRdAu8=" crossorigin="anonymous"></script>',                                      # noqa
+    '<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/jquery.tablesorter.min.js" integrity="sha256-OZsQ3HIaaZel0q2QrfcMuOXZf1i4QxE+7KLA5dJ/XVY=" crossorigin="anonymous"></script>',          # noqa
+    '<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/jquery.tablesorter.widgets.min.js" integrity="sha256-+TgqgSpMfnq0gCirm/O2/SDZ3hODyRVTk/SCiRvFQ4A=" crossorigin="anonymous"></script>',  # noqa
+    '<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/parsers/parser-network.min.js" integrity="sha256-oQTnMXEL+HMou3Kn2ep3VPFg661GGqkB59Tpbo4kBMc=" crossorigin="anonymous"></script>',      # noqa
+    '<script src="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/js/bootstrap.min.js" integrity="sha256-U5ZEeKfGNOja007MMD3YBI0A3OSZOQbeG6z2f2Y0hu8=" crossorigin="anonymous"></script>',                     # noqa
+    '<script>$(document).ready(function(){',
+    # Time Online is worked out here, up to when the data was collected, so
+    # that cached VPN panels do not depend on the time of the collection
+    'function duration(s){var d=Math.floor(s/86400),h=Math.floor(s%86400/3600),m=Math.floor(s%3600/60);s%=60;',
+    'return (d?d+(d==1?" day, ":" days, "):"")+h+":"+(m<10?"0":"")+m+":"+(s<10?"0":"")+s;}',
+    '$("td.time-online").each(function(){',
+    'var collected=$(this).closest("[data-collected]").data("collected")||$("#last-update").data("collected");',
+    '$(this).text(duration(Math.max(0,collected-$(this).data("since"))));',
+    '});',
+    '$("table.tablesorter").tablesorter({theme:"bootstrap", headerTemplate:"{content} {icon}", widgets:["uitheme"]});',
+    '});</script>',
+)))
+
+HEADER_TEMPLATE = '''\
+<!doctype html>
+<html lang="en"><head>
+<meta charset="utf-8">
+<meta http-equiv="X-UA-Compatible" content="IE=edge">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{{ site }} OpenVPN Status Monitor</title>
+{{ head }}
+</head><body>
+<nav class="navbar navbar-inverse">
+<div class="container-fluid">
+<div class="navbar-header">
+<button type="button" class="navbar-toggle" data-toggle="collapse" data-target="#myNavbar">
+<span class="icon-bar"></span>
+<span class="icon-bar"></span>
+<span class="icon-bar"></span>
+</button>
+<a class="navbar-brand" href="#">{{ site }} OpenVPN Status Monitor</a>
+</div><div class="collapse navbar-collapse" id="myNavbar">
+<ul class="nav navbar-nav"><li class="dropdown">
+<a class="dropdown-toggle" data-toggle="dropdown" href="#">VPN <span class="caret"></span></a>
+<ul class="dropdown-menu">
+{% for name in names if name %}
+<li><a href="./#{{ name|anchor }}">{{ name }}</a></li>
+{% endfor %}
+</ul></li>
+<li><a href="top">Top Talkers</a></li>
+</ul>
+{% if logo %}
+<a href="#" class="pull-right"><img alt="Logo" style="max-height:46px; padding-top:3px;" src="images/{{ logo }}"></a>
+{% endif %}
+</div></div></nav>
+<div class="container-fluid">
+'''
+
+UNAVAILABLE_VPN_TEMPLATE = '''\
+<div class="panel panel-danger" id="{{ vpn.name|anchor }}">
+<div class="panel-heading"><h3 class="panel-title">{{ vpn.name }}</h3></div>
+<div class="panel-body">Could not connect to
+{%- if vpn.host and vpn.port %} {{ vpn.host }}:{{ vpn.port }} ({{ vpn.error }})
+{%- elif vpn.socket %} {{ vpn.socket }} ({{ vpn.error }})
+{%- else %} network or unix socket
+{%- endif %}
+{% if vpn.breaker.state == 'open' %}
+<br>Failed {{ vpn.breaker.failures }} times in a row, retrying at {{ vpn.breaker.retry_at.strftime(datetime_format) }}
+{% elif vpn.breaker.state == 'half-open' %}
+<br>Failed {{ vpn.breaker.failures }} times in a row, retrying now
+{% endif %}
+</div></div>
+'''
+
+VPN_TEMPLATE = '''\
+{% macro server_session(session) %}
+<td>{{ session.username }}</td>
+<td>{{ session.local_ip }}</td>
+<td>{{ session.remote_ip }}</td>
+{% if session.location == 'RFC1918' %}
+<td>RFC1918</td>
+{% elif session.location %}
+{% set full_location = [session.city, session.region, session.country]|select|join(', ') %}
+<td><img src="images/flags/{{ session.location|lower }}.png" title="{{ full_location }}" alt="{{ full_location }}" /> {{ full_location }}</td>
+{% else %}
+<td>Unknown</td>
+{% endif %}
+<td>{{ session.bytes_recv|size }}</td>
+<td>{{ session.bytes_sent|size }}</td>
+<td>{{ session.bps_recv|bps if session.bps_recv is not none else '-' }}</td>
+<td>{{ session.bps_sent|bps if session.bps_sent is not none else '-' }}</td>
+<td>{{ session.connected_since.strftime(datetime_format) }}</td>
+<td>{{ session.last_seen.strftime(datetime_format) if session.last_seen else 'ERROR' }}</td>
+<td class="time-online" data-since="{{ session.connected_since|timestamp }}"></td>
+{% if vpn.show_disconnect %}
+<td><form method="post">
+<input type="hidden" name="vpn_id" value="{{ vpn_id }}">
+{% if session.port %}
+<input type="hidden" name="ip" value="{{ session.remote_ip }}">
+<input type="hidden" name="port" value="{{ session.port }}">
+{% endif %}
+{% if session.client_id %}
+<input type="hidden" name="client_id" value="{{ session.client_id }}">
+{% endif %}
+<button type="submit" class="btn btn-xs btn-danger"><span class="glyphicon glyphicon-remove"></span> Disconnect</button></form></td>
+{% endif %}
+{% endmacro %}
+{% macro client_session(session) %}
+<td>{{ session.tuntap_read|size }}</td>
+<td>{{ session.tuntap_write|size }}</td>
+<td>{{ session.tcpudp_read|size }}</td>
+<td>{{ session.tcpudp_write|size }}</td>
+<td>{{ session.auth_read|size }}</td>
+{% endmacro %}
+{% set mode = vpn.state.mode %}
+{% if vpn.stale_since %}
+<div class="panel panel-warning" id="{{ vpn.name|anchor }}" data-collected="{{ vpn.stale_since|timestamp }}">
+{% else %}
+<div class="panel panel-success" id="{{ vpn.name|anchor }}">
+{% endif %}
+<div class="panel-heading"><h3 class="panel-title">{{ vpn.name }}
+{% if vpn.stale_since %}
+<span class="label label-warning" title="{{ vpn.error }}">stale since {{ vpn.stale_since.strftime(datetime_format) }}</span>
+{% if vpn.breaker.state == 'open' %}
+<small>Failed {{ vpn.breaker.failures }} times in a row, retrying at {{ vpn.breaker.retry_at.strftime(datetime_format) }}</small>
+{% elif vpn.breaker.state == 'half-open' %}
+<small>Failed {{ vpn.breaker.failures }} times in a row, retrying now</small>
+{% endif %}
+{% endif %}
+</h3></div>
+<div class="panel-body">
+<div class="table-responsive">
+<table class="table table-condensed table-responsive">
+<thead><tr><th>VPN Mode</th><th>Status</th><th>Pingable</th>
+<th>Clients</th><th>Clients Trend</th><th>Total Bytes In</th><th>Total Bytes Out</th>
+<th>Bits/s In</th><th>Bits/s Out</th>
+<th>Up Since</th><th>Local IP Address</th>
+{% if mode == 'Client' %}
+<th>Remote IP Address</th>
+{% endif %}
+</tr></thead><tbody>
+<tr><td>{{ mode }}</td>
+<td>{{ vpn.state.connected }}</td>
+<td>{{ 'Yes' if vpn.state.success == 'SUCCESS' else 'No' }}</td>
+<td>{{ vpn.stats.nclients }}</td>
+{% if vpn.throughput %}
+<td>{{ '%+d'|format(vpn.throughput.clients_change) }} (avg {{ vpn.throughput.clients_avg }})</td>
+{% else %}
+<td>-</td>
+{% endif %}
+<td>{{ vpn.stats.bytesin|size }}</td>
+<td>{{ vpn.stats.bytesout|size }}</td>
+{% if vpn.throughput %}
+<td>{{ vpn.throughput.bps_in|bps }} (avg {{ vpn.throughput.avg_bps_in|bps }})</td>
+<td>{{ vpn.throughput.bps_out|bps }} (avg {{ vpn.throughput.avg_bps_out|bps }})</td>
+{% else %}
+<td>-</td>
+<td>-</td>
+{% endif %}
+<td>{{ vpn.state.up_since.strftime(datetime_format) }}</td>
+<td>{{ vpn.state.local_ip }}</td>
+{% if mode == 'Client' %}
+<td>{{ vpn.state.remote_ip }}</td>
+{% endif %}
+</tr></tbody></table></div>
+{% if mode == 'Client' or vpn.stats.nclients > 0 %}
+<div class="table-responsive">
+<table id="sessions" class="table table-striped table-bordered table-hover table-condensed table-responsive tablesorter tablesorter-bootstrap">
+<thead><tr>
+{% if mode == 'Client' %}
+<th>Tun-Tap-Read</th><th>Tun-Tap-Write</th><th>TCP-UDP-Read</th><th>TCP-UDP-Write</th><th>Auth-Read</th>
+{% else %}
+<th>Username / Hostname</th><th>VPN IP</th><th>Remote IP</th><th>Location</th><th>Bytes In</th>
+<th>Bytes Out</th><th>Bits/s In</th><th>Bits/s Out</th><th>Connected Since</th><th>Last Ping</th><th>Time Online</th>
+{% if vpn.show_disconnect %}
+<th>Action</th>
+{% endif %}
+{% endif %}
+</tr></thead><tbody>
+{% for session in vpn.sessions.values() %}
+{% if mode == 'Client' %}
+<tr>
+{{ client_session(session) }}</tr>
+{% elif session.local_ip %}
+<tr>
+{{ server_session(session) }}</tr>
+{% endif %}
+{% endfor %}
+</tbody></table></div>
+{% endif %}
+</div>
+<div class="panel-footer panel-custom">{{ vpn.release }}</div>
+</div>
+'''
+
+TOP_TEMPLATE = '''\
+<div class="panel panel-default" id="top">
+<div class="panel-heading"><h3 class="panel-title">Top {{ sessions|length }} sessions by {{ metrics[metric] }}</h3></div>
+<div class="panel-body">
+<form class="form-inline" method="get">
+<input type="number" class="form-control input-sm" name="n" min="1" max="{{ max_n }}" value="{{ n }}">
+<select class="form-control input-sm" name="metric">
+{% for name, title in metrics.items() %}
+<option value="{{ name }}"{% if name == metric %} selected{% endif %}>{{ title }}</option>
+{% endfor %}
+</select>
+<button type="submit" class="btn btn-sm btn-default">Show</button>
+</form>
+<div class="table-responsive">
+<table class="table table-striped table-bordered table-hover table-condensed table-responsive tablesorter tablesorter-bootstrap">
+<thead><tr><th>VPN</th><th>Username / Hostname</th><th>VPN IP</th><th>Remote IP</th>
+<th>Bytes In</th><th>Bytes Out</th><th>Bits/s In</th><th>Bits/s Out</th><th>Connected Since</th></tr></thead><tbody>
+{% for vpn_id, session in sessions %}
+<tr><td><a href="./#{{ vpns[vpn_id].name|anchor }}">{{ vpns[vpn_id].name }}</a></td>
+<td>{{ session.username }}</td>
+<td>{{ session.local_ip }}</td>
+<td>{{ session.remote_ip }}</td>
+<td>{{ session.bytes_recv|size }}</td>
+<td>{{ session.bytes_sent|size }}</td>
+<td>{{ session.bps_recv|bps if session.bps_recv is not none else '-' }}</td>
+<td>{{ session.bps_sent|bps if session.bps_sent is not none else '-' }}</td>
+<td>{{ session.connected_since.strftime(datetime_format) }}</td></tr>
+{% endfor %}
+</tbody></table></div>
+</div></div>
+'''
+
+FOOTER_TEMPLATE = '''\
+<div class="well well-sm">
+Page automatically reloads every 5 minutes.
+Last update: <b id="last-update" data-collected="{{ collected|timestamp }}">{{ collected.strftime(datetime_format) }}</b></div>
+</div></body></html>
+'''
+
+templates = Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True)
+templates.filters['size'] = format_size
+templates.filters['timestamp'] = get_timestamp
+templates.filters['bps'] = format_bps
+templates.filters['anchor'] = get_anchor
+header_template = templates.from_string(HEADER_TEMPLATE)
+unavailable_vpn_template = templates.from_string(UNAVAILABLE_VPN_TEMPLATE)
+vpn_template = templates.from_string(VPN_TEMPLATE)
+top_template = templates.from_string(TOP_TEMPLATE)
+footer_template = templates.from_string(FOOTER_TEMPLATE)
+
+
+class FragmentCache(object):
+    """Rendered parts of the page, each reused until the version of the
+    data it was rendered from changes.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, render, *args):
+        with self.lock:
+            cached = self.fragments.get(key)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        fragment = render(*args)
+        with self.lock:
+            self.fragments[key] = (version, fragment)
+        return fragment
+
+    def retain(self, keys):
+        """Forget the fragments of anything no longer on the page."""
+        with self.lock:
+            for key in set(self.fragments) - set(keys):
+                del self.fragments[key]
+
+
+fragments = FragmentCache()
+
+
 class OpenvpnHtmlPrinter(object):
 
     def __init__(self, cfg, monitor):
         self.init_vars(cfg.settings, monitor)
-        self.print_html_header()
+
+    def render(self):
+        """Yield the page in chunks, one for the header, each VPN panel and the footer."""
+        names = tuple(vpn['name'] for key, vpn in self.vpns)
+        yield fragments.get('header', (self.site, self.logo, names), self.render_html_header, names)
         for key, vpn in self.vpns:
-            if vpn['socket_connected']:
-                self.print_vpn(key, vpn)
-            else:
-                self.print_unavailable_vpn(vpn)
-        self.print_html_footer()
+            yield fragments.get(('vpn', key), self.get_vpn_version(vpn), self.render_vpn, key, vpn)
+        yield self.render_html_footer()
+        fragments.retain(['header'] + [('vpn', key) for key, vpn in self.vpns])
+        logger.debug('Fragment cache: %d hits, %d misses', fragments.hits, fragments.misses)
 
     def init_vars(self, settings, monitor):
 
@@ -464,269 +1962,878 @@ class OpenvpnHtmlPrinter(object):
             self.longitude = settings['longitude']
 
         self.datetime_format = settings['datetime_format']
+        self.last_update = monitor.collected
+
+    def render_top(self, n, metric):
+        """Yield a page listing the top n sessions by metric."""
+        names = tuple(vpn['name'] for key, vpn in self.vpns)
+        yield fragments.get('header', (self.site, self.logo, names), self.render_html_header, names)
+        yield top_template.render(sessions=get_top_sessions(dict(self.vpns), n, metric),
+                                  vpns=dict(self.vpns), n=n, max_n=TOP_MAX,
+                                  metric=metric, metrics=TOP_METRICS,
+                                  datetime_format=self.datetime_format)
+        yield self.render_html_footer()
+
+    def get_vpn_version(self, vpn):
+        """Everything a VPN panel is rendered from, other than the VPN's
+        collected data itself, which is represented by its digest.
+        """
+        if not vpn['socket_connected']:
+            return (vpn['name'], vpn.get('host'), vpn.get('port'),
+                    vpn.get('socket'), vpn.get('error'), vpn.get('breaker'),
+                    self.datetime_format)
+        throughput = vpn['throughput']
+        if throughput is not None:
+            # the number of samples is not shown
+            throughput = dict(throughput, samples=None)
+        # Time Online is filled in by the page from each session's connect
+        # time, so the time of the collection is not part of the version
+        return (vpn['digest'], throughput, vpn['name'],
+                vpn['show_disconnect'], self.datetime_format, geoip.signature,
+                vpn.get('stale_since'), vpn.get('breaker'))
+
+    def render_html_header(self, names):
+        return header_template.render(site=self.site, logo=self.logo,
+                                      names=names, head=HTML_HEAD)
+
+    def render_vpn(self, vpn_id, vpn):
+        if not vpn['socket_connected']:
+            if not vpn.get('socket') and not (vpn.get('host') and vpn.get('port')):
+                logger.warning('fail to get socket or network info: %s', vpn)
+            return unavailable_vpn_template.render(vpn=vpn, datetime_format=self.datetime_format)
+        return vpn_template.render(vpn_id=vpn_id, vpn=vpn,
+                                   datetime_format=self.datetime_format)
+
+    def render_html_footer(self):
+        return footer_template.render(collected=self.last_update,
+                                      datetime_format=self.datetime_format)
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # IP addresses
+    return str(value)
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (TypeError, ValueError):
+        key = None
+    # decoding skips characters outside the alphabet instead of failing
+    if key is None or encode_cursor(key) != cursor:
+        raise ValueError('invalid cursor: {0!s}'.format(cursor))
+    return key
+
+
+# Sorted session keys of each VPN, the order pages of sessions are served in
+session_keys = FragmentCache()
+
+
+class OpenvpnJsonPrinter(object):
+    """Serializes a snapshot for the JSON API.
+
+    Each method returns the strong ETag of a response along with a function
+    producing its body. The ETag is derived from the digests of the data the
+    body is built from, so a conditional request is answered without
+    serializing anything.
+    """
+
+    page_size = 100
+    max_page_size = 1000
 
-    def print_html_header(self):
-        output('<!doctype html>')
-        output('<html lang="en"><head>')
-        output('<meta charset="utf-8">')
-        output('<meta http-equiv="X-UA-Compatible" content="IE=edge">')
-        output('<meta name="viewport" content="width=device-width, initial-scale=1">')
-        output('<title>{0!s} OpenVPN Status Monitor</title>'.format(self.site))
-        output('<meta http-equiv="refresh" content="300" />')
-
-        # css
-        output('<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha256-916EbMg70RQy9LHiGkXzG8hSg9EdNy97GazNG/aiY1w=" crossorigin="anonymous" />')         # noqa
-        output('<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap-theme.min.css" integrity="sha256-ZT4HPpdCOt2lvDkXokHuhJfdOKSPFLzeAJik5U/Q+l4=" crossorigin="anonymous" />')   # noqa
-        output('<link rel="stylesheet" href="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/css/theme.bootstrap.min.css" integrity="sha256-dXZ9g5NdsPlD0182JqLz9UFael+Ug5AYo63RfujWPu8=" crossorigin="anonymous" />') # noqa
-        output('<style>')
-        output('.panel-custom {')
-        output('   background-color:#777;')
-        output('   color:#fff;')
-        output('   font-size:80%;')
-        output('   vertical-align:baseline;')
-        output('   padding:.4em .4em .4em;')
-        output('   line-height:1;')
-        output('   font-weight:700;')
-        output('}')
-        output('</style>')
-
-        # js
-        output('<script src="//cdnjs.cloudflare.com/ajax/libs/jquery/3.3.1/jquery.min.js" integrity="sha256-FgpCb/KJQlLNfOu91ta32o/NMZxltwRo8QtmkMRdAu8=" crossorigin="anonymous"></script>')                                     # noqa
-        output('<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/jquery.tablesorter.min.js" integrity="sha256-OZsQ3HIaaZel0q2QrfcMuOXZf1i4QxE+7KLA5dJ/XVY=" crossorigin="anonymous"></script>')         # noqa
-        output('<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/jquery.tablesorter.widgets.min.js" integrity="sha256-+TgqgSpMfnq0gCirm/O2/SDZ3hODyRVTk/SCiRvFQ4A=" crossorigin="anonymous"></script>') # noqa
-        output('<script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.30.6/js/parsers/parser-network.min.js" integrity="sha256-oQTnMXEL+HMou3Kn2ep3VPFg661GGqkB59Tpbo4kBMc=" crossorigin="anonymous"></script>')     # noqa
-        output('<script src="//cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/js/bootstrap.min.js" integrity="sha256-U5ZEeKfGNOja007MMD3YBI0A3OSZOQbeG6z2f2Y0hu8=" crossorigin="anonymous"></script>')                    # noqa
-        output('<script>$(document).ready(function(){')
-        output('$("table.tablesorter").tablesorter({theme:"bootstrap", headerTemplate:"{content} {icon}", widgets:["uitheme"]});')
-        output('});</script>')
-
-        output('</head><body>')
-
-        output('<nav class="navbar navbar-inverse">')
-        output('<div class="container-fluid">')
-        output('<div class="navbar-header">')
-        output('<button type="button" class="navbar-toggle" ')
-        output('data-toggle="collapse" data-target="#myNavbar">')
-        output('<span class="icon-bar"></span>')
-        output('<span class="icon-bar"></span>')
-        output('<span class="icon-bar"></span>')
-        output('</button>')
-
-        output('<a class="navbar-brand" href="#">')
-        output('{0!s} OpenVPN Status Monitor</a>'.format(self.site))
-
-        output('</div><div class="collapse navbar-collapse" id="myNavbar">')
-        output('<ul class="nav navbar-nav"><li class="dropdown">')
-        output('<a class="dropdown-toggle" data-toggle="dropdown" href="#">VPN')
-        output('<span class="caret"></span></a>')
-        output('<ul class="dropdown-menu">')
+    def __init__(self, cfg, monitor):
+        self.vpns = monitor.vpns
 
-        for key, vpn in self.vpns:
-            if vpn['name']:
-                anchor = vpn['name'].lower().replace(' ', '_')
-                output('<li><a href="#{0!s}">{1!s}</a></li>'.format(anchor, vpn['name']))
-        output('</ul></li>')
+    @staticmethod
+    def get_vpn_version(vpn):
+        if not vpn['socket_connected']:
+            return (vpn['name'], vpn.get('error'), vpn.get('breaker'))
+        return (vpn['name'], vpn['digest'], vpn['throughput'], geoip.signature,
+                vpn.get('stale_since'), vpn.get('breaker'))
+
+    @staticmethod
+    def get_etag(*version):
+        return hashlib.sha1(repr(version).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, default=json_default, sort_keys=True)
+
+    @staticmethod
+    def serialize_vpn(vpn_id, vpn):
+        stale_since = vpn.get('stale_since')
+        # stale data is from a poll that succeeded earlier
+        data = {'id': vpn_id,
+                'name': vpn['name'],
+                'socket_connected': vpn['socket_connected'] and stale_since is None,
+                'breaker': vpn.get('breaker')}
+        if vpn['socket_connected']:
+            data['release'] = vpn['release']
+            data['state'] = vpn['state']
+            data['stats'] = vpn['stats']
+            data['throughput'] = vpn['throughput']
+            data['stale_since'] = stale_since
+        if not data['socket_connected']:
+            data['error'] = vpn.get('error')
+        return data
 
+    def get_vpns(self):
+        etag = self.get_etag('vpns', [(key, self.get_vpn_version(vpn))
+                                      for key, vpn in self.vpns.items()])
+
+        def render():
+            return self.dumps({'vpns': [self.serialize_vpn(key, vpn)
+                                        for key, vpn in self.vpns.items()]})
+        return etag, render
+
+    def get_top(self, n, metric):
+        """Return the top n sessions by metric across all VPNs.
+        Raises ValueError for an unknown metric.
+        """
+        if metric not in TOP_METRICS:
+            raise ValueError('unknown metric: {0!s}'.format(metric))
+        etag = self.get_etag('top', n, metric, [(key, self.get_vpn_version(vpn))
+                                                for key, vpn in self.vpns.items()])
+
+        def render():
+            top = get_top_sessions(self.vpns, n, metric)
+            return self.dumps({'metric': metric,
+                               'sessions': [dict(session, vpn_id=vpn_id)
+                                            for vpn_id, session in top]})
+        return etag, render
+
+    def get_sessions(self, vpn_id, cursor=None, limit=None):
+        """Return a page of limit sessions following the one cursor points at.
+        Raises KeyError for an unknown VPN and ValueError for a bad cursor.
+        """
+        vpn = self.vpns[vpn_id]
+        if limit is None:
+            limit = self.page_size
+        limit = min(max(limit, 1), self.max_page_size)
+        after = decode_cursor(cursor) if cursor else None
+        version = self.get_vpn_version(vpn)
+        etag = self.get_etag('sessions', vpn_id, version, after, limit)
+
+        def render():
+            sessions = vpn.get('sessions', {})
+            keys = session_keys.get(vpn_id, version, sorted, sessions)
+            start = bisect_right(keys, after) if after is not None else 0
+            page = keys[start:start + limit]
+            if start + limit < len(keys):
+                next_cursor = encode_cursor(page[-1])
+            else:
+                next_cursor = None
+            return self.dumps({'sessions': [sessions[key] for key in page],
+                               'next_cursor': next_cursor})
+        return etag, render
 
-        output('</ul>')
 
-        if self.logo:
-            output('<a href="#" class="pull-right"><img alt="Logo" ')
-            output('style="max-height:46px; padding-top:3px;" ')
-            output('src="images/{0!s}"></a>'.format(self.logo))
+METRICS = (
+    ('openvpn_up', 'gauge', 'Whether the management interface could be polled.'),
+    ('openvpn_stale_since_seconds', 'gauge',
+     'Time the last data of a VPN that could not be polled was collected, in seconds since the epoch.'),
+    ('openvpn_state', 'gauge', 'Connection state of the VPN, 1 for the current state.'),
+    ('openvpn_up_since_seconds', 'gauge', 'Time the VPN reached its current state, in seconds since the epoch.'),
+    ('openvpn_clients', 'gauge', 'Number of connected clients.'),
+    ('openvpn_bytes_in_total', 'counter', 'Bytes received by the VPN.'),
+    ('openvpn_bytes_out_total', 'counter', 'Bytes sent by the VPN.'),
+    ('openvpn_session_bytes_received_total', 'counter', 'Bytes received from a client.'),
+    ('openvpn_session_bytes_sent_total', 'counter', 'Bytes sent to a client.'),
+    ('openvpn_geoip_cache_hits_total', 'counter', 'GeoIP lookups answered from the cache.'),
+    ('openvpn_geoip_cache_misses_total', 'counter', 'GeoIP lookups made in the database.'),
+    ('openvpn_geoip_cache_entries', 'gauge', 'Client addresses in the GeoIP cache.'),
+)
 
-        output('</div></div></nav>')
-        output('<div class="container-fluid">')
 
-    @staticmethod
-    def print_session_table_headers(vpn_mode, show_disconnect):
-        server_headers = ['Username / Hostname', 'VPN IP',
-                          'Remote IP', 'Location', 'Bytes In',
-                          'Bytes Out', 'Connected Since', 'Last Ping', 'Time Online']
-        if show_disconnect:
-            server_headers.append('Action')
-
-        client_headers = ['Tun-Tap-Read', 'Tun-Tap-Write', 'TCP-UDP-Read',
-                          'TCP-UDP-Write', 'Auth-Read']
-
-        if vpn_mode == 'Client':
-            headers = client_headers
-        elif vpn_mode == 'Server':
-            headers = server_headers
-
-        output('<div class="table-responsive">')
-        output('<table id="sessions" class="table table-striped table-bordered ')
-        output('table-hover table-condensed table-responsive ')
-        output('tablesorter tablesorter-bootstrap">')
-        output('<thead><tr>')
-        for header in headers:
-            output('<th>{0!s}</th>'.format(header))
-        output('</tr></thead><tbody>')
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labels):
+    return ','.join('{0!s}="{1!s}"'.format(name, escape_label(value))
+                    for name, value in labels)
+
+
+# Exposition text of the latest snapshot, shared between scrapes
+exposition = FragmentCache()
+
+
+class OpenvpnMetricsPrinter(object):
+    """Renders a snapshot in the Prometheus text exposition format.
+
+    Sessions are only exported when metrics_client_labels is enabled, as
+    every session is a separate series.
+    """
+
+    def __init__(self, cfg, monitor):
+        self.vpns = monitor.vpns
+        self.client_labels = get_boolean(cfg.settings, 'metrics_client_labels', False)
+        self.geoip_stats = geoip.cache.get_stats()
+
+    def render(self):
+        version = (self.client_labels, self.geoip_stats,
+                   [(key, OpenvpnJsonPrinter.get_vpn_version(vpn))
+                    for key, vpn in self.vpns.items()])
+        return exposition.get('metrics', version, self.render_metrics)
+
+    def render_metrics(self):
+        samples = dict((name, []) for name, kind, doc in METRICS)
+        for key, vpn in self.vpns.items():
+            self.add_samples(samples, key, vpn)
+        hits, misses, entries = self.geoip_stats
+        samples['openvpn_geoip_cache_hits_total'].append(((), hits))
+        samples['openvpn_geoip_cache_misses_total'].append(((), misses))
+        samples['openvpn_geoip_cache_entries'].append(((), entries))
+        lines = []
+        for name, kind, doc in METRICS:
+            if not samples[name]:
+                continue
+            lines.append('# HELP {0!s} {1!s}'.format(name, doc))
+            lines.append('# TYPE {0!s} {1!s}'.format(name, kind))
+            for labels, value in samples[name]:
+                if labels:
+                    lines.append('{0!s}{{{1!s}}} {2!s}'.format(name, format_labels(labels), value))
+                else:
+                    lines.append('{0!s} {1!s}'.format(name, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def add_samples(self, samples, vpn_id, vpn):
+        labels = (('vpn', vpn_id), ('name', vpn['name']))
+        stale_since = vpn.get('stale_since')
+        samples['openvpn_up'].append((labels, int(vpn['socket_connected'] and stale_since is None)))
+        if stale_since is not None:
+            # the rest would be exported as current
+            samples['openvpn_stale_since_seconds'].append(
+                (labels, int(time.mktime(stale_since.timetuple()))))
+            return
+        if not vpn['socket_connected']:
+            return
+        state = vpn['state']
+        samples['openvpn_state'].append((labels + (('state', state['connected']),), 1))
+        up_since = time.mktime(state['up_since'].timetuple())
+        samples['openvpn_up_since_seconds'].append((labels, int(up_since)))
+        stats = vpn['stats']
+        samples['openvpn_clients'].append((labels, stats['nclients']))
+        samples['openvpn_bytes_in_total'].append((labels, stats['bytesin']))
+        samples['openvpn_bytes_out_total'].append((labels, stats['bytesout']))
+        if not self.client_labels or state['mode'] != 'Server':
+            return
+        for session in vpn['sessions'].values():
+            session_labels = labels + (('username', session['username']),
+                                       ('local_ip', session['local_ip']),
+                                       ('remote_ip', session['remote_ip']))
+            samples['openvpn_session_bytes_received_total'].append(
+                (session_labels, session['bytes_recv']))
+            samples['openvpn_session_bytes_sent_total'].append(
+                (session_labels, session['bytes_sent']))
+
+
+# Resolutions history is kept at, in seconds, each rolled up from the one before
+HISTORY_RESOLUTIONS = OrderedDict((('raw', 0), ('1m', 60), ('1h', 3600), ('1d', 86400)))
+
+HISTORY_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS vpn_samples (
+        vpn TEXT NOT NULL,
+        resolution INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        nclients REAL NOT NULL,
+        nclients_max INTEGER NOT NULL,
+        bytesin INTEGER NOT NULL,
+        bytesout INTEGER NOT NULL,
+        PRIMARY KEY (vpn, resolution, ts))''',
+    '''CREATE TABLE IF NOT EXISTS session_samples (
+        vpn TEXT NOT NULL,
+        resolution INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        common_name TEXT NOT NULL,
+        username TEXT NOT NULL,
+        remote_ip TEXT NOT NULL,
+        local_ip TEXT NOT NULL,
+        connected_since INTEGER NOT NULL,
+        bytes_recv INTEGER NOT NULL,
+        bytes_sent INTEGER NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS session_samples_vpn
+        ON session_samples (vpn, resolution, ts)''',
+    '''CREATE INDEX IF NOT EXISTS session_samples_common_name
+        ON session_samples (common_name, resolution, ts)''',
+    '''CREATE INDEX IF NOT EXISTS session_samples_resolution
+        ON session_samples (resolution, ts)''',
+    '''CREATE TABLE IF NOT EXISTS rollups (
+        resolution INTEGER PRIMARY KEY,
+        rolled_up INTEGER NOT NULL)''',
+)
+
+VPN_SAMPLE_COLUMNS = ('ts', 'nclients', 'nclients_max', 'bytesin', 'bytesout')
+SESSION_SAMPLE_COLUMNS = ('vpn', 'ts', 'common_name', 'username', 'remote_ip', 'local_ip',
+                          'connected_since', 'bytes_recv', 'bytes_sent')
+
+
+class HistoryStore(object):
+    """Optional SQLite history of VPN stats and sessions.
+
+    Each collection is written as one transaction of raw samples. A raw
+    session sample is only written when the session's byte counts have
+    changed, or else once in each minute, so that idle sessions don't fill
+    the table yet still appear in every minute's rollup. Raw
+    samples are rolled up into 1 minute, 1 hour and 1 day samples as each
+    period completes, and every resolution is deleted once older than its
+    retention period. The database is in WAL mode, so queries from page
+    loads are not blocked by the collector writing.
+
+    Connections are checked out of a pool of at most pool_size idle ones,
+    as requests may each be served by a new thread. Any more are closed
+    once used.
+    """
+
+    pool_size = 4
+
+    def __init__(self):
+        self.path = None
+        # days to keep each resolution for, in the order of HISTORY_RESOLUTIONS
+        self.retention = (1, 7, 90, 3650)
+        # idle connections, each usable by one thread at a time
+        self.idle = []
+        self.lock = threading.Lock()
+        # vpn key => {session key => (ts, bytes_recv, bytes_sent) of its last raw sample}
+        self.written = {}
+
+    def configure(self, settings):
+        path = settings.get('history_db') or None
+        try:
+            retention = tuple(float(days) for days in
+                              settings.get('history_retention', '1,7,90,3650').split(','))
+            if len(retention) != len(HISTORY_RESOLUTIONS):
+                raise ValueError
+            self.retention = retention
+        except ValueError:
+            logger.warning('CONFIG: invalid history_retention %s', settings['history_retention'])
+        if path != self.path:
+            self.path = path
+            self.close()
+            if path:
+                with self.connection() as db, db:
+                    for statement in HISTORY_SCHEMA:
+                        db.execute(statement)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @contextmanager
+    def connection(self):
+        """Yield a connection to the database for the calling thread alone."""
+        path = self.path
+        with self.lock:
+            db = self.idle.pop() if self.idle else None
+        if db is None:
+            # passed between threads, though only used by one at a time
+            db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            yield db
+        finally:
+            with self.lock:
+                keep = path == self.path and len(self.idle) < self.pool_size
+                if keep:
+                    self.idle.append(db)
+            if not keep:
+                db.close()
+
+    def close(self):
+        """Close the idle connections, on shutdown or when the path changes."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db in idle:
+            try:
+                db.close()
+            except sqlite3.Error as e:
+                logger.debug('Failed to close history database: %s', e)
+
+    def add(self, ts, vpns):
+        """Write samples of every collected VPN and its sessions at time ts."""
+        ts = int(ts)
+        vpn_rows = []
+        session_rows = []
+        for key, vpn in vpns.items():
+            if not vpn.get('socket_connected') or vpn.get('stale_since'):
+                continue
+            stats = vpn['stats']
+            vpn_rows.append((key, 0, ts, stats['nclients'], stats['nclients'],
+                             stats['bytesin'], stats['bytesout']))
+            if vpn['state']['mode'] != 'Server':
+                continue
+            written = self.written.get(key, {})
+            self.written[key] = current = {}
+            for session in vpn['sessions'].values():
+                connected_since = get_timestamp(session['connected_since'])
+                session_key = (session['common_name'], str(session['remote_ip']), connected_since)
+                counts = (session['bytes_recv'], session['bytes_sent'])
+                last = written.get(session_key)
+                if last is not None and last[1:] == counts and last[0] // 60 == ts // 60:
+                    current[session_key] = last
+                    continue
+                current[session_key] = (ts,) + counts
+                session_rows.append((key, 0, ts, session['common_name'], session['username'],
+                                     str(session['remote_ip']), str(session['local_ip']),
+                                     connected_since, session['bytes_recv'], session['bytes_sent']))
+        with self.connection() as db, db:
+            db.executemany('INSERT OR REPLACE INTO vpn_samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           vpn_rows)
+            db.executemany('INSERT INTO session_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           session_rows)
+            self.rollup(db, ts)
+
+    def rollup(self, db, now):
+        resolutions = list(HISTORY_RESOLUTIONS.values())
+        rolled_up = dict(db.execute('SELECT resolution, rolled_up FROM rollups'))
+        # samples of the source resolution are complete up to source_end
+        source_end = now
+        for source, resolution in zip(resolutions, resolutions[1:]):
+            start = rolled_up.get(resolution, 0)
+            end = min(now // resolution * resolution, source_end)
+            if end > start:
+                db.execute('''INSERT OR REPLACE INTO vpn_samples
+                    SELECT vpn, ?, ts / ? * ?, avg(nclients), max(nclients_max),
+                           max(bytesin), max(bytesout)
+                    FROM vpn_samples WHERE resolution = ? AND ts >= ? AND ts < ?
+                    GROUP BY vpn, ts / ?''',
+                           (resolution, resolution, resolution, source, start, end, resolution))
+                db.execute('''INSERT INTO session_samples
+                    SELECT vpn, ?, ts / ? * ?, common_name, username, remote_ip, local_ip,
+                           connected_since, max(bytes_recv), max(bytes_sent)
+                    FROM session_samples WHERE resolution = ? AND ts >= ? AND ts < ?
+                    GROUP BY vpn, ts / ?, common_name, connected_since, remote_ip''',
+                           (resolution, resolution, resolution, source, start, end, resolution))
+                db.execute('INSERT OR REPLACE INTO rollups VALUES (?, ?)', (resolution, end))
+                if source == 0:
+                    # expire old samples once a minute rather than on every collection
+                    self.expire(db, now)
+            source_end = max(start, end)
+
+    def expire(self, db, now):
+        for resolution, days in zip(HISTORY_RESOLUTIONS.values(), self.retention):
+            cutoff = now - int(days * 86400)
+            for table in ('vpn_samples', 'session_samples'):
+                db.execute('DELETE FROM {0!s} WHERE resolution = ? AND ts < ?'.format(table),
+                           (resolution, cutoff))
+
+    def get_vpn_samples(self, vpn, resolution, start, end):
+        with self.connection() as db:
+            rows = db.execute(
+                '''SELECT ts, nclients, nclients_max, bytesin, bytesout FROM vpn_samples
+                   WHERE vpn = ? AND resolution = ? AND ts >= ? AND ts < ? ORDER BY ts''',
+                (vpn, resolution, start, end)).fetchall()
+        return [dict(zip(VPN_SAMPLE_COLUMNS, row)) for row in rows]
+
+    def get_session_samples(self, resolution, start, end, vpn=None, common_name=None,
+                            limit=1000):
+        where = ['resolution = ?', 'ts >= ?', 'ts < ?']
+        params = [resolution, start, end]
+        if vpn is not None:
+            where.append('vpn = ?')
+            params.append(vpn)
+        if common_name is not None:
+            where.append('common_name = ?')
+            params.append(common_name)
+        params.append(limit)
+        with self.connection() as db:
+            rows = db.execute(
+                '''SELECT vpn, ts, common_name, username, remote_ip, local_ip, connected_since,
+                          bytes_recv, bytes_sent
+                   FROM session_samples WHERE {0!s} ORDER BY ts LIMIT ?'''.format(' AND '.join(where)),
+                params).fetchall()
+        return [dict(zip(SESSION_SAMPLE_COLUMNS, row)) for row in rows]
+
+
+history = HistoryStore()
+atexit.register(history.close)
+
+
+class SessionTracker(object):
+    """Works out which sessions connected and disconnected between
+    collections, by comparing each VPN's sessions with those it had before.
+
+    Sessions are matched as for their rates, by client_id or else remote
+    address and port, along with the time they connected.
+    """
+
+    def __init__(self):
+        # vpn key => (time, {session key => session})
+        self.previous = {}
 
     @staticmethod
-    def print_session_table_footer():
-        output('</tbody></table></div>')
+    def get_key(session):
+        return (SessionRates.get_key(session), session['connected_since'])
 
     @staticmethod
-    def print_unavailable_vpn(vpn):
-        anchor = vpn['name'].lower().replace(' ', '_')
-        output('<div class="panel panel-danger" id="{0!s}">'.format(anchor))
-        output('<div class="panel-heading">')
-        output('<h3 class="panel-title">{0!s}</h3></div>'.format(vpn['name']))
-        output('<div class="panel-body">')
-        output('Could not connect to ')
-        if 'host' in vpn and 'port' in vpn:
-            output('{0!s}:{1!s} ({2!s})</div></div>'.format(vpn['host'],
-                                                            vpn['port'],
-                                                            vpn['error']))
-        elif 'socket' in vpn:
-            output('{0!s} ({1!s})</div></div>'.format(vpn['socket'],
-                                                      vpn['error']))
-        else:
-            logger.warning('fail to get socket or network info: %s', vpn)
-            output('network or unix socket</div></div>')
+    def get_event(ts, event, vpn_id, session):
+        return {'ts': int(ts),
+                'event': event,
+                'vpn': vpn_id,
+                'common_name': session['common_name'],
+                'username': session['username'],
+                'remote_ip': str(session['remote_ip']),
+                'port': session['port'],
+                'local_ip': str(session['local_ip']),
+                'client_id': session.get('client_id'),
+                'connected_since': get_timestamp(session['connected_since'])}
+
+    def diff(self, ts, vpns):
+        """Return connect and disconnect events since the previous call.
+        Nothing is reported for a VPN the first time it is seen, or while it
+        cannot be polled.
+        """
+        events = []
+        for vpn_id, vpn in vpns.items():
+            if not vpn.get('socket_connected') or vpn.get('stale_since') or \
+                    vpn['state']['mode'] != 'Server':
+                continue
+            current = dict((self.get_key(session), session)
+                           for session in vpn['sessions'].values())
+            previous_ts, previous = self.previous.get(vpn_id, (None, None))
+            self.previous[vpn_id] = (ts, current)
+            if previous is None:
+                continue
+            for key, session in previous.items():
+                if key not in current:
+                    event = self.get_event(ts, 'disconnect', vpn_id, session)
+                    # last heard from, or else last seen connected
+                    if session.get('last_seen'):
+                        ended = get_timestamp(session['last_seen'])
+                    else:
+                        ended = int(previous_ts)
+                    event['duration'] = max(0, ended - event['connected_since'])
+                    event['bytes_recv'] = session['bytes_recv']
+                    event['bytes_sent'] = session['bytes_sent']
+                    events.append(event)
+            for key, session in current.items():
+                if key not in previous:
+                    events.append(self.get_event(ts, 'connect', vpn_id, session))
+        return events
+
+
+class EventLog(object):
+    """Append-only log of session events, one JSON object per line.
+
+    The log is split into segments of about segment_size bytes, each named
+    after the time of its first event. The sorted segment start times are
+    the time index, so a query only reads the segments overlapping its
+    range. The oldest segments are deleted to keep at most max_segments.
+
+    Only one process may write the log: forking WSGI servers run a
+    collector in every worker, which would each log the same events and
+    rotate segments under each other. The writer holds an exclusive lock on
+    writer.lock in the log directory; other processes skip appending, and
+    take over if the writer goes away. They re-read the segment list for
+    every query, as it changes under them.
+    """
+
+    segment_size = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.path = None
+        self.max_segments = 16
+        self.starts = []
+        self.file = None
+        self.lock_file = None
+        self.lock = threading.Lock()
+
+    def configure(self, settings):
+        path = settings.get('event_log') or None
+        try:
+            self.max_segments = max(1, int(settings.get('event_log_segments', 16)))
+        except ValueError:
+            logger.warning('CONFIG: invalid event_log_segments %s', settings['event_log_segments'])
+        with self.lock:
+            if path == self.path:
+                return
+            self.close()
+            self.release()
+            self.path = path
+            self.starts = []
+            if path:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                self.scan()
+
+    def scan(self):
+        self.starts = sorted(int(name[:-4]) for name in os.listdir(self.path)
+                             if name.endswith('.log') and name[:-4].isdigit())
+
+    def acquire(self):
+        """Become the process writing the log if no other is, returning
+        whether this process is the writer. Called with lock held."""
+        if self.lock_file is not None or fcntl is None:
+            return True
+        lock_file = open(os.path.join(self.path, 'writer.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        logger.info('Writing event log %s', self.path)
+        # segments may have been added by the previous writer
+        self.scan()
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def get_segment_path(self, start):
+        return os.path.join(self.path, '{0:d}.log'.format(start))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, events):
+        if not events:
+            return
+        with self.lock:
+            if not self.acquire():
+                return
+            if self.file is None:
+                if not self.starts or \
+                        os.path.getsize(self.get_segment_path(self.starts[-1])) >= self.segment_size:
+                    start = events[0]['ts']
+                    if self.starts:
+                        start = max(start, self.starts[-1] + 1)
+                    self.starts.append(start)
+                self.file = open(self.get_segment_path(self.starts[-1]), 'a')
+            for event in events:
+                self.file.write(json.dumps(event, sort_keys=True) + '\n')
+            self.file.flush()
+            if self.file.tell() >= self.segment_size:
+                self.close()
+                while len(self.starts) >= self.max_segments:
+                    os.remove(self.get_segment_path(self.starts.pop(0)))
+
+    def query(self, start, end=None):
+        """Yield the events from time start up to end (or the latest), oldest first."""
+        with self.lock:
+            if self.lock_file is None and fcntl is not None:
+                self.scan()
+            first = max(0, bisect_right(self.starts, start) - 1)
+            segments = [self.get_segment_path(ts) for ts in self.starts[first:]
+                        if end is None or ts <= end]
+        for path in segments:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        event = json.loads(line)
+                        if event['ts'] < start:
+                            continue
+                        if end is not None and event['ts'] > end:
+                            return
+                        yield event
+            except IOError:
+                # removed by rotation since the query started
+                continue
 
-    def print_vpn(self, vpn_id, vpn):
+    def get_user_sessions(self, user, start, end, vpns):
+        """Return the sessions of the user (username or common name) that were
+        connected at some time from start to end. Sessions that have ended
+        come from disconnect events, sessions still connected from vpns.
+        """
+        sessions = []
+        for event in self.query(start):
+            if event['event'] == 'disconnect' and event['connected_since'] <= end and \
+                    user in (event['username'], event['common_name']):
+                sessions.append(event)
+        for vpn_id, vpn in vpns.items():
+            if not vpn.get('socket_connected') or vpn['state']['mode'] != 'Server':
+                continue
+            for session in vpn['sessions'].values():
+                if user in (session['username'], session['common_name']) and \
+                        get_timestamp(session['connected_since']) <= end:
+                    event = SessionTracker.get_event(time.time(), 'connected', vpn_id, session)
+                    event['bytes_recv'] = session['bytes_recv']
+                    event['bytes_sent'] = session['bytes_sent']
+                    sessions.append(event)
+        return sessions
 
-        if vpn['state']['success'] == 'SUCCESS':
-            pingable = 'Yes'
-        else:
-            pingable = 'No'
-
-        connection = vpn['state']['connected']
-        nclients = vpn['stats']['nclients']
-        bytesin = vpn['stats']['bytesin']
-        bytesout = vpn['stats']['bytesout']
-        vpn_mode = vpn['state']['mode']
-        vpn_sessions = vpn['sessions']
-        local_ip = vpn['state']['local_ip']
-        remote_ip = vpn['state']['remote_ip']
-        up_since = vpn['state']['up_since']
-        show_disconnect = vpn['show_disconnect']
-
-        anchor = vpn['name'].lower().replace(' ', '_')
-        output('<div class="panel panel-success" id="{0!s}">'.format(anchor))
-        output('<div class="panel-heading"><h3 class="panel-title">{0!s}</h3>'.format(
-            vpn['name']))
-        output('</div><div class="panel-body">')
-        output('<div class="table-responsive">')
-        output('<table class="table table-condensed table-responsive">')
-        output('<thead><tr><th>VPN Mode</th><th>Status</th><th>Pingable</th>')
-        output('<th>Clients</th><th>Total Bytes In</th><th>Total Bytes Out</th>')
-        output('<th>Up Since</th><th>Local IP Address</th>')
-        if vpn_mode == 'Client':
-            output('<th>Remote IP Address</th>')
-        output('</tr></thead><tbody>')
-        output('<tr><td>{0!s}</td>'.format(vpn_mode))
-        output('<td>{0!s}</td>'.format(connection))
-        output('<td>{0!s}</td>'.format(pingable))
-        output('<td>{0!s}</td>'.format(nclients))
-        output('<td>{0!s} ({1!s})</td>'.format(bytesin, naturalsize(bytesin, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(bytesout, naturalsize(bytesout, binary=True)))
-        output('<td>{0!s}</td>'.format(up_since.strftime(self.datetime_format)))
-        output('<td>{0!s}</td>'.format(local_ip))
-        if vpn_mode == 'Client':
-            output('<td>{0!s}</td>'.format(remote_ip))
-        output('</tr></tbody></table></div>')
-
-        if vpn_mode == 'Client' or nclients > 0:
-            self.print_session_table_headers(vpn_mode, show_disconnect)
-            self.print_session_table(vpn_id, vpn_mode, vpn_sessions, show_disconnect)
-            self.print_session_table_footer()
-
-        output('</div>')
-        output('<div class="panel-footer panel-custom">')
-        output('{0!s}'.format(vpn['release']))
-        output('</div>')
-        output('</div>')
 
-    @staticmethod
-    def print_client_session(session):
-        tuntap_r = session['tuntap_read']
-        tuntap_w = session['tuntap_write']
-        tcpudp_r = session['tcpudp_read']
-        tcpudp_w = session['tcpudp_write']
-        auth_r = session['auth_read']
-        output('<td>{0!s} ({1!s})</td>'.format(tuntap_r, naturalsize(tuntap_r, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(tuntap_w, naturalsize(tuntap_w, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(tcpudp_r, naturalsize(tcpudp_w, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(tcpudp_w, naturalsize(tcpudp_w, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(auth_r, naturalsize(auth_r, binary=True)))
-
-    def print_server_session(self, vpn_id, session, show_disconnect):
-        total_time = str(datetime.now() - session['connected_since'])[:-7]
-        bytes_recv = session['bytes_recv']
-        bytes_sent = session['bytes_sent']
-        output('<td>{0!s}</td>'.format(session['username']))
-        output('<td>{0!s}</td>'.format(session['local_ip']))
-        output('<td>{0!s}</td>'.format(session['remote_ip']))
-
-        if 'location' in session and session['location'] is not None:
-            if session['location'] == 'RFC1918':
-                output('<td>RFC1918</td>')
-            else:
-                flag = 'images/flags/{0!s}.png'.format(session['location'].lower())
-                if 'country' in session and session['country'] is not None:
-                    country = session['country']
-                    full_location = country
-                if 'region' in session and session['region'] is not None:
-                    region = session['region']
-                    full_location = '{0!s}, {1!s}'.format(region, full_location)
-                if 'city' in session and session['city'] is not None:
-                    city = session['city']
-                    full_location = '{0!s}, {1!s}'.format(city, full_location)
-                output('<td><img src="{0!s}" title="{1!s}" alt="{1!s}" /> '.format(flag, full_location))
-                output('{0!s}</td>'.format(full_location))
-        else:
-            output('<td>Unknown</td>')
-
-        output('<td>{0!s} ({1!s})</td>'.format(bytes_recv, naturalsize(bytes_recv, binary=True)))
-        output('<td>{0!s} ({1!s})</td>'.format(bytes_sent, naturalsize(bytes_sent, binary=True)))
-        output('<td>{0!s}</td>'.format(
-            session['connected_since'].strftime(self.datetime_format)))
-        if 'last_seen' in session:
-            output('<td>{0!s}</td>'.format(
-                session['last_seen'].strftime(self.datetime_format)))
-        else:
-            output('<td>ERROR</td>')
-        output('<td>{0!s}</td>'.format(total_time))
-        if show_disconnect:
-            output('<td><form method="post">')
-            output('<input type="hidden" name="vpn_id" value="{0!s}">'.format(vpn_id))
-            if 'port' in session:
-                output('<input type="hidden" name="ip" value="{0!s}">'.format(session['remote_ip']))
-                output('<input type="hidden" name="port" value="{0!s}">'.format(session['port']))
-            if 'client_id' in session:
-                output('<input type="hidden" name="client_id" value="{0!s}">'.format(session['client_id']))
-            output('<button type="submit" class="btn btn-xs btn-danger">')
-            output('<span class="glyphicon glyphicon-remove"></span> ')
-            output('Disconnect</button></form></td>')
-
-    def print_session_table(self, vpn_id, vpn_mode, sessions, show_disconnect):
-        for key, session in list(sessions.items()):
-            output('<tr>')
-            if vpn_mode == 'Client':
-                self.print_client_session(session)
-            elif vpn_mode == 'Server':
-                if not session['local_ip']:
-                    continue
-                self.print_server_session(vpn_id, session, show_disconnect)
-            output('</tr>')
+session_tracker = SessionTracker()
+event_log = EventLog()
+
+
+class SingleFlight(object):
+    """Shares one in-flight call between concurrent callers.
+
+    The first caller (the leader) runs the function while later callers
+    wait for and return its result. A result is also handed out without
+    calling again while it is younger than max_age seconds.
+    """
+
+    def __init__(self, max_age=0):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.call = None
+        self.result = None
+        self.finished = 0
+
+    def do(self, fn):
+        with self.lock:
+            if self.result is not None and time.monotonic() - self.finished <= self.max_age:
+                return self.result
+            call = self.call
+            leader = call is None
+            if leader:
+                call = self.call = FlightCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.call = None
+                if call.error is None:
+                    self.result = call.result
+                    self.finished = time.monotonic()
+            call.done.set()
+        return call.result
+
 
-    def print_html_footer(self):
-        output('<div class="well well-sm">')
-        output('Page automatically reloads every 5 minutes.')
-        output('Last update: <b>{0!s}</b></div>'.format(
-            datetime.now().strftime(self.datetime_format)))
-        output('</div></body></html>')
+class FlightCall(object):
 
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-def main(**kwargs):
-    cfg = ConfigLoader(args.config)
-    monitor = OpenvpnMgmtInterface(cfg, **kwargs)
-    OpenvpnHtmlPrinter(cfg, monitor)
-    pretty_vpns = pformat((dict(monitor.vpns)))
-    logger.debug("=== begin vpns\n%s\n=== end vpns", pretty_vpns)
+
+class Collector(object):
+    """Keeps a snapshot of every VPN fresh from a background thread.
+
+    HTTP requests render the latest snapshot instead of scraping the
+    management interfaces themselves. With a refresh_interval of 0 there
+    is no background thread; concurrent requests then share a single
+    collection, reused for up to coalesce_window seconds.
+    """
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        settings = ConfigLoader(config_file).settings
+        self.interval = get_seconds(settings, 'refresh_interval', 10)
+        self.flight = SingleFlight(get_seconds(settings, 'coalesce_window', 0))
+        self.snapshot = None
+        self.ready = threading.Event()
+        self.refresh_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+
+    def collect(self, **kwargs):
+        cfg = ConfigLoader(self.config_file)
+        self.interval = get_seconds(cfg.settings, 'refresh_interval', 10)
+        self.flight.max_age = get_seconds(cfg.settings, 'coalesce_window', 0)
+        monitor = OpenvpnMgmtInterface(cfg, **kwargs)
+        if logger.isEnabledFor(logging.DEBUG):
+            pretty_vpns = pformat((dict(monitor.vpns)))
+            logger.debug("=== begin vpns\n%s\n=== end vpns", pretty_vpns)
+        return cfg, monitor
+
+    def refresh(self, **kwargs):
+        with self.refresh_lock:
+            snapshot = self.collect(**kwargs)
+            self.snapshot = snapshot
+            self.record(*snapshot)
+        return snapshot
+
+    @staticmethod
+    def record(cfg, monitor):
+        now = time.time()
+        try:
+            history.configure(cfg.settings)
+            if history.enabled:
+                history.add(now, monitor.vpns)
+        except sqlite3.Error as e:
+            logger.warning('Failed to write history: %s', e)
+        try:
+            event_log.configure(cfg.settings)
+            events = session_tracker.diff(now, monitor.vpns)
+            if event_log.enabled:
+                event_log.append(events)
+        except (IOError, OSError) as e:
+            logger.warning('Failed to write event log: %s', e)
+
+    def start(self):
+        # started lazily so that forking WSGI servers get a thread per worker
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='collector')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while self.interval > 0:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to collect VPN data')
+            finally:
+                self.ready.set()
+            time.sleep(self.interval)
+
+    def get(self):
+        if self.interval <= 0:
+            return self.flight.do(self.refresh)
+        self.start()
+        self.ready.wait()
+        if self.snapshot is None:
+            return self.refresh()
+        return self.snapshot
+
+
+def get_seconds(settings, name, default):
+    try:
+        return max(0, float(settings.get(name, default)))
+    except ValueError:
+        logger.warning('CONFIG: invalid %s %s, using %s', name, settings[name], default)
+        return default
+
+
+def get_boolean(settings, name, default):
+    """Read a boolean setting as configparser would, so 'true', 'yes',
+    'on' and '1' are all true."""
+    value = settings.get(name)
+    if value is None:
+        return default
+    try:
+        return configparser.RawConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        logger.warning('CONFIG: invalid %s %s, using %s', name, value, default)
+        return default
+
+
+def main(collector, **kwargs):
+    if kwargs:
+        cfg, monitor = collector.refresh(**kwargs)
+    else:
+        cfg, monitor = collector.get()
+    return OpenvpnHtmlPrinter(cfg, monitor).render()
 
 
 def get_args():
@@ -753,12 +2860,10 @@ def set_logging_level(level):
 
 def monitor_wsgi():
     app = flask.Flask(__name__)
+    collector = Collector(args.config)
 
     def render(**kwargs):
-        global wsgi_output
-        wsgi_output = ''
-        main(**kwargs)
-        return wsgi_output
+        return flask.Response(main(collector, **kwargs), mimetype='text/html')
 
     @app.route('/', methods=['GET'])
     def get_slash():
@@ -772,6 +2877,119 @@ def monitor_wsgi():
     #     client_id = request.forms.get('client_id')
     #     return render(vpn_id=vpn_id, ip=ip, port=port, client_id=client_id)
 
+    def render_json(etag, body):
+        if flask.request.if_none_match.contains_weak(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(body(), mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    def json_error(status, message):
+        response = flask.jsonify({'error': message})
+        response.status_code = status
+        return response
+
+    @app.route('/api/v1/vpns', methods=['GET'])
+    def get_vpns():
+        cfg, monitor = collector.get()
+        return render_json(*OpenvpnJsonPrinter(cfg, monitor).get_vpns())
+
+    @app.route('/api/v1/vpns/<string:vpn_id>/sessions', methods=['GET'])
+    def get_sessions(vpn_id):
+        cfg, monitor = collector.get()
+        try:
+            vpn = monitor.vpns[vpn_id]
+        except KeyError:
+            return json_error(404, 'unknown vpn: {0!s}'.format(vpn_id))
+        if not vpn['socket_connected']:
+            return json_error(503, vpn.get('error'))
+        cursor = flask.request.args.get('cursor')
+        limit = flask.request.args.get('limit', type=int)
+        try:
+            page = OpenvpnJsonPrinter(cfg, monitor).get_sessions(vpn_id, cursor, limit)
+        except ValueError as e:
+            return json_error(400, str(e))
+        return render_json(*page)
+
+    def get_top_args():
+        n = flask.request.args.get('n', TOP_DEFAULT, type=int)
+        metric = flask.request.args.get('metric', 'bps')
+        return min(max(n, 1), TOP_MAX), metric
+
+    @app.route('/top', methods=['GET'])
+    def get_top():
+        cfg, monitor = collector.get()
+        n, metric = get_top_args()
+        if metric not in TOP_METRICS:
+            flask.abort(400)
+        return flask.Response(OpenvpnHtmlPrinter(cfg, monitor).render_top(n, metric),
+                              mimetype='text/html')
+
+    @app.route('/api/v1/top', methods=['GET'])
+    def get_api_top():
+        cfg, monitor = collector.get()
+        n, metric = get_top_args()
+        try:
+            top = OpenvpnJsonPrinter(cfg, monitor).get_top(n, metric)
+        except ValueError as e:
+            return json_error(400, str(e))
+        return render_json(*top)
+
+    def get_history_args():
+        resolution = flask.request.args.get('resolution', 'raw')
+        if resolution not in HISTORY_RESOLUTIONS:
+            raise ValueError('unknown resolution: {0!s}'.format(resolution))
+        end = flask.request.args.get('end', time.time(), type=float)
+        start = flask.request.args.get('start', end - 3600, type=float)
+        return HISTORY_RESOLUTIONS[resolution], int(start), int(end)
+
+    @app.route('/api/v1/history/vpns/<string:vpn_id>', methods=['GET'])
+    def get_vpn_history(vpn_id):
+        if not history.enabled:
+            return json_error(404, 'history is not enabled')
+        try:
+            resolution, start, end = get_history_args()
+            samples = history.get_vpn_samples(vpn_id, resolution, start, end)
+        except ValueError as e:
+            return json_error(400, str(e))
+        except sqlite3.Error as e:
+            return json_error(500, str(e))
+        return flask.jsonify({'samples': samples})
+
+    @app.route('/api/v1/history/sessions', methods=['GET'])
+    def get_session_history():
+        if not history.enabled:
+            return json_error(404, 'history is not enabled')
+        limit = flask.request.args.get('limit', 1000, type=int)
+        try:
+            resolution, start, end = get_history_args()
+            samples = history.get_session_samples(
+                resolution, start, end, vpn=flask.request.args.get('vpn'),
+                common_name=flask.request.args.get('common_name'),
+                limit=min(max(limit, 1), 10000))
+        except ValueError as e:
+            return json_error(400, str(e))
+        except sqlite3.Error as e:
+            return json_error(500, str(e))
+        return flask.jsonify({'samples': samples})
+
+    @app.route('/api/v1/users/<string:user>/sessions', methods=['GET'])
+    def get_user_sessions(user):
+        if not event_log.enabled:
+            return json_error(404, 'event log is not enabled')
+        cfg, monitor = collector.get()
+        end = flask.request.args.get('end', time.time(), type=float)
+        start = flask.request.args.get('start', end - 86400, type=float)
+        sessions = event_log.get_user_sessions(user, start, end, monitor.vpns)
+        return flask.jsonify({'sessions': sessions})
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        cfg, monitor = collector.get()
+        return flask.Response(OpenvpnMetricsPrinter(cfg, monitor).render(),
+                              mimetype='text/plain; version=0.0.4')
+
     @app.route('/images/flags/<string:filename>', methods=['GET'])
     def get_images(filename):
         return flask.send_from_directory('images/flags', filename)
@@ -791,7 +3009,6 @@ if __name__.startswith('_mod_wsgi_') or \
         debug = False
         config = './openvpn-monitor.conf'
 
-    wsgi_output = ''
     application = monitor_wsgi()
 
 
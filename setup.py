@@ -40,6 +40,8 @@ setup(
     keywords='web openvpn monitor',
     url='http://openvpn-monitor.openbytes.ie',
     py_modules=['openvpn-monitor', ],
+    packages=['util'],
+    package_dir={'util': 'src/util'},
     install_requires=install_requires,
     long_description=long_description,
     data_files=data_files,
@@ -0,0 +1,157 @@
+"""
+COMMAND -- status 3
+-------------------
+
+Client sessions are listed in the CLIENT_LIST section of the status output, the columns of which are named by the
+preceding HEADER line and vary between OpenVPN versions:
+
+  2.3: Common Name, Real Address, Virtual Address, Bytes Received, Bytes Sent, Connected Since,
+       Connected Since (time_t), Username
+  2.4: as 2.3 plus Virtual IPv6 Address (after Virtual Address), Client ID and Peer ID
+  2.5: as 2.4 plus Data Channel Cipher
+
+The ROUTING_TABLE section that follows gives the time each client was last heard from in its Last Ref columns.
+
+Fields are kept as the strings read from the socket and only converted to IP address or datetime objects when
+first accessed, as most sessions of a large server are never looked at individually.
+"""
+
+import datetime
+from ipaddress import ip_address, IPv6Address
+
+_UNSET = object()
+
+
+class Session:
+    __slots__ = (
+        'common_name',
+        'real_address',  # Remote address of client, optionally with port as addr:port or addr(port)
+        'virtual_address',
+        'virtual_v6_address',
+        'bytes_recv',
+        'bytes_sent',
+        'connected_since_t',  # Unix timestamp string
+        'raw_username',
+        'client_id',
+        'peer_id',
+        'last_ref_t',  # Unix timestamp string from routing table
+        '_remote',
+        '_local_ip',
+    )
+
+    def __init__(self,
+                 common_name=None,
+                 real_address=None,
+                 virtual_address=None,
+                 virtual_v6_address=None,
+                 bytes_recv=0,
+                 bytes_sent=0,
+                 connected_since_t=None,
+                 raw_username=None,
+                 client_id=None,
+                 peer_id=None,
+                 last_ref_t=None):
+        self.common_name = common_name
+        self.real_address = real_address
+        self.virtual_address = virtual_address
+        self.virtual_v6_address = virtual_v6_address
+        self.bytes_recv = bytes_recv
+        self.bytes_sent = bytes_sent
+        self.connected_since_t = connected_since_t
+        self.raw_username = raw_username
+        self.client_id = client_id
+        self.peer_id = peer_id
+        self.last_ref_t = last_ref_t
+        self._remote = _UNSET
+        self._local_ip = _UNSET
+
+    @classmethod
+    def from_env(cls, client_id, env):
+        """Create a Session from the environment of a >CLIENT:ESTABLISHED notification.
+        """
+        address = env.get('trusted_ip') or env.get('trusted_ip6')
+        port = env.get('trusted_port')
+        if address and port:
+            # status output writes IPv6 addresses with the port in brackets
+            address = '{}({})'.format(address, port) if ':' in address else '{}:{}'.format(address, port)
+        return cls(common_name=env.get('common_name'),
+                   real_address=address,
+                   virtual_address=env.get('ifconfig_pool_remote_ip'),
+                   virtual_v6_address=env.get('ifconfig_pool_remote_ip6'),
+                   bytes_recv=int(env.get('bytes_received', 0)),
+                   bytes_sent=int(env.get('bytes_sent', 0)),
+                   connected_since_t=env.get('time_unix'),
+                   raw_username=env.get('username'),
+                   client_id=client_id)
+
+    def __repr__(self):
+        return '<Session {} {} {}>'.format(self.username, self.real_address, self.virtual_address)
+
+    @property
+    def username(self):
+        """Username, or common name if client did not authenticate with a username.
+        """
+        if self.raw_username is None or self.raw_username == 'UNDEF':
+            return self.common_name
+        return self.raw_username
+
+    def _split_remote(self):
+        if self._remote is _UNSET:
+            remote = self.real_address
+            port = None
+            if remote.count(':') == 1:
+                remote, port = remote.split(':')
+            elif '(' in remote:
+                remote, port = remote.split('(')
+                port = port[:-1]
+            addr = ip_address(remote)
+            if isinstance(addr, IPv6Address) and addr.ipv4_mapped is not None:
+                addr = addr.ipv4_mapped
+            self._remote = (addr, int(port) if port else None)
+        return self._remote
+
+    @property
+    def remote_ip(self):
+        """Remote IP address of client, with IPv4-mapped IPv6 addresses unwrapped.
+        """
+        return self._split_remote()[0]
+
+    @property
+    def remote_port(self):
+        return self._split_remote()[1]
+
+    @property
+    def local_ip(self):
+        """Virtual IP address of client, IPv6 if assigned. None if no address has been assigned yet.
+        """
+        if self._local_ip is _UNSET:
+            addr = self.virtual_v6_address or self.virtual_address
+            self._local_ip = ip_address(addr) if addr else None
+        return self._local_ip
+
+    @property
+    def connected_since(self):
+        if not self.connected_since_t:
+            return None
+        return datetime.datetime.fromtimestamp(int(self.connected_since_t))
+
+    @property
+    def last_seen(self):
+        if not self.last_ref_t:
+            return None
+        return datetime.datetime.fromtimestamp(int(self.last_ref_t))
+
+
+# Column names in HEADER CLIENT_LIST line and the Session attribute each is read into
+CLIENT_LIST_COLUMNS = {
+    'Common Name': 'common_name',
+    'Real Address': 'real_address',
+    'Virtual Address': 'virtual_address',
+    'Virtual IPv6 Address': 'virtual_v6_address',
+    'Bytes Received': 'bytes_recv',
+    'Bytes Sent': 'bytes_sent',
+    'Connected Since (time_t)': 'connected_since_t',
+    'Username': 'raw_username',
+    'Client ID': 'client_id',
+    'Peer ID': 'peer_id',
+}
@@ -0,0 +1,429 @@
+"""
+Management interface multiplexer
+--------------------------------
+
+OpenVPN serves a single management client at a time. The multiplexer holds that one connection and offers the same
+line protocol to any number of local clients on a UNIX socket:
+
+  - commands from all clients are sent upstream one at a time, and each client receives the responses to its own
+  - identical 'status' commands waiting at the same time are answered from a single upstream call
+  - asynchronous notifications are passed to every client, except >STATE, >LOG, >ECHO and >BYTECOUNT notifications,
+    which only go to the clients that asked for them with 'state on', 'log on', 'echo on' or 'bytecount N'. Those
+    commands are answered by the multiplexer, which keeps each setting on upstream while any client wants it.
+  - each client is written to by its own thread, so a client that stops reading holds up nobody else. A client
+    that falls Client.queue_size responses and notifications behind is disconnected.
+
+Run with e.g.:
+
+  python src/mux.py --host 127.0.0.1 --port 5555 --listen /run/openvpn-monitor/mux.sock
+"""
+
+import os
+import queue
+import socket
+import select
+import logging
+import argparse
+import threading
+import socketserver
+import util
+from util.notifications import MULTIPLEXED
+from vpn import VPN
+
+logger = logging.getLogger(__name__)
+
+# Commands switching a kind of real-time notification on and off, and the prefix of the notifications they control
+SUBSCRIPTIONS = {
+    'state': '>STATE:',
+    'log': '>LOG:',
+    'echo': '>ECHO:',
+}
+
+# Commands followed by lines of data up to END
+MULTILINE_COMMANDS = ('client-auth', 'client-pf', 'rsa-sig', 'pk-sig', 'certificate')
+
+GREETING = '>INFO:OpenVPN Management Interface Version 1 -- ' + MULTIPLEXED
+
+
+class Client:
+    """A local client of the multiplexer.
+    Responses and notifications are queued by send() and written to the client's socket by a thread of its own.
+    """
+    queue_size = 1000  # Responses and notifications waiting to be written before the client is dropped
+    close_timeout = 5  # Seconds allowed to write what is still queued when the client is closed
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._queue = queue.Queue(self.queue_size)
+        self._writer = threading.Thread(target=self._write, name='mux-client')
+        self._writer.daemon = True
+        self.dropped = False
+        self.subscriptions = set()  # Names from SUBSCRIPTIONS switched on by the client
+        self.bytecount = 0  # Interval of byte count notifications asked for by the client
+
+    def wants(self, line):
+        """Determine if notification line should be passed to the client.
+        """
+        if line.startswith('>BYTECOUNT'):
+            return self.bytecount > 0
+        for name, prefix in SUBSCRIPTIONS.items():
+            if line.startswith(prefix):
+                return name in self.subscriptions
+        return True
+
+    def start(self):
+        self._writer.start()
+
+    def send(self, lines):
+        """Queue lines to be written to the client without waiting, dropping a client that has fallen too far behind.
+        """
+        if self.dropped:
+            return
+        try:
+            self._queue.put_nowait(lines)
+        except queue.Full:
+            logger.warning('Dropping client that has stopped reading')
+            self.drop()
+
+    def close(self):
+        """Write what is still queued, then stop the writer thread.
+        """
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            self.drop()
+        if self._writer.is_alive():
+            self._writer.join(self.close_timeout)
+            if self._writer.is_alive():
+                self.drop()
+
+    def drop(self):
+        """Disconnect the client, which fails any write it is stuck in and ends its reading of commands.
+        """
+        self.dropped = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _write(self):
+        while True:
+            lines = self._queue.get()
+            if lines is None:
+                return
+            data = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+            try:
+                self._socket.sendall(data)
+            except socket.error as e:
+                logger.debug('Failed to send to client: %s', e)
+                self.drop()
+                return
+
+
+class Flight:
+    """An upstream call shared by the clients waiting for the same command.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.lines = None
+        self.error = None
+
+
+class Multiplexer:
+    """Share the management interface of vpn between the clients connecting to a UNIX socket at path.
+    """
+    retry_interval = 5  # Seconds between attempts to reconnect upstream
+
+    def __init__(self, vpn, path):
+        self.vpn = vpn
+        self.vpn.persistent = True
+        self.vpn.on_notification = self._notify
+        self.path = path
+        self._lock = threading.Lock()  # Held while talking to the upstream interface
+        self._upstream = {}  # Notification settings of the upstream connection, by command
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+        self._flights = {}  # Flight objects by command
+        self._flights_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._server = None
+
+    # Upstream
+
+    def _connect(self):
+        """Connect upstream if not connected, applying the notification settings the clients want.
+        Must be called with _lock held.
+        """
+        if self.vpn.is_connected:
+            return True
+        try:
+            if not self.vpn.connect():
+                return False
+        except Exception as e:
+            logger.warning('Failed to connect to %s: %s', self.vpn.mgmt_address, e, exc_info=True)
+            self.vpn.error = str(e)
+            self.vpn.disconnect()
+            return False
+        self._upstream = {}
+        try:
+            self._apply()
+        except Exception as e:
+            logger.warning('Failed to set notifications on %s: %s', self.vpn.mgmt_address, e)
+            self.vpn.disconnect()
+            return False
+        return True
+
+    def _apply(self):
+        """Bring the notification settings of the upstream connection in line with what the clients want.
+        Must be called with _lock held.
+        """
+        clients = self._get_clients()
+        wanted = {}
+        for name in SUBSCRIPTIONS:
+            wanted[name] = 'on' if any(name in client.subscriptions for client in clients) else 'off'
+        intervals = [client.bytecount for client in clients if client.bytecount]
+        wanted['bytecount'] = str(min(intervals)) if intervals else '0'
+        for name, value in sorted(wanted.items()):
+            # A new connection starts with everything off
+            if self._upstream.get(name, '0' if name == 'bytecount' else 'off') != value:
+                self.vpn.send_command('{} {}'.format(name, value))
+                self._upstream[name] = value
+
+    def _run(self, cmd):
+        """Send cmd upstream and return the lines of its response.
+        """
+        with self._lock:
+            if not self._connect():
+                raise socket.error(self.vpn.error or 'Not connected')
+            try:
+                return list(self.vpn.iter_command(cmd))
+            except Exception:
+                # The connection may be part way through a response
+                self.vpn.disconnect()
+                raise
+
+    def _run_shared(self, cmd):
+        """Send cmd upstream, or wait for the response to the same command already waiting to be sent or received.
+        """
+        with self._flights_lock:
+            flight = self._flights.get(cmd)
+            leader = flight is None
+            if leader:
+                flight = self._flights[cmd] = Flight()
+        if leader:
+            try:
+                flight.lines = self._run(cmd)
+            except Exception as e:
+                # Whatever went wrong, the waiting clients must be woken with it
+                flight.error = e
+            finally:
+                with self._flights_lock:
+                    del self._flights[cmd]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.lines
+
+    def _poll(self):
+        """Keep the upstream connection open and pass on notifications that arrive between commands.
+        """
+        while not self._stopping.is_set():
+            try:
+                self._poll_once()
+            except Exception as e:
+                logger.error('Unexpected error polling %s: %s', self.vpn.mgmt_address, e, exc_info=True)
+                with self._lock:
+                    self.vpn.disconnect()
+                self._stopping.wait(self.retry_interval)
+
+    def _poll_once(self):
+        with self._lock:
+            connected = self._connect()
+        if not connected:
+            self._stopping.wait(self.retry_interval)
+            return
+        try:
+            readable, _, _ = select.select([self.vpn], [], [], 1)
+        except (ValueError, OSError):
+            # Closed by a command that failed
+            return
+        if readable:
+            with self._lock:
+                try:
+                    if self.vpn.is_connected:
+                        self.vpn.poll()
+                except socket.error as e:
+                    logger.warning('Lost connection to %s: %s', self.vpn.mgmt_address, e)
+                    self.vpn.disconnect()
+
+    def _notify(self, line):
+        """Pass a notification to the clients that want it. Called with _lock held, so only queues it.
+        """
+        for client in self._get_clients():
+            if client.wants(line):
+                client.send([line])
+
+    # Clients
+
+    def _get_clients(self):
+        with self._clients_lock:
+            return list(self._clients)
+
+    def execute(self, client, cmd):
+        """Carry out a command from client and return the lines of the response to send it.
+        """
+        name, _, args = cmd.partition(' ')
+        setting, _, history = args.partition(' ')
+        if name in SUBSCRIPTIONS and setting in ('on', 'off') and (history in ('', 'all') or history.isdigit()):
+            if setting == 'on':
+                client.subscriptions.add(name)
+            else:
+                client.subscriptions.discard(name)
+            error = self._update()
+            if error:
+                return error
+            lines = ['SUCCESS: real-time {} notification set to {}'.format(name, setting.upper())]
+            if history:
+                # As OpenVPN does for e.g. 'state on all', switch on, then show the history
+                return lines + self.execute(client, '{} {}'.format(name, history))
+            return lines
+        if name == 'bytecount' and args.isdigit():
+            client.bytecount = int(args)
+            return self._update() or ['SUCCESS: bytecount interval changed']
+        try:
+            if name == 'status':
+                lines = self._run_shared(cmd)
+            else:
+                lines = self._run(cmd)
+        except Exception as e:
+            if not isinstance(e, socket.error):
+                logger.error('Unexpected error running %s: %s', cmd, e, exc_info=True)
+            return ['ERROR: management interface unavailable ({})'.format(e)]
+        if len(lines) == 1 and (lines[0].startswith('SUCCESS:') or lines[0].startswith('ERROR:')):
+            return lines
+        return lines + ['END']
+
+    def _update(self):
+        """Apply a change of the notifications the clients want upstream, returning an error response on failure.
+        """
+        with self._lock:
+            try:
+                if self.vpn.is_connected:
+                    self._apply()
+            except Exception as e:
+                self.vpn.disconnect()
+                return ['ERROR: management interface unavailable ({})'.format(e)]
+        return None
+
+    def serve(self, sock, rfile):
+        """Serve a client connected on sock until it quits or goes away.
+        """
+        client = Client(sock)
+        client.start()
+        with self._clients_lock:
+            self._clients.add(client)
+        try:
+            client.send([GREETING])
+            for raw in rfile:
+                cmd = raw.decode('utf-8', 'replace').strip()
+                if not cmd:
+                    continue
+                if cmd in ('quit', 'exit'):
+                    break
+                if cmd.split(' ', 1)[0] in MULTILINE_COMMANDS:
+                    cmd = self._read_multiline(cmd, rfile)
+                client.send(self.execute(client, cmd))
+        except socket.error as e:
+            # Including a client dropped for falling behind
+            logger.debug('Lost client: %s', e)
+        finally:
+            with self._clients_lock:
+                self._clients.discard(client)
+            if client.subscriptions or client.bytecount:
+                self._update()
+            client.close()
+
+    @staticmethod
+    def _read_multiline(cmd, rfile):
+        lines = [cmd]
+        for raw in rfile:
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(line)
+            if line == 'END':
+                break
+        return '\n'.join(lines)
+
+    # Daemon
+
+    def start(self):
+        """Listen for clients and start passing on notifications, in background threads.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = MultiplexerServer(self.path, self)
+        for target in (self._server.serve_forever, self._poll):
+            thread = threading.Thread(target=target, name='mux')
+            thread.daemon = True
+            thread.start()
+        logger.info('Multiplexing %s on %s', self.vpn.mgmt_address, self.path)
+
+    def stop(self):
+        self._stopping.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.path)
+        with self._lock:
+            self.vpn.disconnect()
+
+
+class MultiplexerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, mux):
+        self.mux = mux
+        super().__init__(path, ClientHandler)
+
+
+class ClientHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.mux.serve(self.connection, self.rfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share an OpenVPN management interface between several clients')
+    upstream = parser.add_mutually_exclusive_group(required=True)
+    upstream.add_argument('--host', help='Host of the management interface')
+    upstream.add_argument('--socket', help='UNIX socket of the management interface')
+    parser.add_argument('--port', type=int, help='Port of the management interface')
+    parser.add_argument('--password', help='Password of the management interface, if protected by a password file')
+    parser.add_argument('--listen', required=True, help='UNIX socket to accept clients on')
+    parser.add_argument('-d', '--debug', action='store_true', help='Run in debug mode')
+    args = parser.parse_args()
+    if args.host and not args.port:
+        parser.error('--port is required with --host')
+    if args.debug:
+        util.logging.enable_debug_log()
+    else:
+        logging.basicConfig(level=logging.INFO)
+    if args.socket:
+        vpn = VPN(socket=args.socket)
+    else:
+        vpn = VPN(host=args.host, port=args.port)
+    vpn.password = args.password
+    mux = Multiplexer(vpn, args.listen)
+    mux.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mux.stop()
+
+
+if __name__ == '__main__':
+    main()
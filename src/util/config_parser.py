@@ -57,10 +57,31 @@ class ConfigParser:
                 vpn = VPN(host=host, port=port)
             vpn.name = s
             # Optional
+            vpn.password = section.get('password')
             try:
                 vpn.allow_disconnect = section.getboolean('allow_disconnect', True)
             except configparser.NoOptionError:
                 pass
+            try:
+                vpn.persistent = section.getboolean('persistent', True)
+            except configparser.NoOptionError:
+                pass
+            try:
+                vpn.event_driven = section.getboolean('event_driven', False)
+            except configparser.NoOptionError:
+                pass
+            try:
+                vpn.reconcile_interval = section.getint('reconcile_interval', 300)
+            except configparser.NoOptionError:
+                pass
+            try:
+                vpn.connect_timeout = section.getfloat('connect_timeout', 3)
+            except configparser.NoOptionError:
+                pass
+            try:
+                vpn.command_timeout = section.getfloat('command_timeout', 10)
+            except configparser.NoOptionError:
+                pass
             # Add VPN
             self.vpns.append(vpn)
 
@@ -92,4 +113,5 @@ class ConfigParser:
         vpn = VPN(host='localhost', port=5555)
         vpn.name = 'Default VPN'
         vpn.allow_disconnect = True
+        vpn.persistent = True
         self.vpns.append(vpn)
@@ -0,0 +1,93 @@
+import socket
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class LineReader:
+    """Read CRLF terminated lines from a management interface socket.
+
+    Data is received into a reusable buffer and split into lines incrementally, so a large response is
+    copied once rather than re-joined on every receive, and a line split across two receives is never
+    looked at until it is complete.
+
+    openvpn-monitor.py uses this class too.
+    """
+    bufsize = 65536
+
+    def __init__(self, sock, on_notification=None):
+        self._socket = sock
+        self._buffer = bytearray(self.bufsize)
+        self._view = memoryview(self._buffer)
+        self._partial = b''  # Incomplete line left over from the last receive
+        self._lines = deque()  # Complete lines not yet read
+        self.on_notification = on_notification  # Called with each asynchronous notification line
+        self.deadline = None  # time.monotonic() by which the data being waited for must arrive, if any
+
+    def fill(self):
+        """Receive whatever data is available on the socket, blocking until there is some or the deadline passes.
+        """
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('timed out waiting for management interface')
+            self._socket.settimeout(remaining)
+        n = self._socket.recv_into(self._buffer)
+        if n == 0:
+            raise socket.error('connection closed by management interface')
+        lines = (self._partial + self._view[:n]).split(b'\n')
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+        return n
+
+    def readline(self, prompts=()):
+        """Return the next line without its line ending.
+        A partial line matching one of prompts (e.g. b'ENTER PASSWORD:') is returned as a line too.
+        """
+        while not self._lines:
+            for prompt in prompts:
+                if self._partial.startswith(prompt):
+                    self._partial = self._partial[len(prompt):]
+                    return prompt.decode('utf-8')
+            self.fill()
+        return self._lines.popleft().rstrip(b'\r').decode('utf-8', 'replace')
+
+    def notification(self, line):
+        """Hand an asynchronous notification line to the handler, if any.
+        """
+        if self.on_notification is not None:
+            self.on_notification(line)
+        else:
+            logger.debug('Discarding notification: %s', line)
+
+    def drain(self):
+        """Pass the complete lines already received to notification().
+        Only to be called between commands, when any line received is a notification.
+        """
+        while self._lines:
+            line = self._lines.popleft().rstrip(b'\r').decode('utf-8', 'replace')
+            if line.startswith('>'):
+                self.notification(line)
+            else:
+                logger.debug('Discarding unexpected line: %s', line)
+
+    def response(self):
+        """Yield the lines of a single command response as they arrive.
+        Single line responses start with SUCCESS: or ERROR:, other responses are terminated by END, which is
+        not yielded. Asynchronous notifications (lines starting with '>') are passed to notification().
+        """
+        first = True
+        while True:
+            line = self.readline()
+            if line.startswith('>'):
+                self.notification(line)
+                continue
+            if first and (line.startswith('SUCCESS:') or line.startswith('ERROR:')):
+                yield line
+                return
+            first = False
+            if line == 'END':
+                return
+            yield line
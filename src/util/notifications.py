@@ -0,0 +1,58 @@
+"""
+Asynchronous notifications
+--------------------------
+
+Lines starting with '>' may arrive from the management interface at any time, including in the middle of a command
+response. Those handled here are:
+
+  >STATE:{time},{state},{desc},...   -- real-time state change, enabled with 'state on'. Fields as for 'state'.
+  >CLIENT:{event},{CID}[,{KID}]      -- client lifecycle event (CONNECT, REAUTH, ESTABLISHED, DISCONNECT),
+  >CLIENT:ENV,{name}={value}            followed by the client's environment, ending with >CLIENT:ENV,END
+  >CLIENT:ADDRESS,{CID},{ADDR},{PRI} -- single line, no environment
+
+OpenVPN only sends >CLIENT notifications when run with --management-client-auth, in which case it also waits for
+the management client to answer each CONNECT and REAUTH with client-auth or client-deny.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MULTIPLEXED = 'multiplexed by openvpn-monitor'  # In the greeting of an interface shared through mux.py
+
+
+class NotificationParser:
+    """Assemble notification lines into events and pass them to handlers.
+    An instance is used as the on_notification callback of a LineReader.
+    """
+
+    def __init__(self, on_client=None, on_state=None):
+        self.on_client = on_client  # Called with (event, client_id, env) once a client's environment is complete
+        self.on_state = on_state  # Called with the list of fields of a >STATE line
+        self._client = None  # (event, client_id, env) of a >CLIENT notification awaiting the end of its environment
+
+    def __call__(self, line):
+        if line.startswith('>CLIENT:ENV,'):
+            if self._client is None:
+                logger.debug('Discarding client environment outside client notification: %s', line)
+                return
+            env = line[len('>CLIENT:ENV,'):]
+            if env == 'END':
+                event, client_id, values = self._client
+                self._client = None
+                if self.on_client is not None:
+                    self.on_client(event, client_id, values)
+            else:
+                name, _, value = env.partition('=')
+                self._client[2][name] = value
+        elif line.startswith('>CLIENT:'):
+            parts = line[len('>CLIENT:'):].split(',')
+            if parts[0] == 'ADDRESS':
+                logger.debug('Discarding notification: %s', line)
+            else:
+                self._client = (parts[0], parts[1] if len(parts) > 1 else None, {})
+        elif line.startswith('>STATE:'):
+            if self.on_state is not None:
+                self.on_state(line[len('>STATE:'):].split(','))
+        else:
+            logger.debug('Discarding notification: %s', line)
@@ -0,0 +1,72 @@
+from operator import itemgetter
+from models.session import Session, CLIENT_LIST_COLUMNS
+from util.errors import ParseError
+
+REQUIRED_COLUMNS = ('common_name', 'real_address', 'bytes_recv', 'bytes_sent')
+# Order of values returned by a row getter, matching Session.__init__ arguments
+ROW_FIELDS = ('common_name', 'real_address', 'virtual_address', 'virtual_v6_address', 'bytes_recv', 'bytes_sent',
+              'connected_since_t', 'raw_username', 'client_id', 'peer_id')
+
+
+def client_list_getter(header):
+    """Build a function pulling the Session fields out of a split CLIENT_LIST row.
+    header is the split HEADER CLIENT_LIST line. Columns missing from this OpenVPN version are read from a None
+    appended to the row.
+    """
+    index = {}
+    for i, name in enumerate(header):
+        attr = CLIENT_LIST_COLUMNS.get(name)
+        if attr is not None:
+            # Data rows have one less leading field ('CLIENT_LIST' rather than 'HEADER', 'CLIENT_LIST')
+            index[attr] = i - 1
+    missing = [c for c in REQUIRED_COLUMNS if c not in index]
+    if missing:
+        raise ParseError('Missing columns in CLIENT_LIST header: {}'.format(', '.join(missing)))
+    return itemgetter(*[index.get(f, -1) for f in ROW_FIELDS])
+
+
+def iter_sessions(lines):
+    """Yield a Session for each CLIENT_LIST row of status 3 output as the lines arrive.
+    Last Ref times come from the routing table after the client list, so are filled in on sessions that have
+    already been yielded.
+    """
+    getter = None
+    route_address = route_last_ref = None
+    by_address = {}
+    for line in lines:
+        if line.startswith('CLIENT_LIST\t'):
+            if getter is None:
+                raise ParseError('CLIENT_LIST row found before its HEADER')
+            parts = line.split('\t')
+            parts.append(None)
+            (common_name, real_address, virtual_address, virtual_v6_address, bytes_recv, bytes_sent,
+             connected_since_t, raw_username, client_id, peer_id) = getter(parts)
+            session = Session(common_name, real_address, virtual_address, virtual_v6_address,
+                              int(bytes_recv), int(bytes_sent), connected_since_t, raw_username, client_id, peer_id)
+            if virtual_address:
+                by_address[virtual_address] = session
+            if virtual_v6_address:
+                by_address[virtual_v6_address] = session
+            yield session
+        elif line.startswith('ROUTING_TABLE\t'):
+            if route_address is None:
+                continue
+            parts = line.split('\t')
+            session = by_address.get(parts[route_address])
+            if session is not None:
+                session.last_ref_t = parts[route_last_ref]
+        elif line.startswith('HEADER\t'):
+            header = line.split('\t')
+            if header[1] == 'CLIENT_LIST':
+                getter = client_list_getter(header)
+            elif header[1] == 'ROUTING_TABLE' and 'Last Ref (time_t)' in header:
+                route_address = header.index('Virtual Address') - 1
+                route_last_ref = header.index('Last Ref (time_t)') - 1
+        elif line == 'END':
+            break
+
+
+def parse_sessions(lines):
+    """Parse status 3 output into a list of Session objects.
+    """
+    return list(iter_sessions(lines))
@@ -1,9 +1,16 @@
 import logging
 import socket
+import select
 import re
+import time
 import contextlib
+from collections import OrderedDict
 import util
 from util.errors import MonitorError, ParseError
+from util.line_reader import LineReader
+from util.notifications import NotificationParser, MULTIPLEXED
+from util.status_parser import parse_sessions
+from models.session import Session
 from models.state import State
 from models.stats import ServerStats
 
@@ -21,14 +28,29 @@ class VPN:
     _mgmt_socket = None  # Management interface UNIX socket
     _type = None  # VPNType object to choose between IP (host:port) and socket
     _socket = None
+    _reader = None  # LineReader for the socket
     error = None  # Error if thrown when trying to connect to management interface
 
     name = None  # VPN name from config
     _release = None  # OpenVPN release string
+    _mgmt_version = None  # Management interface protocol version
+    _commands = None  # Set of management interface commands supported by the daemon
+    _up_since = None  # Start time of the daemon the release and commands were cached from
     _state = None  # State object
     stats = ServerStats()  # Stats object
-    sessions = []  # Client sessions
+    _sessions = None  # List of Session objects
     allow_disconnect = False  # Allow disconnect via API
+    password = None  # Password of the management interface, if it asks for one
+    persistent = True  # Keep management interface socket open between connection() contexts, as by default in config
+    connect_timeout = 3  # Seconds allowed to connect and receive the greeting
+    on_notification = None  # Called with each asynchronous notification line, unless event_driven
+    command_timeout = 10  # Seconds allowed for the whole response to each command
+    event_driven = False  # Maintain sessions from client notifications rather than dumping status on every read
+    reconcile_interval = 300  # Seconds between full status dumps in event-driven mode
+    _client_sessions = None  # Sessions by client ID, maintained from notifications in event-driven mode
+    _reconciled = None  # time.monotonic() of the last full status dump in event-driven mode
+    _pending = None  # Client notifications received during a full status dump, applied after it
+    _multiplexed = False  # Connected through the multiplexer, where another client may answer client-auth
 
     def __init__(self,
                  host=None,
@@ -66,30 +88,77 @@ class VPN:
             return str(self._mgmt_socket)
 
     def connect(self):
-        """Connect to management interface socket.
+        """Connect to management interface socket, reusing an existing healthy connection.
         """
+        if self.is_connected:
+            if self.is_alive():
+                return True
+            logger.info('Management interface connection to %s lost, reconnecting', self.mgmt_address)
+            self._close()
         try:
             if self.type == VPNType.IP:
-                self._socket = socket.create_connection((self._mgmt_host, self._mgmt_port), timeout=3)
+                self._socket = socket.create_connection((self._mgmt_host, self._mgmt_port),
+                                                        timeout=self.connect_timeout)
 
             else:
                 self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._socket.settimeout(self.connect_timeout)
                 self._socket.connect(self._mgmt_socket)
-            resp = self._socket_recv()
-            assert resp.startswith('>INFO'), 'Did not get expected response from interface when opening socket.'
+            self._reader = LineReader(self._socket, self.on_notification)
+            self._reader.deadline = time.monotonic() + self.connect_timeout
+            self._login()
+            if self.event_driven:
+                self._subscribe()
             return True
         except (socket.timeout, socket.error) as e:
             logger.error(e, exc_info=True)
             self.error = str(e)
+            self._close()
             return False
 
+    def _login(self):
+        """Wait for the greeting of the management interface, giving the password first if it asks for one.
+        """
+        while True:
+            resp = self._reader.readline(prompts=(b'ENTER PASSWORD:',))
+            if resp.startswith('>INFO'):
+                self._multiplexed = MULTIPLEXED in resp
+                return
+            elif resp == 'ENTER PASSWORD:':
+                if not self.password:
+                    raise socket.error('Management interface requires a password')
+                self._socket_send('{}\n'.format(self.password))
+            elif resp.startswith('ERROR'):
+                raise socket.error(resp)
+            elif not resp.startswith('SUCCESS'):
+                raise socket.error('Did not get expected response from interface when opening socket.')
+
     def disconnect(self):
         """Disconnect from management interface socket.
         """
         if self._socket is not None:
-            self._socket_send('quit\n')
+            try:
+                self._socket_send('quit\n')
+            except socket.error:
+                pass
+            self._close()
+
+    def _close(self):
+        """Close management interface socket without saying goodbye.
+        """
+        if self._socket is not None:
             self._socket.close()
             self._socket = None
+            self._reader = None
+            self._client_sessions = None
+            self._clear_capabilities()
+
+    def fileno(self):
+        """File descriptor of the management interface socket, so that a VPN can be passed to select().
+        """
+        if self._socket is None:
+            raise ValueError('Not connected to management interface')
+        return self._socket.fileno()
 
     @property
     def is_connected(self):
@@ -97,15 +166,105 @@ class VPN:
         """
         return self._socket != None
 
+    def is_alive(self):
+        """Check an open socket has not been closed by the other end.
+        Any asynchronous notifications waiting on the socket are buffered, to be handled with the next response or
+        by poll().
+        """
+        if self._socket is None:
+            return False
+        self._reader.deadline = None
+        try:
+            while True:
+                readable, _, _ = select.select([self._socket], [], [], 0)
+                if not readable:
+                    return True
+                # Buffered notifications are skipped when the next response is read
+                self._reader.fill()
+        except (socket.error, ValueError):
+            return False
+
     @contextlib.contextmanager
     def connection(self):
-        """Create context where management interface socket is open and close when done.
+        """Create context where management interface socket is open.
+        The socket is closed when done unless the VPN is persistent, in which case it is reused by the next context.
         """
         self.connect()
         try:
             yield
+        except socket.error:
+            self._close()
+            raise
+        finally:
+            if not self.persistent:
+                self.disconnect()
+
+    def subscribe(self):
+        """Switch to event-driven mode on a persistent connection.
+        Real-time state notifications are enabled with 'state on', and sessions are then maintained from
+        >CLIENT:ESTABLISHED and >CLIENT:DISCONNECT notifications, with a full 'status 3' only every
+        reconcile_interval seconds. OpenVPN only sends client notifications with --management-client-auth; without
+        it sessions are only as fresh as the last full status dump.
+        """
+        self.persistent = True
+        self.event_driven = True
+        if self.is_connected and self.is_alive():
+            self._subscribe()
+        else:
+            self.connect()
+
+    def _subscribe(self):
+        self._reader.on_notification = NotificationParser(on_client=self._on_client, on_state=self._on_state)
+        self.send_command('state on')
+        self._reconcile()
+
+    def poll(self, timeout=0):
+        """Handle the notifications received on the socket within timeout seconds.
+        """
+        self._reader.deadline = None
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        while readable:
+            self._reader.fill()
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        self._reader.drain()
+
+    def _reconcile(self):
+        """Replace the sessions maintained from notifications with those of a full status dump.
+        """
+        self._pending = []
+        try:
+            sessions = parse_sessions(self.iter_command('status 3'))
         finally:
-            self.disconnect()
+            pending, self._pending = self._pending, None
+        self._client_sessions = OrderedDict((self._session_key(s), s) for s in sessions)
+        self._reconciled = time.monotonic()
+        # Notifications that arrived during the dump may or may not be reflected in it, so apply them again
+        for event in pending:
+            self._on_client(*event)
+
+    @staticmethod
+    def _session_key(session):
+        """Key of a session in _client_sessions. Status output has no client ID before OpenVPN 2.4, so those
+        sessions can't be matched with notifications until the next full status dump.
+        """
+        return session.client_id if session.client_id is not None else session.real_address
+
+    def _on_client(self, event, client_id, env):
+        if self._pending is not None:
+            self._pending.append((event, client_id, env))
+        elif self._client_sessions is None:
+            return
+        elif event == 'ESTABLISHED':
+            self._client_sessions[client_id] = Session.from_env(client_id, env)
+        elif event == 'DISCONNECT':
+            self._client_sessions.pop(client_id, None)
+        elif event in ('CONNECT', 'REAUTH') and not self._multiplexed:
+            logger.warning('%s is waiting for client-auth for client %s, which is never answered here: '
+                           'share the interface through the multiplexer with the client that answers it',
+                           self.mgmt_address, client_id)
+
+    def _on_state(self, parts):
+        self._set_state(self._parse_state(parts))
 
     def _socket_send(self, data):
         """Convert data to bytes and send to socket.
@@ -113,24 +272,42 @@ class VPN:
         self._socket.send(bytes(data, 'utf-8'))
 
     def _socket_recv(self):
-        """Receive bytes from socket and convert to string.
+        """Receive a line from socket as a string.
         """
-        return self._socket.recv(4096).decode('utf-8')
+        return self._reader.readline()
 
-    def send_command(self, cmd):
-        """Send command to management interface and fetch response.
+    def iter_command(self, cmd):
+        """Send command to management interface and yield response lines as they arrive.
+        The generator must be exhausted before another command is sent.
         """
         logger.debug('Sending cmd: %s', cmd.strip())
         self._socket_send(cmd + '\n')
-        if cmd.startswith('kill') or cmd.startswith('client-kill'):
-            return
-        resp = self._socket_recv()
-        if cmd.strip() != 'load-stats':
-            while not resp.strip().endswith('END'):
-                resp += self._socket_recv()
+        self._reader.deadline = time.monotonic() + self.command_timeout
+        for line in self._reader.response():
+            yield line
+
+    def send_command(self, cmd):
+        """Send command to management interface and fetch response.
+        """
+        resp = '\n'.join(self.iter_command(cmd))
         logger.debug('Cmd response: %s', resp)
         return resp
 
+    def send_batch(self, cmds):
+        """Send several commands to management interface at once and fetch their responses, in order.
+        The commands are written together so the batch costs a single round trip, and the responses are told
+        apart by their framing as for send_command().
+        """
+        logger.debug('Sending cmds: %s', ', '.join(cmds))
+        self._socket_send(''.join(cmd + '\n' for cmd in cmds))
+        resps = []
+        for _ in cmds:
+            # Each response is allowed command_timeout from when it is waited for
+            self._reader.deadline = time.monotonic() + self.command_timeout
+            resps.append('\n'.join(self._reader.response()))
+        logger.debug('Cmd responses: %s', resps)
+        return resps
+
     # Interface commands and parsing
 
     @staticmethod
@@ -143,11 +320,41 @@ class VPN:
         """Get OpenVPN version from socket.
         """
         raw = self.send_command('version')
+        self._mgmt_version = self._parse_mgmt_version(raw)
+        return self._parse_version(raw)
+
+    @staticmethod
+    def _parse_version(raw):
         for line in raw.splitlines():
             if line.startswith('OpenVPN Version'):
                 return line.replace('OpenVPN Version: ', '')
         raise ParseError('Unable to get OpenVPN version, no matches found in socket response.')
 
+    @staticmethod
+    def _parse_mgmt_version(raw):
+        for line in raw.splitlines():
+            if line.startswith('Management Version:'):
+                return util.nonify_int(line.replace('Management Version:', '').strip())
+        return None
+
+    @staticmethod
+    def _parse_commands(raw):
+        """Get the names of the commands listed by 'help', one per line as 'name [args] : description'.
+        """
+        commands = set()
+        for line in raw.splitlines():
+            if ' : ' in line and not line[0].isspace():
+                commands.add(line.split(None, 1)[0])
+        return frozenset(commands)
+
+    def _clear_capabilities(self):
+        """Forget the release and commands of the daemon, which only change when it restarts.
+        """
+        self._release = None
+        self._mgmt_version = None
+        self._commands = None
+        self._up_since = None
+
     @property
     def release(self):
         """OpenVPN release string.
@@ -156,6 +363,22 @@ class VPN:
             self._release = self._get_version()
         return self._release
 
+    @property
+    def mgmt_version(self):
+        """Management interface protocol version, None if not reported.
+        """
+        if self._release is None:
+            self._release = self._get_version()
+        return self._mgmt_version
+
+    @property
+    def commands(self):
+        """Names of the management interface commands supported by the daemon.
+        """
+        if self._commands is None:
+            self._commands = self._parse_commands(self.send_command('help'))
+        return self._commands
+
     @property
     def version(self):
         """OpenVPN version number.
@@ -170,54 +393,116 @@ class VPN:
     def _get_state(self):
         """Get OpenVPN state from socket.
         """
-        raw = self.send_command('state')
+        return self._parse_state_response(self.send_command('state'))
+
+    def _parse_state_response(self, raw):
         for line in raw.splitlines():
             if self.has_prefix(line):
                 continue
             if line.strip() == 'END':
                 break
-            parts = line.split(',')
-            # 0 - Unix timestamp of server start (UTC?)
-            up_since = parts[0]
-            # 1 - Connection state
-            state_name = util.nonify_string(parts[1])
-            # 2 - Connection state description
-            desc_string = util.nonify_string(parts[2])
-            # 3 - TUN/TAP local v4 address
-            local_virtual_v4_addr = util.nonify_string(parts[3])
-            # 4 - Remote server address (client only)
-            remote_addr = util.nonify_string(parts[4])
-            # 5 - Remote server port (client only)
-            remote_port = util.nonify_int(parts[5])
-            # 6 - Local address
-            local_addr = util.nonify_string(parts[6])
-            # 7 - Local port
-            local_port = util.nonify_int(parts[7])
-            return State(up_since=up_since,
-                         state_name=state_name,
-                         desc_string=desc_string,
-                         local_virtual_v4_addr=local_virtual_v4_addr,
-                         remote_addr=remote_addr,
-                         remote_port=remote_port,
-                         local_addr=local_addr,
-                         local_port=local_port)
+            return self._parse_state(line.split(','))
+
+    @staticmethod
+    def _parse_state(parts):
+        """Create a State from the fields of a state line, as output by 'state' or in a >STATE notification.
+        """
+        # 0 - Unix timestamp of server start (UTC?)
+        up_since = parts[0]
+        # 1 - Connection state
+        state_name = util.nonify_string(parts[1])
+        # 2 - Connection state description
+        desc_string = util.nonify_string(parts[2])
+        # 3 - TUN/TAP local v4 address
+        local_virtual_v4_addr = util.nonify_string(parts[3])
+        # 4 - Remote server address (client only)
+        remote_addr = util.nonify_string(parts[4])
+        # 5 - Remote server port (client only)
+        remote_port = util.nonify_int(parts[5])
+        # 6 - Local address
+        local_addr = util.nonify_string(parts[6])
+        # 7 - Local port
+        local_port = util.nonify_int(parts[7])
+        return State(up_since=up_since,
+                     state_name=state_name,
+                     desc_string=desc_string,
+                     local_virtual_v4_addr=local_virtual_v4_addr,
+                     remote_addr=remote_addr,
+                     remote_port=remote_port,
+                     local_addr=local_addr,
+                     local_port=local_port)
 
     @property
     def state(self):
         """OpenVPN daemon state.
         """
         if self._state is None:
-            self._state = self._get_state()
+            self._set_state(self._get_state())
         return self._state
 
+    def _set_state(self, state):
+        """Cache state, and forget the release and commands of the daemon if it has restarted since they were cached.
+        """
+        if state is not None:
+            if self._up_since is not None and state.up_since != self._up_since:
+                logger.info('OpenVPN at %s restarted, clearing cached release', self.mgmt_address)
+                self._clear_capabilities()
+            self._up_since = state.up_since
+        self._state = state
+
+    def _get_sessions(self):
+        """Get client sessions from socket.
+        """
+        return parse_sessions(self.iter_command('status 3'))
+
+    @property
+    def sessions(self):
+        """Client sessions connected to the OpenVPN daemon.
+        """
+        if self.event_driven and self._client_sessions is not None:
+            try:
+                self.poll()
+                if time.monotonic() - self._reconciled >= self.reconcile_interval:
+                    self._reconcile()
+                return list(self._client_sessions.values())
+            except (socket.timeout, socket.error) as e:
+                logger.warning('Lost notifications from %s, reconnecting: %s', self.name, e)
+                sessions = list(self._client_sessions.values())
+                self._close()
+                # Resubscribing dumps status in full
+                if self.connect() and self._client_sessions is not None:
+                    return list(self._client_sessions.values())
+                # The sessions as last known, until the next read reconnects
+                return sessions
+        if self._sessions is None:
+            self._sessions = self._get_sessions()
+        return self._sessions
+
     def cache_data(self):
-        """Cached some metadata about the connection.
+        """Cache some metadata about the connection, fetching whatever is missing in a single round trip.
+        State comes first in the batch, so a release and commands fetched with it are those of the running daemon.
         """
-        _ = self.release
-        _ = self.state
+        cmds = []
+        if self._state is None:
+            cmds.append('state')
+        if self._release is None:
+            cmds.append('version')
+        if self._commands is None:
+            cmds.append('help')
+        if not cmds:
+            return
+        resps = dict(zip(cmds, self.send_batch(cmds)))
+        if 'state' in resps:
+            self._set_state(self._parse_state_response(resps['state']))
+        if 'version' in resps:
+            self._release = self._parse_version(resps['version'])
+            self._mgmt_version = self._parse_mgmt_version(resps['version'])
+        if 'help' in resps:
+            self._commands = self._parse_commands(resps['help'])
 
     def clear_cache(self):
         """Clear cached state data about connection.
+        The release and commands are kept until the daemon restarts or the connection is lost.
         """
-        self._release = None
         self._state = None
+        self._sessions = None
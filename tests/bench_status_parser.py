@@ -0,0 +1,55 @@
+"""Benchmark status 3 parsing throughput.
+
+Run from the repository root with:
+
+    PYTHONPATH=src python tests/bench_status_parser.py
+"""
+import time
+from util.status_parser import parse_sessions
+
+HEADER = ('HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\tBytes Received\t'
+          'Bytes Sent\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\tPeer ID')
+ROUTING_HEADER = 'HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\tLast Ref\tLast Ref (time_t)'
+
+
+def status_lines(clients):
+    lines = ['TITLE\tOpenVPN 2.4.4 x86_64-pc-linux-gnu', 'TIME\tSun Jun 16 22:13:21 2019\t1560719601', HEADER]
+    for i in range(clients):
+        lines.append('CLIENT_LIST\tuser{0}\t203.0.{1}.{2}:{3}\t10.{1}.{2}.{4}\t\t{5}\t{6}\tSun Jun 16 22:10:00 2019\t'
+                     '1560719400\tUNDEF\t{0}\t{0}'.format(i, i // 65536 % 256, i // 256 % 256, 1024 + i % 60000,
+                                                       i % 256, i * 1000, i * 2000))
+    lines.append(ROUTING_HEADER)
+    for i in range(clients):
+        lines.append('ROUTING_TABLE\t10.{0}.{1}.{2}\tuser{3}\t203.0.{0}.{1}:{4}\tSun Jun 16 22:13:20 2019\t'
+                     '1560719600'.format(i // 65536 % 256, i // 256 % 256, i % 256, i, 1024 + i % 60000))
+    lines.append('GLOBAL_STATS\tMax bcast/mcast queue length\t0')
+    lines.append('END')
+    return lines
+
+
+def touch(sessions):
+    """Access every lazily converted field, as rendering a full session table would.
+    """
+    for s in sessions:
+        s.remote_ip, s.local_ip, s.connected_since, s.last_seen, s.username
+
+
+def bench(clients, repeat=3):
+    lines = status_lines(clients)
+    best_parse = best_full = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sessions = parse_sessions(lines)
+        parsed = time.perf_counter()
+        touch(sessions)
+        done = time.perf_counter()
+        assert len(sessions) == clients
+        best_parse = min(best_parse or parsed - start, parsed - start)
+        best_full = min(best_full or done - start, done - start)
+    print('{0:>7} clients: parse {1:>10,.0f} rows/s ({2:.3f}s), parse + convert all fields {3:>10,.0f} rows/s '
+          '({4:.3f}s)'.format(clients, clients / best_parse, best_parse, clients / best_full, best_full))
+
+
+if __name__ == '__main__':
+    for n in (10000, 100000):
+        bench(n)
@@ -0,0 +1,55 @@
+import os
+import sys
+import socket
+import importlib.util
+
+MONITOR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'openvpn-monitor.py')
+
+
+def load_monitor():
+    """Import openvpn-monitor.py, which can't be imported by name because of the hyphen.
+    It is loaded once and shared by all tests, so tests must reset any of its global state they change.
+    """
+    module = sys.modules.get('openvpn_monitor')
+    if module is None:
+        spec = importlib.util.spec_from_file_location('openvpn_monitor', MONITOR_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['openvpn_monitor'] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+class FakeSocket:
+    """Socket stand-in returning a fixed list of chunks from recv_into(), then EOF, or a timeout if hang is set.
+    """
+
+    def __init__(self, chunks, hang=False):
+        self.chunks = list(chunks)
+        self.hang = hang
+        self.sent = []
+        self.timeout = None
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            if self.hang:
+                raise socket.timeout('timed out')
+            return 0
+        chunk = self.chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
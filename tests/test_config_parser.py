@@ -27,6 +27,7 @@ class TestConfigParser(unittest.TestCase):
         self.assertEqual(vpn.name, 'Default VPN')
         self.assertEqual(vpn.mgmt_address, 'localhost:5555')
         self.assertEqual(vpn.allow_disconnect, True)
+        self.assertEqual(vpn.persistent, True)
 
     def test_file_not_exists(self):
         """Test parsing non-existant config file raises and InvalidConfigError.
@@ -99,14 +100,21 @@ class TestConfigParser(unittest.TestCase):
         vpn = [v for v in cp.vpns if v.name == 'A VPN'][0]
         self.assertEqual(vpn.mgmt_address, '/asd/asd/asd')
         self.assertEqual(vpn.allow_disconnect, False)
+        self.assertEqual(vpn.persistent, True)
         # Another VPN
         vpn = [v for v in cp.vpns if v.name == 'Another VPN'][0]
         self.assertEqual(vpn.mgmt_address, '1.2.3.4:5678')
         self.assertEqual(vpn.allow_disconnect, True)
+        self.assertEqual(vpn.persistent, False)
+        self.assertEqual(vpn.event_driven, False)
+        self.assertEqual(vpn.command_timeout, 2.5)
         # All the VPNs
         vpn = [v for v in cp.vpns if v.name == 'All the VPNs'][0]
         self.assertEqual(vpn.mgmt_address, '/asd/asd.sock')
         self.assertEqual(vpn.allow_disconnect, True)
+        self.assertEqual(vpn.event_driven, True)
+        self.assertEqual(vpn.reconcile_interval, 60)
+        self.assertEqual(vpn.command_timeout, 10)
         # So many !"£$%^&*()'
         vpn = [v for v in cp.vpns if v.name == 'So many !"£$%^&*()\''][0]
         self.assertEqual(vpn.mgmt_address, 'localhost:1234')
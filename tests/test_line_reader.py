@@ -0,0 +1,72 @@
+import socket
+import time
+import unittest
+from util.line_reader import LineReader
+from helpers import FakeSocket, load_monitor
+
+
+class TestLineReader(unittest.TestCase):
+
+    def test_readline_across_chunks(self):
+        reader = LineReader(FakeSocket([b'one\r\ntw', b'o\r', b'\nthree\r\n']))
+        self.assertEqual('one', reader.readline())
+        self.assertEqual('two', reader.readline())
+        self.assertEqual('three', reader.readline())
+
+    def test_readline_eof(self):
+        reader = LineReader(FakeSocket([b'partial']))
+        with self.assertRaises(socket.error):
+            reader.readline()
+
+    def test_readline_prompt(self):
+        reader = LineReader(FakeSocket([b'ENTER PASSWORD:']))
+        self.assertEqual('ENTER PASSWORD:', reader.readline(prompts=(b'ENTER PASSWORD:',)))
+
+    def test_readline_multibyte_split(self):
+        data = 'Zoë\r\n'.encode('utf-8')
+        reader = LineReader(FakeSocket([data[:3], data[3:]]))
+        self.assertEqual('Zoë', reader.readline())
+
+    def test_response_end(self):
+        reader = LineReader(FakeSocket([b'OpenVPN Version: OpenVPN 2.4.4\r\nManagement Version: 1\r\nEN', b'D\r\nnext\r\n']))
+        self.assertEqual(['OpenVPN Version: OpenVPN 2.4.4', 'Management Version: 1'], list(reader.response()))
+        self.assertEqual('next', reader.readline())
+
+    def test_response_single_line(self):
+        reader = LineReader(FakeSocket([b'SUCCESS: nclients=0,bytesin=0,bytesout=0\r\nERROR: unknown command\r\n']))
+        self.assertEqual(['SUCCESS: nclients=0,bytesin=0,bytesout=0'], list(reader.response()))
+        self.assertEqual(['ERROR: unknown command'], list(reader.response()))
+
+    def test_response_notifications(self):
+        notifications = []
+        reader = LineReader(FakeSocket([b'>INFO:hello\r\n1560719601,CONNECTED\r\n>STATE:1560719602,EXITING\r\nEND\r\n']),
+                            on_notification=notifications.append)
+        self.assertEqual(['1560719601,CONNECTED'], list(reader.response()))
+        self.assertEqual(['>INFO:hello', '>STATE:1560719602,EXITING'], notifications)
+
+    def test_drain(self):
+        notifications = []
+        reader = LineReader(FakeSocket([b'>CLIENT:DISCONNECT,1\r\nstray\r\n>CLIENT:ENV,END\r\n>STATE:15']),
+                            on_notification=notifications.append)
+        reader.fill()
+        reader.drain()
+        self.assertEqual(['>CLIENT:DISCONNECT,1', '>CLIENT:ENV,END'], notifications)
+
+    def test_deadline(self):
+        sock = FakeSocket([b'TITLE\tOpenVPN 2.4.4\r\n', b'END\r\n'])
+        reader = LineReader(sock)
+        reader.deadline = time.monotonic() + 60
+        self.assertEqual('TITLE\tOpenVPN 2.4.4', reader.readline())
+        self.assertGreater(sock.timeout, 0)
+        reader.deadline = time.monotonic() - 1
+        with self.assertRaises(socket.timeout):
+            reader.readline()
+        self.assertEqual(1, len(sock.chunks))
+
+
+class TestMonitorLineReader(unittest.TestCase):
+
+    def test_shared(self):
+        """Test openvpn-monitor.py reads from the management interface with this LineReader.
+        """
+        self.assertIs(LineReader, load_monitor().LineReader)
@@ -0,0 +1,183 @@
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import patch, PropertyMock
+from mux import Client, Multiplexer
+from vpn import VPN
+from helpers import FakeSocket
+
+
+class FakeClientSocket:
+
+    def __init__(self, reading=True):
+        self.sent = []
+        self.reading = threading.Event()  # Cleared while the client is not reading, which blocks sendall()
+        if reading:
+            self.reading.set()
+        self.closed = False
+
+    def sendall(self, data):
+        self.reading.wait()
+        if self.closed:
+            raise socket.error('Broken pipe')
+        self.sent.append(data)
+
+    def shutdown(self, how):
+        self.closed = True
+        self.reading.set()
+
+
+class TestMultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        self.mux = Multiplexer(VPN(host='localhost', port=1234), '/tmp/test_mux.sock')
+
+    def add_client(self, reading=True):
+        client = Client(FakeClientSocket(reading))
+        client.start()
+        self.addCleanup(client.close)
+        self.mux._clients.add(client)
+        return client
+
+    def test_response_framing(self):
+        client = self.add_client()
+        with patch.object(self.mux, '_run') as mock_run:
+            mock_run.return_value = ['OpenVPN Version: OpenVPN 2.4.4', 'Management Version: 1']
+            self.assertEqual(['OpenVPN Version: OpenVPN 2.4.4', 'Management Version: 1', 'END'],
+                             self.mux.execute(client, 'version'))
+            mock_run.return_value = ["SUCCESS: common name 'bob' found, 1 client(s) killed"]
+            self.assertEqual(["SUCCESS: common name 'bob' found, 1 client(s) killed"], self.mux.execute(client, 'kill bob'))
+            mock_run.return_value = []
+            self.assertEqual(['END'], self.mux.execute(client, 'log all'))
+            mock_run.side_effect = socket.error('Connection refused')
+            self.assertEqual(['ERROR: management interface unavailable (Connection refused)'],
+                             self.mux.execute(client, 'version'))
+
+    def test_status_shared(self):
+        """Test concurrent identical status commands are answered from a single upstream call.
+        """
+        calls = []
+        started = threading.Event()
+
+        def run(cmd):
+            calls.append(cmd)
+            started.set()
+            time.sleep(0.2)
+            return ['TITLE\tOpenVPN 2.4.4']
+
+        client = self.add_client()
+        results = []
+        with patch.object(self.mux, '_run', side_effect=run):
+            first = threading.Thread(target=lambda: results.append(self.mux.execute(client, 'status 3')))
+            first.start()
+            started.wait()
+            others = [threading.Thread(target=lambda: results.append(self.mux.execute(client, 'status 3')))
+                      for _ in range(3)]
+            for thread in others:
+                thread.start()
+            for thread in [first] + others:
+                thread.join()
+            self.assertEqual(['status 3'], calls)
+            self.assertEqual([['TITLE\tOpenVPN 2.4.4', 'END']] * 4, results)
+            # Once answered, the next status is sent upstream again
+            self.mux.execute(client, 'status 3')
+            self.assertEqual(['status 3', 'status 3'], calls)
+
+    @patch('vpn.VPN.is_connected', new_callable=PropertyMock)
+    @patch('vpn.VPN.send_command')
+    def test_subscriptions(self, mock_send_command, mock_is_connected):
+        """Test notifications are switched on upstream while any client wants them, and only passed to those clients.
+        """
+        mock_is_connected.return_value = True
+        first = self.add_client()
+        second = self.add_client()
+        self.assertEqual(['SUCCESS: real-time state notification set to ON'], self.mux.execute(first, 'state on'))
+        self.assertEqual(['SUCCESS: real-time state notification set to ON'], self.mux.execute(second, 'state on'))
+        self.assertEqual(['SUCCESS: bytecount interval changed'], self.mux.execute(second, 'bytecount 5'))
+        self.assertEqual(['SUCCESS: bytecount interval changed'], self.mux.execute(first, 'bytecount 2'))
+        self.assertEqual(['state on', 'bytecount 5', 'bytecount 2'], [c[0][0] for c in mock_send_command.call_args_list])
+        mock_send_command.reset_mock()
+        self.mux.execute(first, 'state off')
+        mock_send_command.assert_not_called()
+        self.mux._notify('>STATE:1560719602,RECONNECTING,SIGHUP,,,,,')
+        self.mux._notify('>CLIENT:DISCONNECT,0')
+        first.close()
+        second.close()
+        self.assertEqual([b'>CLIENT:DISCONNECT,0\r\n'], first._socket.sent)
+        self.assertEqual([b'>STATE:1560719602,RECONNECTING,SIGHUP,,,,,\r\n', b'>CLIENT:DISCONNECT,0\r\n'],
+                         second._socket.sent)
+        self.mux._clients.discard(second)
+        self.mux._update()
+        self.assertEqual(['state off'], [c[0][0] for c in mock_send_command.call_args_list])
+
+    @patch('vpn.VPN.is_connected', new_callable=PropertyMock)
+    @patch('vpn.VPN.send_command')
+    def test_subscription_history(self, mock_send_command, mock_is_connected):
+        """Test 'state on all' switches notifications on for the client, then shows the history from upstream.
+        """
+        mock_is_connected.return_value = True
+        client = self.add_client()
+        with patch.object(self.mux, '_run', return_value=['1560719602,CONNECTED,SUCCESS,10.8.0.1,,,,']) as mock_run:
+            self.assertEqual(['SUCCESS: real-time state notification set to ON', '1560719602,CONNECTED,SUCCESS,10.8.0.1,,,,',
+                              'END'], self.mux.execute(client, 'state on all'))
+            mock_run.assert_called_once_with('state all')
+        self.assertEqual({'state'}, client.subscriptions)
+        self.assertEqual({'state': 'on'}, {k: v for k, v in self.mux._upstream.items() if v == 'on'})
+        mock_send_command.assert_called_once_with('state on')
+
+    def test_unexpected_error(self):
+        """Test any error from upstream is answered with an error and wakes the clients waiting for the same status.
+        """
+        client = self.add_client()
+        with patch.object(self.mux, '_run', side_effect=AssertionError('Unexpected greeting')):
+            self.assertEqual(['ERROR: management interface unavailable (Unexpected greeting)'],
+                             self.mux.execute(client, 'status 3'))
+        self.assertEqual({}, self.mux._flights)
+        with patch('vpn.VPN.connect', side_effect=AssertionError('Unexpected greeting')):
+            with self.mux._lock:
+                self.assertFalse(self.mux._connect())
+        self.assertEqual('Unexpected greeting', self.mux.vpn.error)
+
+    def test_client_not_reading(self):
+        """Test a client that stops reading holds up neither notifications nor other clients, and is dropped once
+        too far behind.
+        """
+        stuck = self.add_client(reading=False)
+        stuck.subscriptions.add('state')
+        other = self.add_client()
+        with self.mux._lock:
+            # As when passing on notifications received from upstream
+            for _ in range(Client.queue_size + 2):
+                self.mux._notify('>STATE:1560719602,CONNECTED,SUCCESS,10.8.0.1,,,,')
+        self.assertTrue(stuck.dropped)
+        with patch.object(self.mux.vpn, 'iter_command', return_value=iter(['OpenVPN Version: OpenVPN 2.4.4'])), \
+                patch.object(self.mux, '_connect', return_value=True):
+            other.send(self.mux.execute(other, 'version'))
+        other.close()
+        self.assertEqual([b'OpenVPN Version: OpenVPN 2.4.4\r\nEND\r\n'], other._socket.sent)
+
+
+class TestLogin(unittest.TestCase):
+
+    def setUp(self):
+        self.vpn = VPN(host='localhost', port=1234)
+
+    def connect(self, *chunks):
+        sock = FakeSocket(chunks)
+        with patch('socket.create_connection', return_value=sock):
+            connected = self.vpn.connect()
+        return connected, sock
+
+    def test_password(self):
+        self.vpn.password = 'secret'
+        connected, sock = self.connect(b'ENTER PASSWORD:', b'SUCCESS: password is correct\r\n',
+                                       b'>INFO:OpenVPN Management Interface Version 1\r\n')
+        self.assertTrue(connected)
+        self.assertEqual([b'secret\n'], sock.sent)
+
+    def test_password_missing(self):
+        connected, sock = self.connect(b'ENTER PASSWORD:')
+        self.assertFalse(connected)
+        self.assertEqual('Management interface requires a password', self.vpn.error)
+        self.assertFalse(self.vpn.is_connected)
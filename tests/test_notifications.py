@@ -0,0 +1,37 @@
+import unittest
+from util.notifications import NotificationParser
+
+
+class TestNotificationParser(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = []
+        self.states = []
+        self.parser = NotificationParser(on_client=lambda *args: self.clients.append(args),
+                                         on_state=self.states.append)
+
+    def test_client_environment(self):
+        for line in ['>CLIENT:ESTABLISHED,7',
+                     '>CLIENT:ENV,common_name=bob',
+                     '>CLIENT:ENV,trusted_ip=1.2.3.4',
+                     '>CLIENT:ENV,password=a=b',
+                     '>CLIENT:ENV,END']:
+            self.parser(line)
+        self.assertEqual([('ESTABLISHED', '7', {'common_name': 'bob', 'trusted_ip': '1.2.3.4', 'password': 'a=b'})],
+                         self.clients)
+
+    def test_client_kid(self):
+        for line in ['>CLIENT:CONNECT,3,1', '>CLIENT:ENV,END', '>CLIENT:DISCONNECT,3', '>CLIENT:ENV,END']:
+            self.parser(line)
+        self.assertEqual([('CONNECT', '3', {}), ('DISCONNECT', '3', {})], self.clients)
+
+    def test_ignored(self):
+        for line in ['>CLIENT:ADDRESS,3,10.0.0.2,1', '>CLIENT:ENV,common_name=bob', '>INFO:hello',
+                     '>BYTECOUNT:1,2']:
+            self.parser(line)
+        self.assertEqual([], self.clients)
+        self.assertEqual([], self.states)
+
+    def test_state(self):
+        self.parser('>STATE:1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194')
+        self.assertEqual([['1560719601', 'CONNECTED', 'SUCCESS', '10.0.0.1', '', '', '1.2.3.4', '1194']], self.states)
@@ -0,0 +1,1012 @@
+import os
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+from datetime import datetime
+from ipaddress import ip_address
+from types import SimpleNamespace
+from unittest.mock import patch
+from helpers import FakeSocket, load_monitor
+
+monitor = load_monitor()
+
+GREETING = b'>INFO:OpenVPN Management Interface Version 1 -- type \'help\' for more info\r\n'
+VERSION = b'OpenVPN Version: OpenVPN 2.4.4 x86_64-pc-linux-gnu\r\nManagement Version: 1\r\nEND\r\n'
+HELP = (b'Management Interface for OpenVPN 2.4.4 x86_64-pc-linux-gnu\r\nCommands:\r\n'
+        b'client-kill CID [M]    : Kill client instance CID with message M (def=RESTART)\r\n'
+        b'kill cn                : Kill the client instance(s) having common name cn.\r\nEND\r\n')
+STATE = b'1560719601,CONNECTED,SUCCESS,10.8.0.1,,,,\r\nEND\r\n'
+LOAD_STATS = b'SUCCESS: nclients=1,bytesin=556794,bytesout=1483013\r\n'
+STATUS = (b'TITLE\tOpenVPN 2.4.4 x86_64-pc-linux-gnu\r\nTIME\tSun Jun 16 22:14:10 2019\t1560719650\r\n'
+          b'HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\t'
+          b'Bytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\tPeer ID\r\n'
+          b'CLIENT_LIST\tbob\t192.168.1.2:1194\t10.8.0.2\t\t100\t200\tSun Jun 16 22:13:21 2019\t1560719601\tUNDEF'
+          b'\t0\t0\r\n'
+          b'HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\tLast Ref\tLast Ref (time_t)\r\n'
+          b'ROUTING_TABLE\t10.8.0.2\tbob\t192.168.1.2:1194\tSun Jun 16 22:14:00 2019\t1560719640\r\n'
+          b'GLOBAL_STATS\tMax bcast/mcast queue length\t0\r\nEND\r\n')
+
+
+def get_config(**settings):
+    """Configuration of a single VPN, as loaded by ConfigLoader.
+    """
+    settings = dict({'geoip_data': '/nonexistent/GeoLite2-City.mmdb',
+                     'datetime_format': '%d/%m/%Y %H:%M:%S'}, **settings)
+    vpns = OrderedDict([('test', {'name': 'Test VPN', 'host': 'localhost', 'port': '5555',
+                                  'show_disconnect': False})])
+    return SimpleNamespace(settings=settings, vpns=vpns)
+
+
+class MonitorTestCase(unittest.TestCase):
+    """Collects from a fake management interface, forgetting everything collected afterwards.
+    """
+
+    def setUp(self):
+        self.sock = FakeSocket([GREETING, VERSION, HELP, STATE, LOAD_STATS, STATUS])
+        for target, value in (('openvpn_monitor.socket.create_connection', self.sock),
+                              ('openvpn_monitor.select.select', ([], [], []))):
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        monitor.connections.close_all()
+        monitor.breakers.retain([])
+        monitor.last_good.data.clear()
+        monitor.throughput.rings.clear()
+        monitor.session_rates.previous.clear()
+        monitor.bytecounts.counters.clear()
+        monitor.fragments.retain([])
+        monitor.connections.set_event_driven(False, 300)
+
+    def collect(self, *chunks, **settings):
+        """Collect with the fake interface sending chunks after whatever it still has to send.
+        """
+        self.sock.chunks.extend(chunks)
+        return monitor.OpenvpnMgmtInterface(get_config(**settings)).vpns['test']
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_get_boolean(self):
+        """Test boolean settings accept what configparser accepts.
+        """
+        for value in ('True', 'true', 'yes', 'on', '1'):
+            self.assertTrue(monitor.get_boolean({'persistent_connections': value}, 'persistent_connections', False))
+        for value in ('False', 'false', 'no', 'off', '0'):
+            self.assertFalse(monitor.get_boolean({'persistent_connections': value}, 'persistent_connections', True))
+        self.assertTrue(monitor.get_boolean({}, 'persistent_connections', True))
+        self.assertTrue(monitor.get_boolean({'persistent_connections': 'sometimes'}, 'persistent_connections', True))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    @patch('openvpn_monitor.time.time')
+    def test_max_age(self, mock_time):
+        """Test a result is reused for max_age seconds however the wall clock moves.
+        """
+        calls = []
+        flight = monitor.SingleFlight(max_age=60)
+        mock_time.return_value = 1000
+        self.assertEqual(1, flight.do(lambda: calls.append(1) or len(calls)))
+        mock_time.return_value = 0
+        self.assertEqual(1, flight.do(lambda: calls.append(1) or len(calls)))
+        flight.max_age = 0
+        flight.finished -= 1
+        self.assertEqual(2, flight.do(lambda: calls.append(1) or len(calls)))
+
+
+class TestCollectAll(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = monitor.OpenvpnMgmtInterface.__new__(monitor.OpenvpnMgmtInterface)
+        self.interface.vpns = OrderedDict((key, {'name': key}) for key in ('slow', 'medium', 'fast'))
+        self.interface.request_timeout = 15
+        self.addCleanup(monitor.breakers.retain, [])
+
+    def test_concurrent(self):
+        """Test VPNs are polled at the same time, and each result is merged into its own VPN in config order
+        whichever finishes first.
+        """
+        barrier = threading.Barrier(3, timeout=5)
+        delays = {'slow': 0.2, 'medium': 0.1, 'fast': 0}
+        finished = []
+
+        def collect_vpn(key, vpn, deadline):
+            barrier.wait()
+            time.sleep(delays[key])
+            finished.append(key)
+            return {'polled': key, 'thread': threading.current_thread().name}
+
+        self.interface.collect_vpn = collect_vpn
+        self.interface.collect_all(10)
+        self.assertEqual(['fast', 'medium', 'slow'], finished)
+        self.assertEqual(['slow', 'medium', 'fast'], list(self.interface.vpns))
+        self.assertEqual([(key, key) for key in self.interface.vpns],
+                         [(key, vpn['polled']) for key, vpn in self.interface.vpns.items()])
+        self.assertEqual(3, len(set(vpn['thread'] for vpn in self.interface.vpns.values())))
+
+    def test_invalid_concurrency(self):
+        """Test an invalid concurrency polls one VPN at a time.
+        """
+        self.interface.collect_vpn = lambda key, vpn, deadline: {'thread': threading.current_thread().name}
+        self.interface.collect_all('many')
+        self.assertEqual(1, len(set(vpn['thread'] for vpn in self.interface.vpns.values())))
+
+
+class TestCollector(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config_file = os.path.join(directory.name, 'openvpn-monitor.conf')
+        self.collections = []
+        for target, side_effect in (('collect', self.collect), ('record', None)):
+            patcher = patch.object(monitor.Collector, target, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def collect(self, **kwargs):
+        self.collections.append(SimpleNamespace(vpns={}, collected=datetime.now()))
+        return None, self.collections[-1]
+
+    def get_collector(self, refresh_interval):
+        with open(self.config_file, 'w') as f:
+            f.write('[openvpn-monitor]\nrefresh_interval={0!s}\n'.format(refresh_interval))
+        return monitor.Collector(self.config_file)
+
+    def test_snapshot(self):
+        """Test requests are served the snapshot of the background thread until a refresh replaces it.
+        """
+        collector = self.get_collector(60)
+        # the thread stops after its next sleep
+        self.addCleanup(setattr, collector, 'interval', 0)
+        first = collector.get()
+        self.assertEqual((None, self.collections[0]), first)
+        self.assertIs(first, collector.get())
+        self.assertTrue(collector.thread.is_alive())
+        second = collector.refresh()
+        self.assertIsNot(first, second)
+        self.assertIs(second, collector.get())
+        self.assertEqual(2, len(self.collections))
+
+    def test_on_request(self):
+        """Test without a background thread or a coalesce window each request collects.
+        """
+        collector = self.get_collector(0)
+        collector.get()
+        collector.get()
+        self.assertEqual(2, len(self.collections))
+        self.assertIsNone(collector.thread)
+
+
+class TestDeadlines(MonitorTestCase):
+
+    def test_get_deadline(self):
+        conn = monitor.MgmtConnection({'host': 'localhost', 'port': '5555'})
+        now = time.monotonic()
+        self.assertAlmostEqual(now + 10, conn.get_deadline(10), delta=1)
+        conn.deadline = now + 1
+        self.assertEqual(now + 1, conn.get_deadline(10))
+
+    def test_stale(self):
+        """Test a VPN that stops answering part way through is shown from its last data, marked as stale.
+        """
+        vpn = self.collect()
+        self.assertTrue(vpn['socket_connected'])
+        self.assertNotIn('stale_since', vpn)
+        fresh = (monitor.OpenvpnJsonPrinter.get_vpn_version(vpn), vpn['digest'])
+        # status 3 never finishes
+        self.sock.hang = True
+        stale = self.collect(STATE, LOAD_STATS, STATUS[:100])
+        self.assertTrue(stale['socket_connected'])
+        self.assertIsNotNone(stale['stale_since'])
+        self.assertEqual('timed out', stale['error'])
+        self.assertEqual(fresh[1], stale['digest'])
+        self.assertEqual(['bob'], [session['common_name'] for session in stale['sessions'].values()])
+        # the ETag and cached panel change with the stale marker
+        self.assertNotEqual(fresh[0], monitor.OpenvpnJsonPrinter.get_vpn_version(stale))
+        html = ''.join(monitor.OpenvpnHtmlPrinter(get_config(), SimpleNamespace(
+            vpns={'test': stale}, collected=stale['stale_since'])).render())
+        self.assertIn('stale since', html)
+
+
+class TestHtmlPrinter(MonitorTestCase):
+
+    def render(self, vpn, collected):
+        monitor_data = SimpleNamespace(vpns={'test': vpn}, collected=collected)
+        return ''.join(monitor.OpenvpnHtmlPrinter(get_config(), monitor_data).render())
+
+    def test_streamed(self):
+        """Test the page is yielded a panel at a time, each rendered only once it is asked for.
+        """
+        vpn = self.collect()
+        monitor_data = SimpleNamespace(vpns={'test': vpn}, collected=datetime.now())
+        chunks = monitor.OpenvpnHtmlPrinter(get_config(), monitor_data).render()
+        with patch.object(monitor.vpn_template, 'render', return_value='panel') as mock_render:
+            self.assertTrue(next(chunks).startswith('<!doctype html>'))
+            mock_render.assert_not_called()
+            self.assertEqual('panel', next(chunks))
+            self.assertIn('Last update', next(chunks))
+            self.assertEqual([], list(chunks))
+
+    def test_unchanged_panel_cached(self):
+        """Test the panel of a VPN whose data has not changed is not rendered again by the next collection.
+        """
+        self.collect()
+        first = self.collect(STATE, LOAD_STATS, STATUS)
+        second = self.collect(STATE, LOAD_STATS, STATUS)
+        collected = (datetime(2019, 6, 16, 22, 14, 10), datetime(2019, 6, 16, 22, 14, 20))
+        timestamps = [str(monitor.get_timestamp(dt)) for dt in collected]
+        with patch.object(monitor.vpn_template, 'render', wraps=monitor.vpn_template.render) as mock_render:
+            html = self.render(first, collected[0])
+            self.assertEqual(html.replace(timestamps[0], timestamps[1]).replace('22:14:10', '22:14:20'),
+                             self.render(second, collected[1]))
+            self.assertEqual(1, mock_render.call_count)
+        # Time Online is worked out in the page, up to the time of the collection
+        self.assertIn('<td class="time-online" data-since="1560719601"></td>', html)
+        self.assertIn('id="last-update" data-collected="{0!s}"'.format(timestamps[0]), html)
+
+
+def get_vpn(sessions=()):
+    """Collected data of a server VPN with the given sessions.
+    """
+    return {'name': 'Test VPN', 'socket_connected': True, 'show_disconnect': False, 'digest': 'abc',
+            'release': 'OpenVPN 2.4.4 x86_64-pc-linux-gnu', 'throughput': None,
+            'state': {'mode': 'Server', 'connected': 'CONNECTED', 'success': 'SUCCESS',
+                      'up_since': datetime.fromtimestamp(1560719601), 'local_ip': ip_address('10.8.0.1'),
+                      'remote_ip': ''},
+            'stats': {'nclients': len(sessions), 'bytesin': 556794, 'bytesout': 1483013},
+            'sessions': OrderedDict((str(session['local_ip']), session) for session in sessions)}
+
+
+def get_session(n, bytes_recv=0, bytes_sent=0, bps_recv=None, bps_sent=None):
+    return {'common_name': 'client{}'.format(n), 'username': 'client{}'.format(n),
+            'local_ip': ip_address('10.8.0.{}'.format(n)), 'remote_ip': ip_address('192.168.1.{}'.format(n)),
+            'port': 1194, 'connected_since': datetime(2019, 6, 16, 22, 13, 21), 'client_id': str(n),
+            'bytes_recv': bytes_recv, 'bytes_sent': bytes_sent, 'bps_recv': bps_recv, 'bps_sent': bps_sent}
+
+
+class AppTestCase(unittest.TestCase):
+    """Requests pages from the Flask app, served from self.vpns.
+    """
+
+    def setUp(self):
+        monitor.args = SimpleNamespace(config='/nonexistent/openvpn-monitor.conf')
+        self.addCleanup(delattr, monitor, 'args')
+        self.vpns = OrderedDict()
+        self.cfg = get_config()
+        patcher = patch.object(monitor.Collector, 'get',
+                               side_effect=lambda: (self.cfg, SimpleNamespace(vpns=self.vpns,
+                                                                              collected=datetime.now())))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = monitor.monitor_wsgi().test_client()
+
+
+class TestJsonApi(AppTestCase):
+
+    def test_sessions_cursor(self):
+        """Test following next_cursor returns every session once, in order.
+        """
+        self.vpns['test'] = get_vpn([get_session(n) for n in range(1, 9)])
+        names = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get('/api/v1/vpns/test/sessions', query_string={'limit': 3, 'cursor': cursor})
+            self.assertEqual(200, response.status_code)
+            page = response.get_json()
+            self.assertLessEqual(len(page['sessions']), 3)
+            names.extend(session['common_name'] for session in page['sessions'])
+            cursor = page['next_cursor']
+        self.assertEqual(['client{}'.format(n) for n in range(1, 9)], names)
+        self.assertEqual(400, self.client.get('/api/v1/vpns/test/sessions?cursor=%21%21').status_code)
+        self.assertEqual(404, self.client.get('/api/v1/vpns/other/sessions').status_code)
+
+    def test_stale(self):
+        """Test a VPN shown from earlier data is reported as not connected, with its data and the error.
+        """
+        self.vpns['test'] = dict(get_vpn([get_session(1)]), stale_since=datetime(2019, 6, 16, 22, 14, 10),
+                                 error='timed out')
+        vpn = self.client.get('/api/v1/vpns').get_json()['vpns'][0]
+        self.assertFalse(vpn['socket_connected'])
+        self.assertEqual('timed out', vpn['error'])
+        self.assertEqual(556794, vpn['stats']['bytesin'])
+        self.assertIsNotNone(vpn['stale_since'])
+
+    def test_cursor_round_trip(self):
+        for key in ('10.8.0.1', 'fd00::1', 'client/ü'):
+            self.assertEqual(key, monitor.decode_cursor(monitor.encode_cursor(key)))
+        with self.assertRaises(ValueError):
+            monitor.decode_cursor('MTAuOC4wLjE=x')
+
+    def test_not_modified(self):
+        """Test a request with the ETag of the current data gets a 304, until the data changes.
+        """
+        self.vpns['test'] = get_vpn([get_session(1)])
+        response = self.client.get('/api/v1/vpns')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Test VPN', response.get_json()['vpns'][0]['name'])
+        etag = response.headers['ETag']
+        response = self.client.get('/api/v1/vpns', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.data)
+        self.assertEqual(etag, response.headers['ETag'])
+        self.vpns['test']['digest'] = 'def'
+        response = self.client.get('/api/v1/vpns', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+
+EXPOSITION = """\
+# HELP openvpn_up Whether the management interface could be polled.
+# TYPE openvpn_up gauge
+openvpn_up{vpn="test",name="Test VPN"} 1
+openvpn_up{vpn="down",name="Down VPN"} 0
+# HELP openvpn_state Connection state of the VPN, 1 for the current state.
+# TYPE openvpn_state gauge
+openvpn_state{vpn="test",name="Test VPN",state="CONNECTED"} 1
+# HELP openvpn_up_since_seconds Time the VPN reached its current state, in seconds since the epoch.
+# TYPE openvpn_up_since_seconds gauge
+openvpn_up_since_seconds{vpn="test",name="Test VPN"} 1560719601
+# HELP openvpn_clients Number of connected clients.
+# TYPE openvpn_clients gauge
+openvpn_clients{vpn="test",name="Test VPN"} 1
+# HELP openvpn_bytes_in_total Bytes received by the VPN.
+# TYPE openvpn_bytes_in_total counter
+openvpn_bytes_in_total{vpn="test",name="Test VPN"} 556794
+# HELP openvpn_bytes_out_total Bytes sent by the VPN.
+# TYPE openvpn_bytes_out_total counter
+openvpn_bytes_out_total{vpn="test",name="Test VPN"} 1483013
+"""
+
+SESSION_EXPOSITION = """\
+# HELP openvpn_session_bytes_received_total Bytes received from a client.
+# TYPE openvpn_session_bytes_received_total counter
+openvpn_session_bytes_received_total{vpn="test",name="Test VPN",username="a\\"b\\\\c",local_ip="10.8.0.2",remote_ip="192.168.1.2"} 100
+# HELP openvpn_session_bytes_sent_total Bytes sent to a client.
+# TYPE openvpn_session_bytes_sent_total counter
+openvpn_session_bytes_sent_total{vpn="test",name="Test VPN",username="a\\"b\\\\c",local_ip="10.8.0.2",remote_ip="192.168.1.2"} 200
+"""
+
+GEOIP_EXPOSITION = """\
+# HELP openvpn_geoip_cache_hits_total GeoIP lookups answered from the cache.
+# TYPE openvpn_geoip_cache_hits_total counter
+openvpn_geoip_cache_hits_total {0:d}
+# HELP openvpn_geoip_cache_misses_total GeoIP lookups made in the database.
+# TYPE openvpn_geoip_cache_misses_total counter
+openvpn_geoip_cache_misses_total 1
+# HELP openvpn_geoip_cache_entries Client addresses in the GeoIP cache.
+# TYPE openvpn_geoip_cache_entries gauge
+openvpn_geoip_cache_entries 1
+"""
+
+
+class TestMetrics(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        monitor.exposition.retain([])
+        self.addCleanup(monitor.exposition.retain, [])
+        patcher = patch.object(monitor.geoip, 'cache', monitor.GeoipCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lookup()
+
+    def lookup(self):
+        self.cache.get(ip_address('198.51.100.1'), lambda ip: {'country': 'GB'})
+
+    def test_exposition(self):
+        session = get_session(2, bytes_recv=100, bytes_sent=200)
+        session['username'] = 'a"b\\c'
+        self.vpns['test'] = get_vpn([session])
+        self.vpns['down'] = {'name': 'Down VPN', 'socket_connected': False, 'error': 'Connection refused'}
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response.headers['Content-Type'])
+        self.assertEqual(EXPOSITION + GEOIP_EXPOSITION.format(0), response.get_data(as_text=True))
+        # Sessions are only exported when asked for
+        self.cfg.settings['metrics_client_labels'] = 'yes'
+        self.assertEqual(EXPOSITION + SESSION_EXPOSITION + GEOIP_EXPOSITION.format(0),
+                         self.client.get('/metrics').get_data(as_text=True))
+
+    def test_geoip_cache(self):
+        """Test the shared exposition is rendered again when the GeoIP cache counts change.
+        """
+        self.vpns['test'] = get_vpn()
+        self.assertTrue(self.client.get('/metrics').get_data(as_text=True).endswith(GEOIP_EXPOSITION.format(0)))
+        self.lookup()
+        self.assertTrue(self.client.get('/metrics').get_data(as_text=True).endswith(GEOIP_EXPOSITION.format(1)))
+
+    def test_stale(self):
+        """Test a VPN shown from earlier data is down, with the time of that data and nothing else.
+        """
+        stale_since = datetime(2019, 6, 16, 22, 14, 10)
+        self.vpns['test'] = dict(get_vpn(), stale_since=stale_since, error='timed out')
+        self.assertEqual('# HELP openvpn_up Whether the management interface could be polled.\n'
+                         '# TYPE openvpn_up gauge\n'
+                         'openvpn_up{{vpn="test",name="Test VPN"}} 0\n'
+                         '# HELP openvpn_stale_since_seconds Time the last data of a VPN that could not be polled '
+                         'was collected, in seconds since the epoch.\n'
+                         '# TYPE openvpn_stale_since_seconds gauge\n'
+                         'openvpn_stale_since_seconds{{vpn="test",name="Test VPN"}} {0:d}\n'.format(
+                             int(time.mktime(stale_since.timetuple()))) + GEOIP_EXPOSITION.format(0),
+                         self.client.get('/metrics').get_data(as_text=True))
+
+
+class TestGeoipDatabase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'GeoLite2-City.mmdb')
+        with open(self.path, 'wb') as f:
+            f.write(b'first')
+        patcher = patch.object(monitor.GeoipDatabase, 'open', side_effect=lambda path: (object(), 2))
+        self.mock_open = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reopen(self):
+        """Test the reader is shared until the file is replaced, and the cached lookups go with it.
+        """
+        geoip = monitor.GeoipDatabase()
+        gi = geoip.get(self.path)[0]
+        self.assertIs(gi, geoip.get(self.path)[0])
+        self.assertEqual(1, self.mock_open.call_count)
+        geoip.cache.get('192.0.2.1', lambda ip: {'country': 'GB'})
+        with open(self.path + '.new', 'wb') as f:
+            f.write(b'second')
+        os.rename(self.path + '.new', self.path)
+        self.assertIsNot(gi, geoip.get(self.path)[0])
+        self.assertEqual(2, self.mock_open.call_count)
+        self.assertEqual(0, len(geoip.cache.entries))
+
+
+class TestGeoipCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = monitor.GeoipCache(size=2, ttl=60)
+        self.lookups = []
+        patcher = patch('openvpn_monitor.time.time', return_value=1000)
+        self.mock_time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def lookup(self, ip):
+        self.lookups.append(ip)
+        # addresses missing from the database have no location
+        return {'country': 'GB'} if ip != '192.0.2.3' else {}
+
+    def get(self, *ips):
+        return [self.cache.get(ip, self.lookup) for ip in ips]
+
+    def test_lru(self):
+        """Test the least recently used address is evicted, and each get counts as a hit or a miss.
+        """
+        self.get('192.0.2.1', '192.0.2.2', '192.0.2.1', '192.0.2.3')
+        self.assertEqual(['192.0.2.1', '192.0.2.3'], list(self.cache.entries))
+        self.get('192.0.2.3', '192.0.2.2')
+        self.assertEqual(['192.0.2.1', '192.0.2.2', '192.0.2.3', '192.0.2.2'], self.lookups)
+        self.assertEqual((2, 4, 2), self.cache.get_stats())
+
+    def test_miss_cached(self):
+        """Test an address with no location is not looked up again until it expires.
+        """
+        self.assertEqual([{}, {}], self.get('192.0.2.3', '192.0.2.3'))
+        self.assertEqual(['192.0.2.3'], self.lookups)
+        self.mock_time.return_value = 1060
+        self.assertEqual([{}], self.get('192.0.2.3'))
+        self.assertEqual(['192.0.2.3', '192.0.2.3'], self.lookups)
+        self.assertEqual((1, 2, 1), self.cache.get_stats())
+
+
+class TestThroughput(unittest.TestCase):
+
+    def test_ring_wraps(self):
+        """Test only the latest size samples are kept, and rates are worked out from them.
+        """
+        ring = monitor.StatsRing(3)
+        self.assertIsNone(ring.get_throughput())
+        for n in range(5):
+            ring.append(10 * n, n, 1000 * n, 2000 * n)
+        self.assertEqual(3, len(ring))
+        self.assertEqual(20, ring.times[ring.index(0)])
+        self.assertEqual(40, ring.times[ring.index(-1)])
+        self.assertEqual({'bps_in': 800, 'bps_out': 1600, 'avg_bps_in': 800, 'avg_bps_out': 1600,
+                          'clients_avg': 3.0, 'clients_change': 2, 'samples': 3}, ring.get_throughput())
+
+    def test_restart(self):
+        """Test the samples of a VPN are forgotten when its counters go backwards.
+        """
+        history = monitor.ThroughputHistory(samples=60)
+        self.assertIsNone(history.add('test', 0, {'nclients': 1, 'bytesin': 1000, 'bytesout': 1000}))
+        throughput = history.add('test', 10, {'nclients': 2, 'bytesin': 2000, 'bytesout': 1500})
+        self.assertEqual((800, 400, 1), (throughput['bps_in'], throughput['bps_out'], throughput['clients_change']))
+        self.assertIsNone(history.add('test', 20, {'nclients': 1, 'bytesin': 10, 'bytesout': 1600}))
+        throughput = history.add('test', 30, {'nclients': 1, 'bytesin': 110, 'bytesout': 1700})
+        self.assertEqual((80, 80, 2), (throughput['bps_in'], throughput['bps_out'], throughput['samples']))
+        history.samples = 10
+        self.assertIsNone(history.add('test', 40, {'nclients': 1, 'bytesin': 210, 'bytesout': 1800}))
+
+
+class TestSessionRates(unittest.TestCase):
+
+    def update(self, rates, ts, *sessions):
+        digest = hashlib.sha1()
+        rates.update('test', ts, OrderedDict(enumerate(sessions)), digest)
+        return [(session['bps_recv'], session['bps_sent']) for session in sessions], digest.hexdigest()
+
+    def test_rates(self):
+        """Test rates from the change in each session's counters, and none when they go backwards.
+        """
+        rates = monitor.SessionRates()
+        self.assertEqual([(None, None)], self.update(rates, 100, get_session(1, 1000, 2000))[0])
+        self.assertEqual([(800, 1600)], self.update(rates, 110, get_session(1, 2000, 4000))[0])
+        # Counters reset
+        self.assertEqual([(None, None)], self.update(rates, 120, get_session(1, 500, 4500))[0])
+        self.assertEqual([(400, 400)], self.update(rates, 130, get_session(1, 1000, 5000))[0])
+        # Reconnected with the same client ID
+        session = get_session(1, 2000, 6000)
+        session['connected_since'] = datetime(2019, 6, 16, 23, 0, 0)
+        self.assertEqual([(None, None)], self.update(rates, 140, session)[0])
+
+    def test_without_client_id(self):
+        """Test sessions are matched by remote address and port before OpenVPN 2.4.
+        """
+        rates = monitor.SessionRates()
+        first, second = get_session(1, 1000, 1000), get_session(2, 1000, 1000)
+        for session in (first, second):
+            del session['client_id']
+        self.update(rates, 100, first, second)
+        first, second = dict(first, bytes_recv=2000), dict(second, bytes_recv=3000, port=1195)
+        result, digest = self.update(rates, 110, first, second)
+        self.assertEqual([(800, 0), (None, None)], result)
+        # The digest changes with the rates
+        self.assertNotEqual(digest, self.update(monitor.SessionRates(), 110, first, second)[1])
+
+
+class TestTopSessions(AppTestCase):
+
+    def test_ranking(self):
+        """Test sessions are ranked across VPNs, with those without a rate yet ranking as 0.
+        """
+        self.vpns['first'] = get_vpn([get_session(1, 100, 0, 10, 20), get_session(2, 300, 0, None, None)])
+        self.vpns['second'] = get_vpn([get_session(3, 200, 50, 40, 0)])
+        self.vpns['down'] = {'name': 'Down VPN', 'socket_connected': False, 'error': 'Connection refused'}
+        client = get_vpn()
+        client['state']['mode'] = 'Client'
+        client['sessions']['Client'] = {'tuntap_read': 1000}
+        self.vpns['client'] = client
+
+        def top(n, metric):
+            return [(vpn_id, session['common_name'])
+                    for vpn_id, session in monitor.get_top_sessions(self.vpns, n, metric)]
+        self.assertEqual([('second', 'client3'), ('first', 'client1'), ('first', 'client2')], top(5, 'bps'))
+        self.assertEqual([('first', 'client1')], top(1, 'bps_sent'))
+        self.assertEqual([('first', 'client2'), ('second', 'client3')], top(2, 'bytes'))
+        with self.assertRaises(ValueError):
+            monitor.get_top_sessions(self.vpns, 5, 'nclients')
+        response = self.client.get('/api/v1/top?n=1&metric=bytes_sent')
+        self.assertEqual([('second', 'client3')],
+                         [(s['vpn_id'], s['common_name']) for s in response.get_json()['sessions']])
+        self.assertEqual(400, self.client.get('/api/v1/top?metric=nclients').status_code)
+
+
+class TestByteCounts(unittest.TestCase):
+
+    def test_rates(self):
+        """Test rates from consecutive notifications of each counter, and none once a counter goes backwards.
+        """
+        counts = monitor.ByteCounts()
+        counts.interval = 5
+        counts.notify('test', '>BYTECOUNT_CLI:1,1000,2000', 100)
+        counts.notify('test', '>BYTECOUNT_CLI:2,1000,2000', 100)
+        self.assertEqual({}, counts.get_rates('test', 100))
+        counts.notify('test', '>BYTECOUNT_CLI:1,2000,4000', 105)
+        counts.notify('test', '>BYTECOUNT_CLI:2,500,3000', 105)
+        counts.notify('test', '>BYTECOUNT_CLI:3,malformed', 105)
+        self.assertEqual({'1': (1600, 3200)}, counts.get_rates('test', 105))
+        counts.notify('test', '>BYTECOUNT_CLI:2,1000,3500', 110)
+        self.assertEqual({'1': (1600, 3200), '2': (800, 800)}, counts.get_rates('test', 110))
+        # Counters not updated for two intervals are forgotten
+        self.assertEqual({'2': (800, 800)}, counts.get_rates('test', 116.5))
+        self.assertEqual({}, counts.get_rates('other', 116.5))
+
+    def test_apply(self):
+        """Test live rates replace those of the sessions, and the VPN's throughput once every session has one.
+        """
+        counts = monitor.ByteCounts()
+        counts.interval = 5
+        now = time.time()
+        vpn = get_vpn([get_session(1, bps_recv=1, bps_sent=1), get_session(2, bps_recv=1, bps_sent=1)])
+        vpn['throughput'] = {'bps_in': 2, 'bps_out': 2, 'avg_bps_in': 2, 'avg_bps_out': 2}
+        for line in ('>BYTECOUNT_CLI:1,1000,2000', '>BYTECOUNT_CLI:2,0,0'):
+            counts.notify('test', line, now - 5)
+        counts.notify('test', '>BYTECOUNT_CLI:1,2000,4000', now)
+        counts.apply('test', vpn, hashlib.sha1())
+        sessions = list(vpn['sessions'].values())
+        self.assertEqual([(1600, 3200), (1, 1)], [(s['bps_recv'], s['bps_sent']) for s in sessions])
+        self.assertEqual(2, vpn['throughput']['bps_in'])
+        counts.notify('test', '>BYTECOUNT_CLI:2,500,0', now)
+        counts.apply('test', vpn, hashlib.sha1())
+        self.assertEqual({'bps_in': 2400, 'bps_out': 3200, 'avg_bps_in': 2, 'avg_bps_out': 2}, vpn['throughput'])
+
+
+class TestCapabilities(MonitorTestCase):
+
+    def test_restart(self):
+        """Test the release and commands are cached with the connection until the daemon restarts.
+        """
+        vpn = self.collect()
+        self.assertEqual([b'version\nhelp\nstate\nload-stats\nstatus 3\n'], self.sock.sent)
+        self.assertEqual('OpenVPN 2.4.4 x86_64-pc-linux-gnu', vpn['release'])
+        # Disconnecting a client uses the cached commands
+        self.sock.chunks.extend([b'SUCCESS: client-kill command succeeded\r\n', STATE, LOAD_STATS, STATUS])
+        monitor.OpenvpnMgmtInterface(get_config(), vpn_id='test', client_id='0')
+        self.assertEqual([b'client-kill 0\n', b'state\nload-stats\nstatus 3\n'], self.sock.sent[1:])
+        del self.sock.sent[:]
+        restarted = STATE.replace(b'1560719601', b'1560723201')
+        vpn = self.collect(restarted, LOAD_STATS, STATUS, VERSION.replace(b'2.4.4', b'2.4.5'), HELP)
+        self.assertEqual([b'state\nload-stats\nstatus 3\n', b'version\nhelp\n'], self.sock.sent)
+        self.assertEqual('OpenVPN 2.4.5 x86_64-pc-linux-gnu', vpn['release'])
+        del self.sock.sent[:]
+        vpn = self.collect(restarted, LOAD_STATS, STATUS)
+        self.assertEqual([b'state\nload-stats\nstatus 3\n'], self.sock.sent)
+        self.assertEqual('OpenVPN 2.4.5 x86_64-pc-linux-gnu', vpn['release'])
+
+
+class TestCircuitBreakers(MonitorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.breakers = monitor.CircuitBreakers()
+        self.breakers.configure({'breaker_threshold': '3', 'breaker_backoff': '5', 'breaker_max_backoff': '30'})
+        self.vpn = {'name': 'Test VPN', 'host': 'localhost', 'port': '5555'}
+        timer_patcher = patch('openvpn_monitor.threading.Timer')
+        self.mock_timer = timer_patcher.start()
+        self.addCleanup(timer_patcher.stop)
+        # No jitter
+        jitter_patcher = patch('openvpn_monitor.random.uniform', return_value=1)
+        jitter_patcher.start()
+        self.addCleanup(jitter_patcher.stop)
+
+    def probe(self, error=None):
+        with patch.object(monitor.connections, 'connection', side_effect=error):
+            self.breakers.probe('test', self.vpn)
+
+    def test_threshold(self):
+        """Test a breaker opens after threshold consecutive failures, and a success starts the count again.
+        """
+        self.breakers.failure('test', self.vpn, 'Connection refused')
+        self.breakers.success('test')
+        for _ in range(2):
+            self.breakers.failure('test', self.vpn, 'Connection refused')
+        self.assertEqual({'state': 'closed', 'failures': 2, 'error': 'Connection refused', 'retry_at': None},
+                         self.breakers.get_info('test'))
+        self.mock_timer.assert_not_called()
+        self.breakers.failure('test', self.vpn, 'Connection refused')
+        self.assertEqual('open', self.breakers.get_info('test')['state'])
+        self.mock_timer.assert_called_once_with(5, self.breakers.probe, ('test', self.vpn))
+        self.mock_timer.return_value.start.assert_called_once_with()
+
+    def test_backoff(self):
+        """Test the backoff doubles with each failed probe up to max_backoff, and a probe that connects closes the
+        breaker.
+        """
+        for _ in range(3):
+            self.breakers.failure('test', self.vpn, 'Connection refused')
+        self.probe(socket.error('Connection refused'))
+        self.probe(socket.timeout('timed out'))
+        # Failures other than socket errors are retried too
+        self.probe(AssertionError('unexpected greeting'))
+        self.probe(socket.error('Connection refused'))
+        self.assertEqual([5, 10, 20, 30, 30], [c[0][0] for c in self.mock_timer.call_args_list])
+        info = self.breakers.get_info('test')
+        self.assertEqual(('open', 7), (info['state'], info['failures']))
+        self.probe()
+        self.assertEqual({'state': 'closed', 'failures': 0, 'error': None, 'retry_at': None},
+                         self.breakers.get_info('test'))
+        self.mock_timer.return_value.cancel.assert_called_once_with()
+        # Only an open breaker is probed
+        with patch.object(monitor.connections, 'connection') as mock_connection:
+            self.breakers.probe('test', self.vpn)
+            mock_connection.assert_not_called()
+
+    def test_retain(self):
+        for key in ('test', 'removed'):
+            for _ in range(3):
+                self.breakers.failure(key, self.vpn, 'Connection refused')
+        self.breakers.retain(['test'])
+        self.assertEqual('open', self.breakers.get_info('test')['state'])
+        self.assertEqual('closed', self.breakers.get_info('removed')['state'])
+        self.assertEqual(1, self.mock_timer.return_value.cancel.call_count)
+
+    def test_open_shows_last_good(self):
+        """Test a VPN whose breaker is open is shown from its last data without connecting, if there is any.
+        """
+        self.collect()
+        del self.sock.sent[:]
+        for _ in range(3):
+            monitor.breakers.failure('test', self.vpn, 'timed out')
+        vpn = self.collect()
+        self.assertEqual([], self.sock.sent)
+        self.assertTrue(vpn['socket_connected'])
+        self.assertIsNotNone(vpn['stale_since'])
+        self.assertEqual(('open', 'timed out'), (vpn['breaker']['state'], vpn['error']))
+        monitor.last_good.data.clear()
+        vpn = self.collect()
+        self.assertFalse(vpn['socket_connected'])
+        self.assertEqual('open', vpn['breaker']['state'])
+
+    def test_stale_panel(self):
+        """Test the panel of a VPN shown from its last data says when its breaker retries, and is rendered again
+        as that changes.
+        """
+        self.collect()
+        for _ in range(3):
+            monitor.breakers.failure('test', self.vpn, 'timed out')
+        vpn = self.collect()
+        printer = monitor.OpenvpnHtmlPrinter(get_config(), SimpleNamespace(vpns={'test': vpn},
+                                                                           collected=vpn['stale_since']))
+        retry_at = vpn['breaker']['retry_at'].strftime(printer.datetime_format)
+        self.assertIn('Failed 3 times in a row, retrying at {0!s}'.format(retry_at), ''.join(printer.render()))
+        with patch.object(monitor.connections, 'connection', side_effect=socket.error('Connection refused')):
+            monitor.breakers.probe('test', self.vpn)
+        self.assertNotEqual(printer.get_vpn_version(vpn), printer.get_vpn_version(self.collect()))
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    start = 1560729600  # Midnight UTC, so the start of a minute, hour and day
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.history = monitor.HistoryStore()
+        self.history.configure({'history_db': os.path.join(directory.name, 'history.db')})
+        self.addCleanup(self.history.close)
+
+    def add(self, offset, bytes_recv, bytesin=556794):
+        vpn = get_vpn([get_session(1, bytes_recv=bytes_recv)])
+        vpn['stats']['bytesin'] = bytesin
+        self.history.add(self.start + offset, {'test': vpn})
+
+    def get_sessions(self, resolution):
+        return [(sample['ts'] - self.start, sample['bytes_recv'])
+                for sample in self.history.get_session_samples(resolution, 0, self.start * 2)]
+
+    def test_rollup(self):
+        """Test a minute is rolled up once the next has started, from the samples within it.
+        """
+        for offset, count in ((0, 100), (30, 200), (59, 300)):
+            self.add(offset, count, bytesin=count)
+        self.assertEqual([], self.history.get_vpn_samples('test', 60, 0, self.start * 2))
+        self.add(60, 400, bytesin=400)
+        samples = self.history.get_vpn_samples('test', 60, 0, self.start * 2)
+        self.assertEqual([(self.start, 300)], [(sample['ts'], sample['bytesin']) for sample in samples])
+        self.assertEqual([(0, 300)], self.get_sessions(60))
+        # The hour isn't complete yet
+        self.assertEqual([], self.history.get_vpn_samples('test', 3600, 0, self.start * 2))
+        self.add(3600, 500, bytesin=500)
+        samples = self.history.get_vpn_samples('test', 3600, 0, self.start * 2)
+        self.assertEqual([(self.start, 400)], [(sample['ts'], sample['bytesin']) for sample in samples])
+
+    def test_session_changes(self):
+        """Test raw session samples are only written when the counts change, or else once a minute.
+        """
+        for offset, count in ((0, 100), (10, 100), (20, 200), (50, 200), (70, 200), (80, 200)):
+            self.add(offset, count)
+        self.assertEqual([(0, 100), (20, 200), (70, 200)], self.get_sessions(0))
+
+    def test_retention(self):
+        """Test each resolution is deleted once older than its retention.
+        """
+        self.add(0, 100)
+        self.add(60, 200)
+        self.add(86400 + 61, 300)
+        self.assertEqual([(86400 + 61, 300)], self.get_sessions(0))
+        self.assertEqual([(0, 100), (60, 200)], self.get_sessions(60))
+        self.history.retention = (1, 1, 90, 3650)
+        self.add(86400 + 121, 400)
+        self.assertEqual([(86400 + 60, 300)], self.get_sessions(60))
+
+    def test_pool(self):
+        """Test connections are reused between threads, at most pool_size are kept, and close() closes them.
+        """
+        opened = []
+        barrier = threading.Barrier(10)
+
+        def query():
+            with self.history.connection() as db:
+                opened.append(db)
+                # All at once, so that each needs a connection of its own
+                barrier.wait()
+
+        threads = [threading.Thread(target=query) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(10, len(set(map(id, opened))))
+        idle = list(self.history.idle)
+        self.assertEqual(self.history.pool_size, len(idle))
+        for db in opened:
+            if db in idle:
+                db.execute('SELECT 1')
+            else:
+                self.assertRaises(monitor.sqlite3.ProgrammingError, db.execute, 'SELECT 1')
+        # Short-lived threads one after another share a connection
+        for _ in range(50):
+            thread = threading.Thread(target=self.history.get_vpn_samples, args=('test', 60, 0, 1))
+            thread.start()
+            thread.join()
+        self.assertEqual(idle, self.history.idle)
+        self.history.close()
+        self.assertEqual([], self.history.idle)
+        for db in idle:
+            self.assertRaises(monitor.sqlite3.ProgrammingError, db.execute, 'SELECT 1')
+
+
+class TestSessionTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = monitor.SessionTracker()
+
+    def diff(self, ts, *sessions):
+        return [(event['ts'], event['event'], event['common_name'], event['port'], event.get('duration'))
+                for event in self.tracker.diff(ts, {'test': get_vpn(sessions)})]
+
+    def test_diff(self):
+        connected_since = monitor.get_timestamp(datetime(2019, 6, 16, 22, 13, 21))
+        self.assertEqual([], self.diff(connected_since + 10, get_session(1)))
+        self.assertEqual([(connected_since + 20, 'connect', 'client2', 1194, None)],
+                         self.diff(connected_since + 20, get_session(1), get_session(2)))
+        # Without last_seen, a session ended when last seen connected
+        self.assertEqual([(connected_since + 30, 'disconnect', 'client1', 1194, 20)],
+                         self.diff(connected_since + 30, get_session(2)))
+        # Nothing is reported while the VPN can't be polled
+        self.assertEqual([], self.tracker.diff(connected_since + 40, {'test': {'socket_connected': False}}))
+
+    def test_reconnect(self):
+        """Test a client reconnecting from a new port between collections is a disconnect and a connect.
+        """
+        connected_since = monitor.get_timestamp(datetime(2019, 6, 16, 22, 13, 21))
+        first = get_session(1)
+        second = get_session(1)
+        for session in (first, second):
+            # Matched by address, as before OpenVPN 2.4
+            del session['client_id']
+        second['port'] = 1195
+        self.diff(connected_since + 10, first)
+        self.assertEqual([(connected_since + 20, 'disconnect', 'client1', 1194, 10),
+                          (connected_since + 20, 'connect', 'client1', 1195, None)],
+                         self.diff(connected_since + 20, second))
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.event_log = self.get_event_log()
+
+    def get_event_log(self):
+        event_log = monitor.EventLog()
+        event_log.segment_size = 100
+        event_log.configure({'event_log': self.path, 'event_log_segments': '3'})
+        self.addCleanup(event_log.release)
+        self.addCleanup(event_log.close)
+        return event_log
+
+    @staticmethod
+    def get_event(ts):
+        # About 60 bytes, so that two fill a segment
+        return {'ts': ts, 'event': 'connect', 'common_name': 'client{:d}'.format(ts)}
+
+    def get_segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.log'))
+
+    def test_rotation(self):
+        """Test the log starts a new segment once the last is full, keeping at most event_log_segments.
+        """
+        for ts in range(1, 6):
+            self.event_log.append([self.get_event(ts)])
+        self.assertEqual(['1.log', '3.log', '5.log'], self.get_segments())
+        self.event_log.append([self.get_event(6)])
+        self.event_log.append([self.get_event(7)])
+        self.assertEqual(['3.log', '5.log', '7.log'], self.get_segments())
+        self.assertEqual([4, 5, 6, 7], [event['ts'] for event in self.event_log.query(4)])
+
+    def test_single_writer(self):
+        """Test only one process writes the log, and another takes over when it goes away.
+        """
+        self.event_log.append([self.get_event(1)])
+        other = self.get_event_log()
+        other.append([self.get_event(2)])
+        self.assertEqual([1], [event['ts'] for event in other.query(0)])
+        self.event_log.append([self.get_event(3)])
+        self.assertEqual([1, 3], [event['ts'] for event in other.query(0)])
+        self.event_log.close()
+        self.event_log.release()
+        other.append([self.get_event(4)])
+        self.assertEqual([1, 3, 4], [event['ts'] for event in self.event_log.query(0)])
+
+
+class TestEventDriven(MonitorTestCase):
+
+    multiplexed = b'>INFO:OpenVPN Management Interface Version 1 -- multiplexed by openvpn-monitor\r\n'
+    state_on = b'SUCCESS: real-time state notification set to ON\r\n'
+    established = (b'>CLIENT:ESTABLISHED,5\r\n>CLIENT:ENV,common_name=alice\r\n>CLIENT:ENV,trusted_ip=5.6.7.8\r\n'
+                   b'>CLIENT:ENV,trusted_port=5000\r\n>CLIENT:ENV,ifconfig_pool_remote_ip=10.8.0.6\r\n'
+                   b'>CLIENT:ENV,time_unix=1560719700\r\n>CLIENT:ENV,END\r\n')
+    disconnect = b'>CLIENT:DISCONNECT,0\r\n>CLIENT:ENV,bytes_received=150\r\n>CLIENT:ENV,END\r\n'
+
+    def setUp(self):
+        super().setUp()
+        # Notifications are read with the responses
+        patcher = patch.object(monitor.connections, 'start_listener')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def collect(self, *chunks):
+        return super().collect(*chunks, event_driven='True', reconcile_interval='300')
+
+    def get_sessions(self, vpn):
+        return [(session['common_name'], session['client_id'], str(session['local_ip']))
+                for session in vpn['sessions'].values()]
+
+    def test_sessions(self):
+        """Test sessions are kept up to date from client notifications between full status dumps.
+        """
+        self.sock.chunks[0] = self.multiplexed
+        self.sock.chunks.insert(1, self.state_on)
+        vpn = self.collect()
+        self.assertEqual([b'state on\n', b'version\nhelp\nstate\nload-stats\nstatus 3\n'], self.sock.sent)
+        self.assertEqual([('bob', '0', '10.8.0.2')], self.get_sessions(vpn))
+        del self.sock.sent[:]
+        vpn = self.collect(self.established, self.disconnect, b'>BYTECOUNT_CLI:5,300,400\r\n', STATE, LOAD_STATS)
+        self.assertEqual([b'state\nload-stats\n'], self.sock.sent)
+        self.assertEqual([('alice', '5', '10.8.0.6')], self.get_sessions(vpn))
+        session = vpn['sessions']['10.8.0.6']
+        # Counters between full dumps may be old, so give no rate
+        self.assertEqual((None, None), (session['bps_recv'], session['bps_sent']))
+        self.assertEqual((monitor.ip_address('5.6.7.8'), 5000, 300, 400),
+                         (session['remote_ip'], session['port'], session['bytes_recv'], session['bytes_sent']))
+        self.assertEqual(datetime.fromtimestamp(1560719700), session['connected_since'])
+        # A state change calls for a full dump, which replaces the sessions
+        del self.sock.sent[:]
+        self.collect(b'>STATE:1560719800,RECONNECTING,SIGHUP,,,,,\r\n', STATE, LOAD_STATS)
+        vpn = self.collect(STATE, LOAD_STATS, STATUS)
+        self.assertEqual([b'state\nload-stats\n', b'state\nload-stats\nstatus 3\n'], self.sock.sent)
+        self.assertEqual([('bob', '0', '10.8.0.2')], self.get_sessions(vpn))
+
+    def test_rates(self):
+        """Test the counters of a full dump aren't compared with those of the last one, from before sessions were
+        collected from notifications.
+        """
+        self.sock.chunks[0] = self.multiplexed
+        self.sock.chunks.insert(1, self.state_on)
+        self.collect()
+        vpn = self.collect(STATE, LOAD_STATS)
+        self.assertIsNone(vpn['sessions']['10.8.0.2']['bps_recv'])
+        monitor.connections.connections['test'].events.reconciled = None
+        vpn = self.collect(STATE, LOAD_STATS, STATUS.replace(b'\t100\t200\t', b'\t100000\t200000\t'))
+        self.assertIsNone(vpn['sessions']['10.8.0.2']['bps_recv'])
+
+    def test_not_multiplexed(self):
+        """Test an interface not shared through the multiplexer is polled, as only it could answer client-auth.
+        """
+        with self.assertLogs('openvpn_monitor', 'WARNING') as logs:
+            vpn = self.collect()
+        self.assertEqual([b'version\nhelp\nstate\nload-stats\nstatus 3\n'], self.sock.sent)
+        self.assertIn('not shared through the multiplexer', logs.output[0])
+        self.assertEqual([('bob', '0', '10.8.0.2')], self.get_sessions(vpn))
+        # A daemon waiting for client-auth is pointed out, once
+        connect = b'>CLIENT:CONNECT,7,0\r\n>CLIENT:ENV,common_name=carol\r\n>CLIENT:ENV,END\r\n'
+        with self.assertLogs('openvpn_monitor', 'WARNING') as logs:
+            self.collect(connect, connect, STATE, LOAD_STATS, STATUS)
+        self.assertEqual(1, len([line for line in logs.output if 'client-auth' in line]))
@@ -0,0 +1,73 @@
+import unittest
+import datetime
+from ipaddress import ip_address
+from util.errors import ParseError
+from util.status_parser import parse_sessions
+
+STATUS_2_3 = """TITLE\tOpenVPN 2.3.10 x86_64-pc-linux-gnu [SSL (OpenSSL)] [LZO] [EPOLL] [PKCS11] [MH] [IPv6] built on Jan  4 2016
+TIME\tWed Mar 23 21:42:22 2016\t1458729742
+HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tBytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)\tUsername
+CLIENT_LIST\tfurlongm\t::ffff:59.167.120.210\t10.10.10.6\t369528\t1216150\tWed Mar 23 21:40:15 2016\t1458729615\tfurlongm
+CLIENT_LIST\tbob\t59.167.120.211:12345\t10.10.10.7\t12345\t11615\tWed Mar 23 21:41:45 2016\t1458729715\tUNDEF
+HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\tLast Ref\tLast Ref (time_t)
+ROUTING_TABLE\t10.10.10.6\tfurlongm\t::ffff:59.167.120.210\tWed Mar 23 21:42:22 2016\t1458729742
+ROUTING_TABLE\t10.10.10.7\tbob\t59.167.120.211:12345\tWed Mar 23 21:42:22 2016\t1458729742
+GLOBAL_STATS\tMax bcast/mcast queue length\t0
+END"""
+
+STATUS_2_4 = """TITLE\tOpenVPN 2.4.4 x86_64-pc-linux-gnu [SSL (OpenSSL)] [LZO] [LZ4] [EPOLL] [PKCS11] [MH/PKTINFO] [AEAD] built on Sep  5 2018
+TIME\tSun Jun 16 22:13:21 2019\t1560719601
+HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\tBytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\tPeer ID
+CLIENT_LIST\talice\t2001:4860:4801:3::20\t10.10.10.8\tfd00::1000\t100\t200\tSun Jun 16 22:10:00 2019\t1560719400\tUNDEF\t7\t1
+HEADER\tROUTING_TABLE\tVirtual Address\tCommon Name\tReal Address\tLast Ref\tLast Ref (time_t)
+ROUTING_TABLE\tfd00::1000\talice\t2001:4860:4801:3::20\tSun Jun 16 22:13:20 2019\t1560719600
+GLOBAL_STATS\tMax bcast/mcast queue length\t0
+END"""
+
+
+class TestStatusParser(unittest.TestCase):
+
+    def test_2_3(self):
+        sessions = parse_sessions(STATUS_2_3.splitlines())
+        self.assertEqual(2, len(sessions))
+        s = sessions[0]
+        self.assertEqual('furlongm', s.username)
+        self.assertEqual(ip_address('59.167.120.210'), s.remote_ip)
+        self.assertIsNone(s.remote_port)
+        self.assertEqual(ip_address('10.10.10.6'), s.local_ip)
+        self.assertEqual(369528, s.bytes_recv)
+        self.assertEqual(1216150, s.bytes_sent)
+        self.assertEqual(datetime.datetime.fromtimestamp(1458729615), s.connected_since)
+        self.assertEqual(datetime.datetime.fromtimestamp(1458729742), s.last_seen)
+        self.assertIsNone(s.client_id)
+        s = sessions[1]
+        self.assertEqual('bob', s.username)
+        self.assertEqual(ip_address('59.167.120.211'), s.remote_ip)
+        self.assertEqual(12345, s.remote_port)
+
+    def test_2_4(self):
+        sessions = parse_sessions(STATUS_2_4.splitlines())
+        self.assertEqual(1, len(sessions))
+        s = sessions[0]
+        self.assertEqual('alice', s.username)
+        self.assertEqual(ip_address('2001:4860:4801:3::20'), s.remote_ip)
+        self.assertEqual(ip_address('fd00::1000'), s.local_ip)
+        self.assertEqual('7', s.client_id)
+        self.assertEqual('1', s.peer_id)
+        self.assertEqual(datetime.datetime.fromtimestamp(1560719600), s.last_seen)
+
+    def test_lazy_conversion(self):
+        s = parse_sessions(STATUS_2_3.splitlines())[0]
+        self.assertEqual('1458729615', s.connected_since_t)
+        self.assertEqual('::ffff:59.167.120.210', s.real_address)
+        with self.assertRaises(AttributeError):
+            s.some_attribute = 1
+
+    def test_no_header(self):
+        with self.assertRaises(ParseError):
+            parse_sessions(['CLIENT_LIST\tbob\t1.2.3.4\t10.0.0.2\t1\t1\tdate\t0\tUNDEF'])
+
+    def test_missing_column(self):
+        with self.assertRaises(ParseError) as ctx:
+            parse_sessions(['HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address'])
+        self.assertEqual('Missing columns in CLIENT_LIST header: bytes_recv, bytes_sent', str(ctx.exception))
@@ -1,8 +1,9 @@
 import unittest
 import datetime
-from unittest.mock import patch, PropertyMock
+from unittest.mock import patch
 from vpn import VPN, VPNType
 from util.errors import MonitorError, ParseError
+from helpers import FakeSocket
 
 
 class TestVPNModel(unittest.TestCase):
@@ -21,6 +22,7 @@ class TestVPNModel(unittest.TestCase):
         self.assertIsNone(vpn._mgmt_socket)
         self.assertEqual(vpn.type, VPNType.IP)
         self.assertEqual(vpn.mgmt_address, 'localhost:1234')
+        self.assertTrue(vpn.persistent)
 
     def test_socket(self):
         vpn = VPN(socket='file.sock')
@@ -120,17 +122,212 @@ END"""
         _ = vpn.state
         mock.assert_not_called()
 
-    @patch('vpn.VPN.release', new_callable=PropertyMock)
-    @patch('vpn.VPN.state', new_callable=PropertyMock)
-    def test_cache(self, release_mock, state_mock):
+    @patch('vpn.VPN.send_batch')
+    def test_cache(self, mock_send_batch):
         """Test caching VPN metadata works and clears correctly.
         """
         vpn = VPN(host='localhost', port=1234)
+        mock_send_batch.return_value = [
+            '1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194',
+            'OpenVPN Version: OpenVPN 2.4.4 x86_64-pc-linux-gnu\nManagement Version: 1',
+            HELP,
+        ]
         vpn.cache_data()
-        release_mock.assert_called_once()
-        state_mock.assert_called_once()
-        vpn._release = 'asd'
-        vpn._state = 'qwe'
+        mock_send_batch.assert_called_once_with(['state', 'version', 'help'])
+        self.assertEqual('OpenVPN 2.4.4 x86_64-pc-linux-gnu', vpn.release)
+        self.assertEqual(1, vpn.mgmt_version)
+        self.assertEqual(frozenset(['bytecount', 'client-auth', 'client-kill', 'help', 'kill', 'state', 'status']), vpn.commands)
+        self.assertEqual('CONNECTED', vpn.state.state_name)
+        mock_send_batch.reset_mock()
+        vpn.cache_data()
+        mock_send_batch.assert_not_called()
         vpn.clear_cache()
-        self.assertIsNone(vpn._release)
         self.assertIsNone(vpn._state)
+        self.assertIsNone(vpn._sessions)
+        self.assertEqual('OpenVPN 2.4.4 x86_64-pc-linux-gnu', vpn._release)
+        # Same daemon, release and commands are still cached
+        mock_send_batch.return_value = ['1560719601,RECONNECTING,SIGHUP,,,,,']
+        vpn.cache_data()
+        mock_send_batch.assert_called_once_with(['state'])
+        self.assertIsNotNone(vpn._commands)
+
+    @patch('vpn.VPN.send_batch')
+    def test_cache_restart(self, mock_send_batch):
+        """Test release and commands are fetched again once the daemon has restarted.
+        """
+        vpn = VPN(host='localhost', port=1234)
+        mock_send_batch.return_value = [
+            '1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194',
+            'OpenVPN Version: OpenVPN 2.4.4 x86_64-pc-linux-gnu\nManagement Version: 1',
+            HELP,
+        ]
+        vpn.cache_data()
+        vpn.clear_cache()
+        mock_send_batch.reset_mock()
+        mock_send_batch.side_effect = [
+            ['1560729601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194'],
+            ['OpenVPN Version: OpenVPN 2.5.1 x86_64-pc-linux-gnu\nManagement Version: 3', HELP],
+        ]
+        vpn.cache_data()
+        self.assertIsNone(vpn._release)
+        vpn.cache_data()
+        self.assertEqual([(['state'],), (['version', 'help'],)], [c[0] for c in mock_send_batch.call_args_list])
+        self.assertEqual('OpenVPN 2.5.1 x86_64-pc-linux-gnu', vpn.release)
+        self.assertEqual(3, vpn.mgmt_version)
+
+    @patch('vpn.select.select')
+    @patch('vpn.socket.create_connection')
+    def test_persistent_connection(self, mock_create_connection, mock_select):
+        """Test a persistent VPN reuses its socket until the other end closes it.
+        """
+        banner = b'>INFO:OpenVPN Management Interface Version 1\r\n'
+        mock_create_connection.side_effect = lambda *a, **kw: FakeSocket([banner])
+        mock_select.return_value = ([], [], [])
+        vpn = VPN(host='localhost', port=1234)
+        vpn.persistent = True
+        with vpn.connection():
+            pass
+        with vpn.connection():
+            pass
+        mock_create_connection.assert_called_once()
+        self.assertTrue(vpn.is_connected)
+        # Socket readable with EOF means the daemon went away
+        mock_select.return_value = ([vpn._socket], [], [])
+        with vpn.connection():
+            pass
+        self.assertEqual(2, mock_create_connection.call_count)
+        vpn.persistent = False
+        mock_select.return_value = ([], [], [])
+        with vpn.connection():
+            pass
+        self.assertFalse(vpn.is_connected)
+
+    @patch('vpn.socket.create_connection')
+    def test_send_command(self, mock_create_connection):
+        """Test responses are framed correctly and notifications are skipped.
+        """
+        mock_create_connection.return_value = FakeSocket([
+            b'>INFO:OpenVPN Management Interface Version 1\r\n',
+            b'SUCCESS: nclients=1,bytesin=556794,bytesout=1483013\r\n',
+            b'>CLIENT:ESTABLISHED,0\r\n>CLIENT:ENV,common_name=bob\r\n>CLIENT:ENV,END\r\n1560719601,CONN',
+            b'ECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194\r\nEND\r\n',
+            b'SUCCESS: common name \'bob\' found, 1 client(s) killed\r\n',
+        ])
+        vpn = VPN(host='localhost', port=1234)
+        with vpn.connection():
+            self.assertEqual('SUCCESS: nclients=1,bytesin=556794,bytesout=1483013', vpn.send_command('load-stats'))
+            self.assertEqual('1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194', vpn.send_command('state'))
+            self.assertEqual("SUCCESS: common name 'bob' found, 1 client(s) killed", vpn.send_command('kill bob'))
+
+    @patch('vpn.socket.create_connection')
+    def test_send_batch(self, mock_create_connection):
+        """Test a batch is sent in one write and its responses are split by their framing.
+        """
+        sock = FakeSocket([
+            b'>INFO:OpenVPN Management Interface Version 1\r\n',
+            b'OpenVPN Version: OpenVPN 2.4.4\r\nManagement Version: 1\r\nEND\r\nSUCCESS: nclients=1,',
+            b'bytesin=556794,bytesout=1483013\r\n>STATE:1560719602,EXITING\r\nERROR: unknown command\r\n'
+            b'1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194\r\nEND\r\n',
+        ])
+        mock_create_connection.return_value = sock
+        vpn = VPN(host='localhost', port=1234)
+        with vpn.connection():
+            self.assertEqual(['OpenVPN Version: OpenVPN 2.4.4\nManagement Version: 1',
+                              'SUCCESS: nclients=1,bytesin=556794,bytesout=1483013',
+                              'ERROR: unknown command',
+                              '1560719601,CONNECTED,SUCCESS,10.0.0.1,,,1.2.3.4,1194'],
+                             vpn.send_batch(['version', 'load-stats', 'foo', 'state']))
+        self.assertEqual(b'version\nload-stats\nfoo\nstate\n', sock.sent[0])
+
+    @patch('vpn.socket.create_connection')
+    def test_iter_command(self, mock_create_connection):
+        """Test response lines are yielded before the whole response has been received.
+        """
+        sock = FakeSocket([
+            b'>INFO:OpenVPN Management Interface Version 1\r\n',
+            b'TITLE\tOpenVPN 2.4.4\r\nTIME\tWed Mar 23 21:42:22 2016\t1458729742\r\n',
+            b'GLOBAL_STATS\tMax bcast/mcast queue length\t0\r\nEND\r\n',
+        ])
+        mock_create_connection.return_value = sock
+        vpn = VPN(host='localhost', port=1234)
+        with vpn.connection():
+            lines = vpn.iter_command('status 3')
+            self.assertEqual('TITLE\tOpenVPN 2.4.4', next(lines))
+            self.assertEqual(1, len(sock.chunks))
+            self.assertEqual(['TIME\tWed Mar 23 21:42:22 2016\t1458729742',
+                              'GLOBAL_STATS\tMax bcast/mcast queue length\t0'], list(lines))
+
+    @patch('vpn.select.select')
+    @patch('vpn.socket.create_connection')
+    def test_event_driven_sessions(self, mock_create_connection, mock_select):
+        """Test sessions are maintained from client notifications between full status dumps.
+        """
+        sock = FakeSocket([
+            b'>INFO:OpenVPN Management Interface Version 1\r\n',
+            b'SUCCESS: real-time state notification set to ON\r\n',
+            b'HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\t'
+            b'Bytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\tPeer ID\r\n'
+            b'CLIENT_LIST\tbob\t1.2.3.4:1194\t10.0.0.2\t\t100\t200\tWed Jun 16 22:13:21 2019\t1560719601\tUNDEF\t0\t0\r\n'
+            b'END\r\n',
+            b'>CLIENT:ESTABLISHED,5\r\n>CLIENT:ENV,common_name=alice\r\n>CLIENT:ENV,trusted_ip=5.6.7.8\r\n'
+            b'>CLIENT:ENV,trusted_port=5000\r\n>CLIENT:ENV,ifconfig_pool_remote_ip=10.0.0.6\r\n'
+            b'>CLIENT:ENV,time_unix=1560719700\r\n>CLIENT:ENV,END\r\n'
+            b'>CLIENT:DISCONNECT,0\r\n>CLIENT:ENV,bytes_received=150\r\n>CLIENT:ENV,END\r\n'
+            b'>STATE:1560719800,RECONNECTING,SIGHUP,,,,,\r\n',
+        ])
+        mock_create_connection.return_value = sock
+        vpn = VPN(host='localhost', port=1234)
+        vpn.subscribe()
+        self.assertTrue(vpn.persistent)
+        self.assertEqual(['bob'], [s.common_name for s in vpn._client_sessions.values()])
+        mock_select.side_effect = [([sock], [], []), ([], [], [])]
+        sessions = vpn.sessions
+        self.assertEqual(['alice'], [s.common_name for s in sessions])
+        self.assertEqual('5', sessions[0].client_id)
+        self.assertEqual('5.6.7.8', str(sessions[0].remote_ip))
+        self.assertEqual(5000, sessions[0].remote_port)
+        self.assertEqual('10.0.0.6', str(sessions[0].local_ip))
+        self.assertEqual('RECONNECTING', vpn._state.state_name)
+        self.assertEqual(0, len(sock.chunks))
+
+    @patch('vpn.select.select')
+    @patch('vpn.socket.create_connection')
+    def test_event_driven_reconnect(self, mock_create_connection, mock_select):
+        """Test a lost event-driven connection is reconnected and resubscribed, or else the last sessions are kept.
+        """
+        greeting = b'>INFO:OpenVPN Management Interface Version 1\r\n'
+        state_on = b'SUCCESS: real-time state notification set to ON\r\n'
+        header = (b'HEADER\tCLIENT_LIST\tCommon Name\tReal Address\tVirtual Address\tVirtual IPv6 Address\t'
+                  b'Bytes Received\tBytes Sent\tConnected Since\tConnected Since (time_t)\tUsername\tClient ID\t'
+                  b'Peer ID\r\n')
+        bob = b'CLIENT_LIST\tbob\t1.2.3.4:1194\t10.0.0.2\t\t100\t200\tWed Jun 16 22:13:21 2019\t1560719601\tUNDEF\t0\t0\r\n'
+        alice = b'CLIENT_LIST\talice\t5.6.7.8:5000\t10.0.0.6\t\t0\t0\tWed Jun 16 22:15:00 2019\t1560719700\tUNDEF\t5\t0\r\n'
+        # The first connection is closed by the daemon after the status dump
+        first = FakeSocket([greeting, state_on, header + bob + b'END\r\n'])
+        second = FakeSocket([greeting, state_on, header + alice + b'END\r\n'])
+        mock_create_connection.side_effect = [first, second]
+        vpn = VPN(host='localhost', port=1234)
+        vpn.name = 'test'
+        vpn.subscribe()
+        mock_select.return_value = ([first], [], [])
+        self.assertEqual(['alice'], [s.common_name for s in vpn.sessions])
+        self.assertTrue(vpn.is_connected)
+        self.assertEqual([b'state on\n', b'status 3\n'], second.sent)
+        # Failing to reconnect keeps the sessions as last known
+        mock_select.return_value = ([second], [], [])
+        mock_create_connection.side_effect = ConnectionRefusedError('Connection refused')
+        self.assertEqual(['alice'], [s.common_name for s in vpn.sessions])
+        self.assertFalse(vpn.is_connected)
+
+
+HELP = """Management Interface for OpenVPN 2.4.4 x86_64-pc-linux-gnu
+Commands:
+bytecount n            : Show bytes in/out, update every n secs (0=off).
+client-kill CID [M]    : Kill client instance CID with message M (def=RESTART)
+help                   : Print this message.
+kill cn                : Kill the client instance(s) having common name cn.
+kill IP:port           : Kill the client instance connecting from IP:port.
+status [n]             : Show current daemon status info using format #n.
+state [on|off] [N|all] : Like log, but show state history.
+                         (N=show last N lines, all=show all lines)
+client-auth CID KID    : Authenticate client-id/key-id CID/KID (MULTILINE)"""